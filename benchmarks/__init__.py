@@ -0,0 +1,4 @@
+""" Benchmarks of the processing hot paths, using synthetic UKV data
+
+See `benchmarks/README.md` for how to run them.
+"""
@@ -0,0 +1,294 @@
+""" A local stand-in for the Weather DataHub api
+
+This serves the `/orders`, `/orders/{order_id}/latest`, `/orders/{order_id}/latest/{file_id}`,
+`/orders/{order_id}/latest/{file_id}/data`, `/runs` and `/runs/{model_id}` endpoints over real
+sockets, so downloading can be tested and benchmarked without the real api. Latency, a bandwidth
+cap, 429 and 5xx errors and dropped connections can be added.
+
+For example
+```python
+with MockDataHubServer(files=make_grib_files(folder), latency=0.05, error_rate=0.1) as server:
+    datahub = MetOfficeDataHub(client_id="fake", client_secret="fake", base_url=server.base_url)
+    datahub.download_all_files(order_ids=[server.order_id])
+```
+"""
+import json
+import logging
+import random
+import re
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional
+from urllib.parse import urlparse
+
+from metofficedatahub.constants import ROOT
+from metofficedatahub.models import File
+
+logger = logging.getLogger(__name__)
+
+# size of the chunks, in bytes, the data is sent in
+CHUNK_SIZE = 64 * 1024
+
+
+class MockDataHubServer:
+    """Local http server that behaves like the Weather DataHub api"""
+
+    def __init__(
+        self,
+        files: List[File],
+        order_id: str = "test_order_id",
+        model_id: str = "mo-uk",
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency: float = 0,
+        bandwidth: Optional[float] = None,
+        error_rate: float = 0,
+        too_many_requests_rate: float = 0,
+        retry_after: float = 1,
+        drop_rate: float = 0,
+        seed: int = 0,
+    ):
+        """
+        Initialise the server, this is started with `start` or by using it as a context manager
+
+        :param files: the files of the order, `local_filename` is the file that is served
+        :param order_id: the id of the order
+        :param model_id: the model of the order
+        :param host: the host to listen on
+        :param port: the port to listen on, 0 picks a free port
+        :param latency: seconds to wait before each response
+        :param bandwidth: the maximum bytes per second each data download is sent at.
+            If None, there is no limit
+        :param error_rate: the fraction of requests that get a 503 response
+        :param too_many_requests_rate: the fraction of requests that get a 429 response
+        :param retry_after: the `Retry-After` header, in seconds, of the 429 responses
+        :param drop_rate: the fraction of requests where the connection is dropped. For data
+            downloads, this happens after half of the file has been sent
+        :param seed: seed for the random errors
+        """
+        self.files = {file.fileId: file for file in files}
+        self.order_id = order_id
+        self.model_id = model_id
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.too_many_requests_rate = too_many_requests_rate
+        self.retry_after = retry_after
+        self.drop_rate = drop_rate
+
+        # number of requests to each endpoint, and the responses that were injected
+        self.request_counts: Counter = Counter()
+        self.injected: Counter = Counter()
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), _make_handler(self))
+        self._server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        """The base url to give to MetOfficeDataHub"""
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/{ROOT}"
+
+    def start(self):
+        """Start serving in a background thread"""
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        logger.debug(f"Mock DataHub serving on {self.base_url}")
+
+    def stop(self):
+        """Stop serving"""
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self) -> "MockDataHubServer":
+        """Start the server"""
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        """Stop the server"""
+        self.stop()
+
+    def get_failure(self) -> Optional[str]:
+        """Pick a failure for a request, one of "drop", "429", "503" or None"""
+        with self._lock:
+            value = self._random.random()
+        for failure, rate in [
+            ("drop", self.drop_rate),
+            ("429", self.too_many_requests_rate),
+            ("503", self.error_rate),
+        ]:
+            if value < rate:
+                with self._lock:
+                    self.injected[failure] += 1
+                return failure
+            value -= rate
+        return None
+
+    def get_json(self, path: str) -> Optional[dict]:
+        """
+        Get the json response for a path, or None if the path is not found
+
+        :param path: the path of the request, after the base url
+        """
+        order = {
+            "orderId": self.order_id,
+            "name": self.order_id,
+            "modelId": self.model_id,
+            "requiredLatestRuns": sorted({f"{file.run:02}" for file in self.files.values()}),
+            "format": "GRIB2",
+        }
+        runs = sorted({file.runDateTime for file in self.files.values()})
+        complete_runs = {
+            "modelId": self.model_id,
+            "completeRuns": [
+                {"run": f"{run.hour:02}", "runDateTime": _isoformat(run), "runFilter": ""}
+                for run in runs
+            ],
+        }
+
+        if path == "/orders":
+            return {"orders": [order]}
+        if path == f"/orders/{self.order_id}/latest":
+            return {
+                "orderDetails": {
+                    "order": order,
+                    "files": [_file_to_json(file) for file in self.files.values()],
+                }
+            }
+        if path == "/runs":
+            return {"runs": [complete_runs]}
+        if path == f"/runs/{self.model_id}":
+            return complete_runs
+
+        match = re.fullmatch(f"/orders/{re.escape(self.order_id)}/latest/([^/]+)", path)
+        if match is not None and match.group(1) in self.files:
+            file = self.files[match.group(1)]
+            return {
+                "fileDetails": {
+                    "file": _file_to_json(file),
+                    "parameterDetails": [],
+                }
+            }
+
+        return None
+
+
+def _isoformat(time: datetime) -> str:
+    """Format a datetime like the api"""
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def _file_to_json(file: File) -> dict:
+    """The json of a file, like the api"""
+    return {
+        "fileId": file.fileId,
+        "runDateTime": _isoformat(file.runDateTime),
+        "run": f"{file.run:02}",
+        "timesteps": [str(step) for step in file.timesteps or []],
+    }
+
+
+def _make_handler(server: MockDataHubServer):
+    """Make the request handler class for a server"""
+
+    class Handler(BaseHTTPRequestHandler):
+        """Handle the requests to the mock api"""
+
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            """Log to debug, rather than stderr"""
+            logger.debug(format % args)
+
+        def do_GET(self):
+            """Handle a GET request"""
+            path = urlparse(self.path).path
+            if not path.startswith(f"/{ROOT}"):
+                self.send_error(404)
+                return
+            path = path[len(f"/{ROOT}") :]
+            is_data = path.endswith("/data")
+
+            with server._lock:
+                server.request_counts["data" if is_data else path] += 1
+
+            if server.latency > 0:
+                time.sleep(server.latency)
+
+            failure = server.get_failure()
+            if failure == "drop" and not is_data:
+                self.close_connection = True
+                return
+            if failure == "429":
+                self.send_response(429)
+                self.send_header("Retry-After", str(server.retry_after))
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            if failure == "503":
+                self.send_json({"message": "Service unavailable"}, status_code=503)
+                return
+
+            if is_data:
+                self.send_data(path[: -len("/data")].split("/")[-1], drop=failure == "drop")
+                return
+
+            data = server.get_json(path)
+            if data is None:
+                self.send_json({"message": f"{path} not found"}, status_code=404)
+            else:
+                self.send_json(data)
+
+        def send_json(self, data: dict, status_code: int = 200):
+            """Send a json response"""
+            body = json.dumps(data).encode()
+            self.send_response(status_code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def send_data(self, file_id: str, drop: bool = False):
+            """Send a file, from the `Range` header if given, at most at the bandwidth"""
+            if file_id not in server.files:
+                self.send_json({"message": f"{file_id} not found"}, status_code=404)
+                return
+
+            with open(server.files[file_id].local_filename, "rb") as f:
+                content = f.read()
+
+            start = 0
+            match = re.fullmatch(r"bytes=(\d+)-", self.headers.get("Range", ""))
+            if match is not None and int(match.group(1)) < len(content):
+                start = int(match.group(1))
+                self.send_response(206)
+                self.send_header(
+                    "Content-Range", f"bytes {start}-{len(content) - 1}/{len(content)}"
+                )
+            else:
+                self.send_response(200)
+            self.send_header("Content-Type", "application/x-grib")
+            self.send_header("Content-Length", str(len(content) - start))
+            self.end_headers()
+
+            # when dropping, only send half the file, and then close the connection
+            end = start + (len(content) - start) // 2 if drop else len(content)
+            for chunk_start in range(start, end, CHUNK_SIZE):
+                chunk = content[chunk_start : min(chunk_start + CHUNK_SIZE, end)]
+                self.wfile.write(chunk)
+                if server.bandwidth is not None:
+                    time.sleep(len(chunk) / server.bandwidth)
+
+            if drop:
+                self.close_connection = True
+
+    return Handler
@@ -0,0 +1,237 @@
+""" Time the processing hot paths on synthetic UKV data
+
+Run with, for example,
+```bash
+python -m benchmarks.run --size medium --repeat 3 --output results.json \
+    --compare benchmarks/baseline.json
+```
+"""
+import json
+import logging
+import platform
+import statistics
+import tempfile
+import time
+from datetime import datetime, timezone
+from typing import Callable, Dict, Optional
+
+import click
+
+from benchmarks.mock_datahub import MockDataHubServer
+from benchmarks.synthetic import (
+    SIZES,
+    make_grib_files,
+    make_order_details_json,
+    make_ukv_dataset,
+)
+from metofficedatahub.cache import StagingCache
+from metofficedatahub.light_models import parse_order_details
+from metofficedatahub.models import OrderDetails
+from metofficedatahub.multiple_files import MetOfficeDataHub, _chunk, save_to_s3
+from metofficedatahub.regrid import _weights_in_memory
+from metofficedatahub.utils import add_x_y, post_process_dataset
+
+logger = logging.getLogger(__name__)
+
+# a benchmark is a regression if it is this much slower than the baseline
+REGRESSION_THRESHOLD = 0.2
+
+
+def time_function(function: Callable[[], None], repeat: int) -> Dict[str, float]:
+    """
+    Time a function
+
+    :param function: the function to time, this is called `repeat` times
+    :param repeat: the number of times to call the function
+    :return: the min, median and max time in seconds
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+
+    return {"min": min(times), "median": statistics.median(times), "max": max(times)}
+
+
+def run_benchmarks(size: str = "small", repeat: int = 3) -> dict:
+    """
+    Run all the benchmarks
+
+    :param size: the size of the synthetic data, one of SIZES
+    :param repeat: the number of times each benchmark is run
+    :return: dict of the size, the machine and the times of each benchmark.
+        If a benchmark fails, its error is stored instead of its times.
+    """
+    config = SIZES[size]
+    logger.info(f"Running benchmarks with {size} data {config}")
+
+    dataset = make_ukv_dataset(**config)
+    regridded = add_x_y(dataset.copy())
+    post_processed = post_process_dataset(regridded)
+    chunked = _chunk(post_processed, ideal_chunk_size_mb=1)
+    order_details_json = make_order_details_json()
+
+    def add_x_y_cold():
+        _weights_in_memory.clear()
+        add_x_y(dataset.copy(), regrid_cache_dir=None)
+
+    with tempfile.TemporaryDirectory() as tmpdirname, MockDataHubServer(
+        files=make_grib_files(folder=f"{tmpdirname}/source", **config), latency=0.01
+    ) as server:
+        datahub = MetOfficeDataHub(
+            client_id="fake",
+            client_secret="fake",
+            staging_cache=StagingCache(
+                staging_dir=f"{tmpdirname}/staging", index_dir=f"{tmpdirname}/index"
+            ),
+        )
+        datahub.files = make_grib_files(folder=f"{tmpdirname}/raw", **config)
+
+        def download_all_files():
+            # a new cache each time, so every file is downloaded
+            download_dir = tempfile.mkdtemp(dir=tmpdirname)
+            MetOfficeDataHub(
+                client_id="fake",
+                client_secret="fake",
+                base_url=server.base_url,
+                cache_dir=download_dir,
+            ).download_all_files(order_ids=[server.order_id])
+
+        benchmarks = {
+            "download_all_files": download_all_files,
+            "order_details": lambda: OrderDetails(**order_details_json),
+            "order_details_lite": lambda: parse_order_details(
+                order_details_json, fields=("fileId", "runDateTime")
+            ),
+            "add_x_y": lambda: add_x_y(dataset.copy()),
+            "add_x_y_cold_weights": add_x_y_cold,
+            "add_x_y_bbox": lambda: add_x_y(
+                dataset.copy(), bbox=(300_000, 400_000, 400_000, 500_000)
+            ),
+            "post_process_dataset": lambda: post_process_dataset(regridded),
+            "_chunk": lambda: _chunk(post_processed, ideal_chunk_size_mb=1),
+            "save_to_s3_zarr": lambda: save_to_s3(chunked, f"{tmpdirname}/latest.zarr"),
+            "save_to_s3_netcdf": lambda: save_to_s3(post_processed, f"{tmpdirname}/latest.netcdf"),
+            "load_all_files": lambda: datahub.load_all_files(max_workers=1).compute(),
+        }
+
+        results = {}
+        for name, function in benchmarks.items():
+            logger.info(f"Running {name}")
+            try:
+                results[name] = time_function(function, repeat=repeat)
+            except Exception as e:
+                logger.warning(f"Benchmark {name} failed: {e}")
+                results[name] = {"error": str(e)}
+
+    return {
+        "size": size,
+        "config": config,
+        "repeat": repeat,
+        "datetime": datetime.now(timezone.utc).isoformat(),
+        "machine": {"python": platform.python_version(), "platform": platform.platform()},
+        "results": results,
+    }
+
+
+def compare(results: dict, baseline: dict, threshold: float = REGRESSION_THRESHOLD) -> dict:
+    """
+    Compare the results to a baseline, using the median times
+
+    :param results: the results from `run_benchmarks`
+    :param baseline: a baseline, in the same format as `results`, or a dict of them keyed by size
+    :param threshold: a benchmark is a regression if it is this fraction slower than the baseline
+    :return: dict of the ratio (result / baseline) of each benchmark in both, the names of the
+        regressions, the names of the benchmarks that have no baseline times (because they are
+        not in the baseline, or failed in it), and the names of the benchmarks that failed but
+        have baseline times
+    """
+    baseline = baseline.get(results["size"], baseline)
+    if baseline.get("size") != results["size"]:
+        raise ValueError(f"There is no baseline for size {results['size']}")
+
+    ratios = {}
+    missing = []
+    failed = []
+    for name, result in results["results"].items():
+        baseline_result = baseline["results"].get(name, {})
+        if "median" not in baseline_result:
+            missing.append(name)
+        elif "median" not in result:
+            failed.append(name)
+        else:
+            ratios[name] = result["median"] / baseline_result["median"]
+
+    regressions = [name for name, ratio in ratios.items() if ratio > 1 + threshold]
+    return {"ratios": ratios, "regressions": regressions, "missing": missing, "failed": failed}
+
+
+@click.command()
+@click.option(
+    "--size",
+    default="small",
+    help="The size of the synthetic data",
+    type=click.Choice(list(SIZES)),
+)
+@click.option("--repeat", default=3, help="How many times each benchmark is run", type=click.INT)
+@click.option(
+    "--output", default=None, help="Save the results to this json file", type=click.STRING
+)
+@click.option(
+    "--compare",
+    "baseline_path",
+    default=None,
+    help="A json file of baseline results to compare to, e.g. benchmarks/baseline.json",
+    type=click.STRING,
+)
+@click.option(
+    "--fail-on-regression",
+    is_flag=True,
+    default=False,
+    help="Exit with an error if a benchmark is slower than the baseline",
+)
+def run(
+    size: str,
+    repeat: int,
+    output: Optional[str] = None,
+    baseline_path: Optional[str] = None,
+    fail_on_regression: bool = False,
+):
+    """Run the benchmarks"""
+    results = run_benchmarks(size=size, repeat=repeat)
+
+    for name, result in results["results"].items():
+        if "median" in result:
+            click.echo(f"{name:25} {result['median']:10.4f} s")
+        else:
+            click.echo(f"{name:25} failed: {result['error']}")
+
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if baseline_path is not None:
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        comparison = compare(results=results, baseline=baseline)
+
+        click.echo(f"Compared to {baseline_path}:")
+        for name, ratio in comparison["ratios"].items():
+            click.echo(f"{name:25} {ratio:10.2f} x")
+        for name in comparison["missing"]:
+            click.echo(f"{name:25} no baseline")
+        for name in comparison["failed"]:
+            click.echo(f"{name:25} failed, but worked in the baseline")
+
+        if len(comparison["regressions"]) > 0:
+            click.echo(f"Regressions: {comparison['regressions']}")
+        if len(comparison["regressions"]) > 0 or len(comparison["failed"]) > 0:
+            if fail_on_regression:
+                raise click.ClickException("Benchmarks are slower than the baseline, or failed")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format="%(asctime)s %(name)s %(levelname)s:%(message)s")
+    logger.setLevel(logging.INFO)
+    run()
@@ -0,0 +1,259 @@
+""" Synthetic UKV-shaped datasets and grib files for the benchmarks
+
+The UKV model is on a Lambert Azimuthal Equal Area grid, centred on (54.9N, 2.5W), of 1042 x 970
+points at 2 km. The synthetic data is on the same area, at a configurable resolution, so that the
+regridding to the OSGB grid covers the same region as the real data.
+"""
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+import pyproj
+import xarray as xr
+
+from metofficedatahub.models import File
+
+logger = logging.getLogger(__name__)
+
+UKV_PROJ4 = "+proj=laea +lat_0=54.9 +lon_0=-2.5 +x_0=0 +y_0=0 +a=6371229 +b=6371229"
+UKV_NX = 1042
+UKV_NY = 970
+UKV_DX_METERS = 2_000
+
+# variable name in the file id: (short name, discipline, parameter category, parameter number)
+VARIABLES = {
+    "temperature": ("t", 0, 0, 0),
+    "relative-humidity": ("r", 0, 1, 1),
+    "low-cloud-cover": ("lcc", 0, 6, 3),
+    "medium-cloud-cover": ("mcc", 0, 6, 4),
+    "high-cloud-cover": ("hcc", 0, 6, 5),
+    "downward-longwave": ("dlwrf", 0, 5, 3),
+    "downward-shortwave": ("dswrf", 0, 4, 7),
+    "snow-depth": ("sde", 0, 1, 11),
+    "visibility": ("vis", 0, 19, 0),
+    "pressure": ("pres", 0, 3, 0),
+    "dew-point": ("dpt", 0, 0, 6),
+    "total-cloud-cover": ("tcc", 0, 6, 1),
+}
+
+# sizes of the synthetic data, as (grid spacing in meters, number of steps, number of variables)
+SIZES = {
+    "small": dict(dx=32_000, n_steps=3, n_variables=2),
+    "medium": dict(dx=8_000, n_steps=12, n_variables=6),
+    "realistic": dict(dx=UKV_DX_METERS, n_steps=36, n_variables=12),
+}
+
+
+def get_grid(dx: float) -> Dict[str, np.ndarray]:
+    """
+    Get the UKV area on a grid with spacing `dx`
+
+    :param dx: the grid spacing in meters
+    :return: dict of the `x` and `y` LAEA coordinates of the grid,
+        and the 2D `latitude` and `longitude` of the grid points
+    """
+    width = UKV_NX * UKV_DX_METERS
+    height = UKV_NY * UKV_DX_METERS
+    x = -width / 2 + dx * np.arange(int(width // dx))
+    y = -height / 2 + dx * np.arange(int(height // dx))
+
+    x_grid, y_grid = np.meshgrid(x, y)
+    laea_to_lat_lon = pyproj.Transformer.from_crs(
+        pyproj.CRS.from_proj4(UKV_PROJ4), 4326, always_xy=True
+    )
+    longitude, latitude = laea_to_lat_lon.transform(x_grid, y_grid)
+
+    return {"x": x, "y": y, "latitude": latitude, "longitude": longitude}
+
+
+def make_values(shape: tuple, seed: int = 0) -> np.ndarray:
+    """Smooth values with some noise, so they compress roughly like real data"""
+    rng = np.random.default_rng(seed)
+    ny, nx = shape[-2:]
+    y = np.linspace(0, 4 * np.pi, ny)[:, None]
+    x = np.linspace(0, 4 * np.pi, nx)[None, :]
+    field = 280 + 5 * np.sin(x + rng.uniform(0, np.pi)) * np.cos(y)
+    values = np.broadcast_to(field, shape) + rng.normal(0, 0.5, size=shape)
+    return values.astype(np.float32)
+
+
+def make_ukv_dataset(
+    dx: float = SIZES["small"]["dx"],
+    n_steps: int = SIZES["small"]["n_steps"],
+    n_variables: int = SIZES["small"]["n_variables"],
+    init_time: datetime = datetime(2022, 1, 1),
+) -> xr.Dataset:
+    """
+    Make a dataset that looks like the merged grib files, before `add_x_y`
+
+    :param dx: the grid spacing in meters
+    :param n_steps: the number of hourly steps
+    :param n_variables: the number of variables, at most len(VARIABLES)
+    :param init_time: the init time of the run
+    :return: dataset with dimensions (time, step, y, x)
+    """
+    grid = get_grid(dx)
+    shape = (1, n_steps, len(grid["y"]), len(grid["x"]))
+
+    data_vars = {}
+    for i, (short_name, *_) in enumerate(list(VARIABLES.values())[:n_variables]):
+        data_vars[short_name] = (["time", "step", "y", "x"], make_values(shape, seed=i))
+
+    return xr.Dataset(
+        data_vars=data_vars,
+        coords={
+            "time": pd.to_datetime([init_time]),
+            "step": pd.to_timedelta(np.arange(n_steps), unit="h"),
+            "latitude": (["y", "x"], grid["latitude"]),
+            "longitude": (["y", "x"], grid["longitude"]),
+        },
+    )
+
+
+def make_grib_file(
+    filename: str,
+    variable: str,
+    dx: float,
+    n_steps: int,
+    init_time: datetime,
+    seed: int = 0,
+):
+    """
+    Write a UKV-shaped grib2 file, with one message for each step
+
+    :param filename: the file to write to
+    :param variable: the variable name, one of VARIABLES
+    :param dx: the grid spacing in meters
+    :param n_steps: the number of hourly steps
+    :param init_time: the init time of the run
+    :param seed: seed for the random values
+    """
+    # eccodes is only needed here, and is imported after pyproj,
+    # otherwise pyproj can not find its database
+    import eccodes
+
+    _, discipline, category, number = VARIABLES[variable]
+    grid = get_grid(dx)
+    ny, nx = grid["latitude"].shape
+    values = make_values((n_steps, ny, nx), seed=seed)
+
+    with open(filename, "wb") as f:
+        for step in range(n_steps):
+            handle = eccodes.codes_grib_new_from_samples("GRIB2")
+            try:
+                # Lambert Azimuthal Equal Area, on a sphere with radius 6371229 m
+                eccodes.codes_set(handle, "gridDefinitionTemplateNumber", 140)
+                eccodes.codes_set(handle, "shapeOfTheEarth", 6)
+                eccodes.codes_set(handle, "Nx", nx)
+                eccodes.codes_set(handle, "Ny", ny)
+                eccodes.codes_set(
+                    handle, "latitudeOfFirstGridPoint", int(grid["latitude"][0, 0] * 1e6)
+                )
+                eccodes.codes_set(
+                    handle, "longitudeOfFirstGridPoint", int((grid["longitude"][0, 0] % 360) * 1e6)
+                )
+                eccodes.codes_set(handle, "standardParallelInMicrodegrees", int(54.9e6))
+                eccodes.codes_set(handle, "centralLongitudeInMicrodegrees", int((-2.5 % 360) * 1e6))
+                eccodes.codes_set(handle, "xDirectionGridLengthInMillimetres", int(dx * 1000))
+                eccodes.codes_set(handle, "yDirectionGridLengthInMillimetres", int(dx * 1000))
+                eccodes.codes_set(handle, "scanningMode", 64)
+
+                eccodes.codes_set(handle, "dataDate", int(init_time.strftime("%Y%m%d")))
+                eccodes.codes_set(handle, "dataTime", init_time.hour * 100)
+                eccodes.codes_set(handle, "productDefinitionTemplateNumber", 0)
+                eccodes.codes_set(handle, "typeOfFirstFixedSurface", 103)
+                eccodes.codes_set(handle, "scaledValueOfFirstFixedSurface", 2)
+                eccodes.codes_set(handle, "discipline", discipline)
+                eccodes.codes_set(handle, "parameterCategory", category)
+                eccodes.codes_set(handle, "parameterNumber", number)
+                eccodes.codes_set(handle, "forecastTime", step)
+
+                eccodes.codes_set_values(handle, values[step].ravel().astype(float))
+                eccodes.codes_write(handle, f)
+            finally:
+                eccodes.codes_release(handle)
+
+
+def make_grib_files(
+    folder: str,
+    dx: float = SIZES["small"]["dx"],
+    n_steps: int = SIZES["small"]["n_steps"],
+    n_variables: int = SIZES["small"]["n_variables"],
+    init_time: datetime = None,
+) -> List[File]:
+    """
+    Write one grib file for each variable, like a downloaded order
+
+    :param folder: the folder to write the files to
+    :param dx: the grid spacing in meters
+    :param n_steps: the number of hourly steps in each file
+    :param n_variables: the number of variables, at most len(VARIABLES)
+    :param init_time: the init time of the run. If None, the start of the previous hour is used,
+        so the files are not filtered out by `load_all_files`.
+    :return: the File objects, with `local_filename` set, for `MetOfficeDataHub.files`
+    """
+    if init_time is None:
+        init_time = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+        init_time = init_time.replace(tzinfo=None) - timedelta(hours=1)
+
+    os.makedirs(folder, exist_ok=True)
+
+    files = []
+    for i, variable in enumerate(list(VARIABLES)[:n_variables]):
+        file_id = f"agl_{variable}_{init_time:%Y%m%d%H}"
+        filename = f"{folder}/{file_id}.grib"
+        logger.debug(f"Making {filename}")
+        make_grib_file(
+            filename=filename,
+            variable=variable,
+            dx=dx,
+            n_steps=n_steps,
+            init_time=init_time,
+            seed=i,
+        )
+        files.append(
+            File(
+                fileId=file_id,
+                runDateTime=init_time,
+                run=init_time.hour,
+                local_filename=filename,
+                timesteps=list(range(n_steps)),
+            )
+        )
+
+    return files
+
+
+def make_order_details_json(n_runs: int = 24, n_files_per_run: int = 200) -> dict:
+    """
+    Make the "orderDetails" of a large order, like the json response of the api
+
+    :param n_runs: the number of runs, one each hour
+    :param n_files_per_run: the number of files in each run
+    :return: dict of the order and its files
+    """
+    init_time = datetime(2022, 1, 1)
+    files = []
+    for run in range(n_runs):
+        run_datetime = init_time + timedelta(hours=run)
+        for i in range(n_files_per_run):
+            files.append(
+                {
+                    "fileId": f"agl_variable-{i}_{run_datetime:%Y%m%d%H}",
+                    "runDateTime": f"{run_datetime:%Y-%m-%dT%H:%M:%SZ}",
+                    "run": f"{run_datetime.hour:02}",
+                    "timesteps": [str(step) for step in range(55)],
+                }
+            )
+
+    order = {
+        "orderId": "test_order_id",
+        "name": "test_order_id",
+        "modelId": "mo-uk",
+        "requiredLatestRuns": [f"{hour:02}" for hour in range(24)],
+        "format": "GRIB2",
+    }
+    return {"order": order, "files": files}
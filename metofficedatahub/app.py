@@ -1,14 +1,15 @@
 """ Application that pulls data from the Metoffice API and saves to a zarr file"""
 import logging
 import os
-from typing import Optional
+import time
+from datetime import datetime, timezone
+from typing import Callable, Optional, Tuple
 
 import click
-from nowcasting_datamodel.connection import DatabaseConnection
-from nowcasting_datamodel.models.base import Base_Forecast
-from nowcasting_datamodel.read.read import update_latest_input_data_last_updated
 
+from metofficedatahub.metrics import PipelineMetrics
 from metofficedatahub.multiple_files import MetOfficeDataHub, save
+from metofficedatahub.utils import BBOX_CRS, parse_bbox
 
 logging.basicConfig(format="%(asctime)s %(name)s %(levelname)s:%(message)s")
 logging.getLogger("metofficedatahub").setLevel(
@@ -60,12 +61,104 @@ logger.setLevel(getattr(logging, os.environ.get("LOG_LEVEL", "INFO")))
     multiple=True,
     type=click.STRING,
 )
+@click.option(
+    "--max-workers",
+    default=1,
+    envvar="MAX_WORKERS",
+    help="The number of files downloaded at the same time",
+    type=click.INT,
+)
+@click.option(
+    "--load-workers",
+    default=1,
+    envvar="LOAD_WORKERS",
+    help="The maximum number of processes used to decode the grib files",
+    type=click.INT,
+)
+@click.option(
+    "--archive-path",
+    default=None,
+    envvar="ARCHIVE_PATH",
+    help="A .zarr archive that each new run is appended to",
+    type=click.STRING,
+)
+@click.option(
+    "--archive-retention-hours",
+    default=None,
+    envvar="ARCHIVE_RETENTION_HOURS",
+    help="Runs older than this are removed from the zarr archive. Keeps all runs if not set",
+    type=click.FLOAT,
+)
+@click.option(
+    "--dtype",
+    default="float32",
+    envvar="DTYPE",
+    help="The float dtype of the saved data",
+    type=click.Choice(["float16", "float32", "float64"]),
+)
+@click.option(
+    "--poll-interval",
+    default=None,
+    envvar="POLL_INTERVAL",
+    help="If set, keep running and check for a new complete run every this many seconds. "
+    "The data is only downloaded and processed when there is a new run",
+    type=click.FLOAT,
+)
+@click.option(
+    "--model-id",
+    default="mo-uk",
+    envvar="MODEL_ID",
+    help="The model that is checked for new complete runs, when polling",
+    type=click.STRING,
+)
+@click.option(
+    "--metrics-json",
+    "metrics_json_path",
+    default=None,
+    envvar="METRICS_JSON",
+    help="Save the timing and resource metrics of each stage to this json file",
+    type=click.STRING,
+)
+@click.option(
+    "--metrics-prometheus",
+    "metrics_prometheus_path",
+    default=None,
+    envvar="METRICS_PROMETHEUS",
+    help="Save the timing and resource metrics of each stage to this Prometheus textfile",
+    type=click.STRING,
+)
+@click.option(
+    "--bbox",
+    default=None,
+    envvar="BBOX",
+    help="Only regrid and save this region, as 'west,south,east,north'. "
+    "Saves the whole UK if not set",
+    type=click.STRING,
+)
+@click.option(
+    "--bbox-crs",
+    default="osgb",
+    envvar="BBOX_CRS",
+    help="The crs of the bounding box, 'osgb' for meters or 'lat_lon' for degrees",
+    type=click.Choice(BBOX_CRS),
+)
 def run(
     api_key,
     api_secret,
     save_dir,
     db_url: Optional[str] = None,
     order_ids: Optional[list[str]] = None,
+    max_workers: int = 1,
+    load_workers: int = 1,
+    archive_path: Optional[str] = None,
+    archive_retention_hours: Optional[float] = None,
+    dtype: str = "float32",
+    poll_interval: Optional[float] = None,
+    model_id: str = "mo-uk",
+    metrics_json_path: Optional[str] = None,
+    metrics_prometheus_path: Optional[str] = None,
+    bbox: Optional[str] = None,
+    bbox_crs: str = "osgb",
 ):
     """Run main application
 
@@ -73,27 +166,184 @@ def run(
     2. Load grib files to one Xarray Dataset
     3. Save to directory
     4. Update latest data table
+
+    If `poll_interval` is set, this keeps running, and the steps are run each time there is a new
+    complete run. The process, the connection and the regridding weights are reused between runs.
     """
 
     logger.info(f'Running application and saving to "{save_dir}"')
-    # 1. Get data from API, download grip files
     datahub = MetOfficeDataHub(client_id=api_key, client_secret=api_secret)
-    datahub.download_all_files(order_ids=order_ids)
+    bbox = parse_bbox(bbox)
+
+    def pipeline() -> datetime:
+        return run_pipeline(
+            datahub=datahub,
+            save_dir=save_dir,
+            db_url=db_url,
+            order_ids=order_ids,
+            max_workers=max_workers,
+            load_workers=load_workers,
+            archive_path=archive_path,
+            archive_retention_hours=archive_retention_hours,
+            dtype=dtype,
+            metrics_json_path=metrics_json_path,
+            metrics_prometheus_path=metrics_prometheus_path,
+            bbox=bbox,
+            bbox_crs=bbox_crs,
+            # when polling, the order is fetched because there is a new run, so is not cached
+            refresh=poll_interval is not None,
+        )
+
+    if poll_interval is None:
+        pipeline()
+    else:
+        poll_for_new_runs(
+            datahub=datahub, pipeline=pipeline, model_id=model_id, poll_interval=poll_interval
+        )
+
+
+def run_pipeline(
+    datahub: MetOfficeDataHub,
+    save_dir: str,
+    db_url: Optional[str] = None,
+    order_ids: Optional[list[str]] = None,
+    max_workers: int = 1,
+    load_workers: int = 1,
+    archive_path: Optional[str] = None,
+    archive_retention_hours: Optional[float] = None,
+    dtype: str = "float32",
+    metrics_json_path: Optional[str] = None,
+    metrics_prometheus_path: Optional[str] = None,
+    bbox: Optional[Tuple[float, float, float, float]] = None,
+    bbox_crs: str = "osgb",
+    refresh: bool = False,
+) -> datetime:
+    """
+    Download, load and save the latest data once, see `run`
+
+    :param refresh: if True, the cached order details are not used
+    :return: the init time of the run that was saved
+    """
+
+    # the metrics are only measured if they are saved
+    metrics = PipelineMetrics(
+        enabled=metrics_json_path is not None or metrics_prometheus_path is not None
+    )
+    datahub.metrics = metrics
+
+    # 1. Get data from API, download grip files
+    datahub.download_all_files(order_ids=order_ids, max_workers=max_workers, refresh=refresh)
 
     # 2. Load grib files to one Xarray Dataset
-    data = datahub.load_all_files()
+    data = datahub.load_all_files(
+        max_workers=load_workers, dtype=dtype, bbox=bbox, bbox_crs=bbox_crs
+    )
 
     # 3. Save to directory
-    save(dataset=data, save_dir=save_dir)
+    save(
+        dataset=data,
+        save_dir=save_dir,
+        archive_path=archive_path,
+        archive_retention_hours=archive_retention_hours,
+        metrics=metrics,
+    )
+
+    if metrics_json_path is not None:
+        metrics.save_json(metrics_json_path)
+    if metrics_prometheus_path is not None:
+        metrics.save_prometheus(metrics_prometheus_path)
 
     # 4. update table to show when this data has been pulled
     if db_url is not None:
+        # nowcasting_datamodel is slow to import, and only needed when there is a database
+        from nowcasting_datamodel.connection import DatabaseConnection
+        from nowcasting_datamodel.models.base import Base_Forecast
+        from nowcasting_datamodel.read.read import update_latest_input_data_last_updated
+
         connection = DatabaseConnection(url=db_url, base=Base_Forecast)
         with connection.get_session() as session:
             update_latest_input_data_last_updated(session=session, component="nwp")
 
     logger.info("Finished Running application.")
 
+    init_time = data.init_time.values[-1].astype("datetime64[s]").astype(int)
+    return datetime.fromtimestamp(init_time, tz=timezone.utc)
+
+
+def _as_utc(value: Optional[datetime]) -> Optional[datetime]:
+    """Make a datetime timezone aware, naive datetimes are taken to be in UTC"""
+    if value is None or value.tzinfo is not None:
+        return value
+    return value.replace(tzinfo=timezone.utc)
+
+
+def get_latest_complete_run(datahub: MetOfficeDataHub, model_id: str) -> Optional[datetime]:
+    """
+    Get the datetime of the latest complete run of a model, or None if there are none
+
+    The response cache is not used, so that new runs are found at every poll.
+    """
+    runs = datahub.get_runs_model_id(model_id=model_id, refresh=True)
+    if len(runs.completeRuns) == 0:
+        return None
+    return max(run.runDateTime for run in runs.completeRuns)
+
+
+def poll_for_new_runs(
+    datahub: MetOfficeDataHub,
+    pipeline: Callable[[], Optional[datetime]],
+    model_id: str,
+    poll_interval: float,
+    max_polls: Optional[int] = None,
+):
+    """
+    Check for new complete runs, and run the pipeline when there is one
+
+    If the pipeline fails, the error is logged and it is tried again at the next poll. A run can be
+    listed as complete before it is in the latest files of the order, so the run is also tried
+    again if the pipeline saved an older run.
+
+    :param datahub: the datahub used to check for new runs
+    :param pipeline: function that downloads, loads and saves the data, and returns the
+        init time of the run it saved
+    :param model_id: the model that is checked for new complete runs
+    :param poll_interval: the number of seconds between checks
+    :param max_polls: stop after this many checks. If None, this runs forever
+    """
+    logger.info(f"Checking for new complete runs of {model_id} every {poll_interval} seconds")
+
+    last_run = None
+    polls = 0
+    while max_polls is None or polls < max_polls:
+        if polls > 0:
+            time.sleep(poll_interval)
+        polls += 1
+
+        try:
+            latest_run = get_latest_complete_run(datahub=datahub, model_id=model_id)
+        except Exception as e:
+            logger.warning(f"Could not get the latest complete run of {model_id}: {e}")
+            continue
+
+        if latest_run is None or latest_run == last_run:
+            logger.debug(f"No new complete run, the latest is {latest_run}")
+            continue
+
+        logger.info(f"New complete run {latest_run}")
+        try:
+            saved_run = pipeline()
+        except Exception:
+            logger.exception(f"Failed to process run {latest_run}, will try again")
+            continue
+
+        if _as_utc(saved_run) == _as_utc(latest_run):
+            last_run = latest_run
+        else:
+            logger.warning(
+                f"Saved run {saved_run}, but the latest complete run is {latest_run}, "
+                f"will try again"
+            )
+
 
 if __name__ == "__main__":
     run()
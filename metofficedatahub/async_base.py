@@ -0,0 +1,392 @@
+""" Asyncio version of the API wrapper
+
+`AsyncMetOfficeDataHub` has the same methods as `BaseMetOfficeDataHub`, and returns the same
+pydantic models, but the calls are coroutines. One aiohttp session, with a pool of `pool_size`
+connections, is used for all the calls, so many files can be downloaded at the same time
+without a thread for each. The calls to the filesystem, which can be s3, are run in a thread
+with `asyncio.to_thread`, so they do not block the event loop. For example
+```python
+async with AsyncMetOfficeDataHub() as datahub:
+    order_details = await datahub.get_lastest_order(order_id=order_id)
+    filenames = await asyncio.gather(
+        *[
+            datahub.get_latest_order_file_id_data(order_id=order_id, file_id=file.fileId)
+            for file in order_details.files
+        ]
+    )
+```
+"""
+import asyncio
+import hashlib
+import logging
+from datetime import datetime
+from typing import Any, Iterable, Optional, Tuple, Union
+
+import aiohttp
+import fsspec
+
+from metofficedatahub.base import DOWNLOAD_CHUNK_SIZE, DataHubMixin, _get_expected_size
+from metofficedatahub.light_models import LightOrderDetails, parse_order_details
+from metofficedatahub.models import FileDetails, OrderDetails, OrderList, RunList, RunListForModel
+from metofficedatahub.rate_limit import get_retry_after
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncMetOfficeDataHub(DataHubMixin):
+    """Asyncio class for connection and retrieving data from Met Office Weather DataHub AMD"""
+
+    def make_session(self, pool_size: int):
+        """
+        Set up the session, which is made the first time the api is called, in the event loop
+
+        :param pool_size: the number of connections to the api that can be open at the same time
+        """
+        self.pool_size = pool_size
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    async def __aenter__(self) -> "AsyncMetOfficeDataHub":
+        """Use the client as an async context manager, so the session is closed at the end"""
+        return self
+
+    async def __aexit__(self, *args):
+        """Close the session"""
+        await self.close()
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """The session, this keeps connections to the api alive between calls"""
+        if self._session is None or self._session.closed:
+            logger.debug(f"Making session with a pool of {self.pool_size} connections")
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=aiohttp.ClientTimeout(
+                    sock_connect=self.timeout[0], sock_read=self.timeout[1]
+                ),
+            )
+        return self._session
+
+    async def close(self):
+        """Close the session and its connections"""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def call_url(self, url: str, headers: dict = None) -> aiohttp.ClientResponse:
+        """
+        Call url, the same as `BaseMetOfficeDataHub.call_url`
+
+        The body of the response is not read, so it can be streamed. The caller has to read it,
+        or release the response, so the connection goes back to the pool.
+
+        :param url: url to be called
+        :param headers: headers to use, defaults to self.headers
+        :return: response from url
+        """
+        if headers is None:
+            headers = self.headers
+
+        attempt = 0
+        while True:
+            logger.debug(f"Calling url {url}")
+            message: Optional[str] = None
+            retry_after: Optional[float] = None
+            await asyncio.sleep(self.rate_limiter.reserve())
+            try:
+                response = await self.session.get(
+                    url, headers=headers, params={"detail": "MINIMAL"}
+                )
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                message = f"Tried to call url but got error {e!r}"
+            else:
+                logger.debug(response.status)
+                if response.status == 429:
+                    message = "Tried to call url but got response code 429, too many requests"
+                    retry_after = get_retry_after(response.headers.get("Retry-After"))
+                    if retry_after is None:
+                        retry_after = self._get_backoff(attempt=attempt)
+                    response.release()
+                elif response.status >= 500:
+                    message = (
+                        f"Tried to call url but got response code "
+                        f"{response.status} with message: {await response.text()}"
+                    )
+                    response.release()
+
+            if message is None:
+                break
+
+            if attempt >= self.max_retries:
+                logger.debug(message)
+                raise Exception(message)
+
+            if retry_after is not None:
+                # hold back every call with this rate limiter, this waits before the next call
+                logger.warning(f"{message}. Will retry in {retry_after:.1f} seconds")
+                self.rate_limiter.pause(retry_after)
+            else:
+                backoff = self._get_backoff(attempt=attempt)
+                logger.warning(f"{message}. Will retry in {backoff:.1f} seconds")
+                await asyncio.sleep(backoff)
+            attempt += 1
+
+        # check response code 200 (or 206 for partial downloads, or 304 for conditional requests)
+        # and show error if not
+        if response.status not in (200, 206, 304):
+            message = (
+                f"Tried to call url but got response code "
+                f"{response.status} with message: {await response.text()}"
+            )
+            logger.debug(message)
+            raise Exception(message)
+
+        return response
+
+    async def call_url_json(self, url: str, endpoint: str, refresh: bool = False) -> Any:
+        """
+        Call url and get the json data, using the response cache
+
+        :param url: url to be called
+        :param endpoint: the name of the endpoint, used to get the TTL from the response cache
+        :param refresh: if True, the url is always called, even if the cached response is fresh.
+            The call is still conditional, so an unchanged response is not sent again.
+        :return: the json data of the response
+        """
+        entry = await asyncio.to_thread(self.response_cache.get, url)
+        if self._use_cached_response(entry, endpoint=endpoint, refresh=refresh):
+            logger.debug(f"Using cached response for {url}")
+            return entry["data"]
+
+        response = await self.call_url(url=url, headers=self._get_conditional_headers(entry))
+        try:
+            if response.status == 304 and entry is not None:
+                logger.debug(f"Cached response for {url} is still valid")
+                data = entry["data"]
+            else:
+                data = await response.json(content_type=None)
+        finally:
+            response.release()
+
+        await asyncio.to_thread(
+            self._cache_response,
+            url=url,
+            data=data,
+            response_headers=response.headers,
+            entry=entry,
+        )
+
+        return data
+
+    async def get_orders(self) -> OrderList:
+        """Get a list of order"""
+
+        data = await self.call_url_json(url=f"{self.base_url}/orders", endpoint="orders")
+
+        return OrderList(**data)
+
+    async def get_lastest_order(
+        self,
+        order_id,
+        lite: bool = False,
+        fields: Optional[Iterable[str]] = None,
+        refresh: bool = False,
+    ) -> Union[OrderDetails, LightOrderDetails]:
+        """
+        Provide a list of the latest available data files for the specified order.
+
+        :param order_id: The order ID that you wish to retrieve information about
+        :param lite: if True, the files are parsed into slotted LightFile objects, which is much
+            faster for large orders, rather than validated into pydantic File models
+        :param fields: the fields of each file to parse when `lite` is True, e.g. ("fileId",
+            "runDateTime"). If None, all the fields are parsed.
+        :param refresh: if True, the response cache is not used, e.g. when a new run is expected
+        :return: The latest order
+        """
+
+        data = await self.call_url_json(
+            url=f"{self.base_url}/orders/{order_id}/latest",
+            endpoint="latest_order",
+            refresh=refresh,
+        )
+        data = data["orderDetails"]
+
+        if lite:
+            return parse_order_details(data, fields=fields)
+
+        return OrderDetails(**data)
+
+    async def get_latest_order_file_id(self, order_id, file_id) -> FileDetails:
+        """
+        Provide the details of a specific file that can be obtained for the latest available data.
+
+        :param order_id: The order ID that you wish to retrieve information about
+        :param file_id: The file ID of the application/x-grib file you wish to retrieve
+            information about
+        :return: Pydantic object of the details of the file
+        """
+
+        data = await self.call_url_json(
+            url=f"{self.base_url}/orders/{order_id}/latest/{file_id}",
+            endpoint="file_details",
+        )
+
+        return FileDetails(**data["fileDetails"])
+
+    async def get_latest_order_file_id_data(
+        self,
+        order_id,
+        file_id,
+        filename: str = None,
+        run_datetime: Optional[datetime] = None,
+        save_manifest: bool = True,
+    ) -> str:
+        """
+        Gets the actual data for a specific file that can be obtained for the latest available data.
+
+        Files that are already in the download cache index are not downloaded again.
+
+        :param order_id: The order ID that you wish to retrieve information about
+        :param file_id: The file ID of the application/x-grib file you wish to retrieve
+        :param filename: the name of the file that will be saved
+        :param run_datetime: the datetime of the run the file is from, this is saved in the
+            download cache index
+        :param save_manifest: save the download cache index after downloading the file. This can be
+            set to False when downloading many files, and then the index is saved at the end.
+        :return: filename where the data is downloaded to
+        """
+
+        headers = self.headers.copy()
+        headers["accept"] = "application/x-grib"
+
+        if filename is None:
+            filename = f"{order_id}_{file_id}.grib"
+
+        filename = f"{self.cache_dir}/{filename}"
+        download_cache = self.download_cache
+        fs = download_cache.fs
+        # the first call loads the download cache index
+        if not await asyncio.to_thread(download_cache.contains, filename):
+            await asyncio.to_thread(fs.makedirs, self.cache_dir, exist_ok=True)
+
+            size, checksum = await self.download_url_to_file(
+                url=f"{self.base_url}/orders/{order_id}/latest/{file_id}/data",
+                filename=filename,
+                fs=fs,
+                headers=headers,
+            )
+
+            await asyncio.to_thread(
+                download_cache.add,
+                filename=filename,
+                size=size,
+                checksum=checksum,
+                file_id=file_id,
+                run_datetime=run_datetime,
+            )
+            if save_manifest:
+                await asyncio.to_thread(download_cache.save)
+        else:
+            logger.debug(f"File already exists so not downloading new one, {filename}")
+
+        return filename
+
+    async def download_url_to_file(
+        self, url: str, filename: str, fs: fsspec.AbstractFileSystem, headers: dict
+    ) -> Tuple[int, str]:
+        """
+        Stream the data from an url to a file, like `BaseMetOfficeDataHub.download_url_to_file`
+
+        :param url: url to be called
+        :param filename: the file the data is saved to
+        :param fs: the filesystem of the file
+        :param headers: headers to use when calling the url
+        :return: the size in bytes, and the md5 checksum, of the downloaded file
+        """
+        temp_filename = f"{filename}.part"
+
+        offset = await asyncio.to_thread(_get_size, fs, temp_filename)
+        if offset > 0:
+            logger.debug(f"Resuming download of {filename} from byte {offset}")
+            try:
+                response = await self.call_url(
+                    url=url, headers={**headers, "Range": f"bytes={offset}-"}
+                )
+            except Exception as e:
+                logger.warning(f"Could not resume download of {filename}, starting again: {e}")
+                await asyncio.to_thread(fs.rm, temp_filename)
+                offset = 0
+
+        if offset == 0:
+            response = await self.call_url(url=url, headers=headers)
+
+        checksum = hashlib.md5()
+        try:
+            if response.status == 206:
+                mode = "ab"
+                # the checksum includes the part that was already downloaded
+                await asyncio.to_thread(_update_checksum, checksum, fs, temp_filename)
+            else:
+                # the server sent the whole file
+                offset = 0
+                mode = "wb"
+
+            expected_size = _get_expected_size(response=response, offset=offset)
+
+            localfile = await asyncio.to_thread(fs.open, temp_filename, mode=mode)
+            try:
+                async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                    checksum.update(chunk)
+                    await asyncio.to_thread(localfile.write, chunk)
+            finally:
+                await asyncio.to_thread(localfile.close)
+        finally:
+            response.release()
+
+        size = await asyncio.to_thread(fs.size, temp_filename)
+        if expected_size is not None and size != expected_size:
+            raise Exception(
+                f"Downloaded {size} bytes but expected {expected_size} bytes for {filename}, "
+                f"the download will be resumed next time"
+            )
+
+        await asyncio.to_thread(fs.mv, temp_filename, filename)
+
+        return size, checksum.hexdigest()
+
+    async def get_runs(self) -> RunList:
+        """
+        List all runs
+
+        :return: pydantic object of run list
+        """
+
+        data = await self.call_url_json(url=f"{self.base_url}/runs", endpoint="runs")
+
+        return RunList(**data)
+
+    async def get_runs_model_id(self, model_id, refresh: bool = False) -> RunListForModel:
+        """
+        List all runs for specific model
+
+        :param model_id: the model id we are looking for
+        :param refresh: if True, the response cache is not used, e.g. when polling for new runs
+        :return: Pydantic object of specific run list for a model
+        """
+
+        data = await self.call_url_json(
+            url=f"{self.base_url}/runs/{model_id}", endpoint="runs", refresh=refresh
+        )
+
+        return RunListForModel(**data)
+
+
+def _get_size(fs: fsspec.AbstractFileSystem, filename: str) -> int:
+    """The size in bytes of a file, or 0 if it does not exist"""
+    return fs.size(filename) if fs.exists(filename) else 0
+
+
+def _update_checksum(checksum, fs: fsspec.AbstractFileSystem, filename: str):
+    """Update a checksum, e.g. `hashlib.md5()`, with the contents of a file"""
+    with fs.open(filename, mode="rb") as localfile:
+        for chunk in iter(lambda: localfile.read(DOWNLOAD_CHUNK_SIZE), b""):
+            checksum.update(chunk)
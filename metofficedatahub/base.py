@@ -1,25 +1,52 @@
 """ Main application for the API wrapper """
+import abc
+import hashlib
 import logging
 import os
+import random
+import time
+from datetime import datetime
+from typing import Any, Iterable, Optional, Tuple, Union
 
 import fsspec
 import requests
 from pathy import Pathy
+from requests.adapters import HTTPAdapter
 
-from metofficedatahub.constants import DOMAIN, ROOT
+from metofficedatahub.cache import DownloadCache, ResponseCache
+from metofficedatahub.constants import BASE_URL
+from metofficedatahub.light_models import LightOrderDetails, parse_order_details
 from metofficedatahub.models import FileDetails, OrderDetails, OrderList, RunList, RunListForModel
+from metofficedatahub.rate_limit import RateLimiter, get_retry_after
 
 logger = logging.getLogger(__name__)
 
+# size of the chunks, in bytes, that are streamed from the api to file
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
 
-class BaseMetOfficeDataHub:
-    """Main class for connection and retrieving data from Met Office Weather DataHub AMD"""
+
+class DataHubMixin(abc.ABC):
+    """The parts of the api client that do not depend on how the api is called
+
+    This is shared by `BaseMetOfficeDataHub`, which uses requests, and `AsyncMetOfficeDataHub`,
+    which uses aiohttp. Each client makes its session in `make_session`.
+    """
 
     def __init__(
         self,
         cache_dir: str = os.getenv("RAW_DIR", "./temp_metofficedatahub"),
         client_id: str = None,
         client_secret: str = None,
+        pool_size: int = int(os.getenv("POOL_SIZE", 10)),
+        max_retries: int = int(os.getenv("MAX_RETRIES", 3)),
+        backoff_factor: float = float(os.getenv("BACKOFF_FACTOR", 1)),
+        timeout: Tuple[float, float] = (
+            float(os.getenv("CONNECT_TIMEOUT", 10)),
+            float(os.getenv("READ_TIMEOUT", 60)),
+        ),
+        response_cache: Optional[ResponseCache] = None,
+        base_url: str = os.getenv("BASE_URL", BASE_URL),
+        rate_limiter: Optional[RateLimiter] = None,
     ):
         """
         Initialise the class
@@ -27,6 +54,18 @@ class BaseMetOfficeDataHub:
         :param cache_dir: The directory where files are downloaded to
         :param client_id: the client id for the api
         :param client_secret: the client secret for the api
+        :param pool_size: the number of connections to the api kept in the pool
+        :param max_retries: how many times to retry on 429, server (5xx) and connection errors
+        :param backoff_factor: retry number n waits for backoff_factor * 2**n seconds,
+            plus a random jitter of up to backoff_factor seconds
+        :param timeout: the (connect, read) timeouts in seconds for each call
+        :param response_cache: cache for the responses of the orders, runs and file details
+            endpoints. If None, the default ResponseCache is used, which is in memory unless
+            RESPONSE_CACHE_DIR is set.
+        :param base_url: the url of the api, e.g. a local mock server for testing
+        :param rate_limiter: limits the calls to the api, and is shared by everything using
+            this client. If None, the default RateLimiter is used, which is set by RATE_LIMIT
+            and RATE_LIMIT_BURST.
         """
 
         if client_id is None:
@@ -41,7 +80,18 @@ class BaseMetOfficeDataHub:
 
         self.make_headers()
 
+        self.base_url = base_url.rstrip("/")
+
         self.cache_dir = cache_dir
+        self._download_cache = None
+
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.timeout = timeout
+        self.make_session(pool_size=pool_size)
+
+        self.response_cache = ResponseCache() if response_cache is None else response_cache
+        self.rate_limiter = RateLimiter() if rate_limiter is None else rate_limiter
 
     def make_headers(self):
         """
@@ -55,24 +105,167 @@ class BaseMetOfficeDataHub:
             "accept": "application/json",
         }
 
-    def call_url(self, url: str, headers: dict = None) -> requests.Response:
+    @abc.abstractmethod
+    def make_session(self, pool_size: int):
+        """
+        Make the session used to call the api
+
+        :param pool_size: the number of connections kept in the pool
+        """
+
+    @property
+    def download_cache(self) -> DownloadCache:
+        """The index of files in the cache directory, and the filesystem of the cache directory"""
+        if self._download_cache is None or self._download_cache.cache_dir != self.cache_dir:
+            fs = fsspec.open(Pathy.fluid(self.cache_dir).parent).fs
+            self._download_cache = DownloadCache(cache_dir=self.cache_dir, fs=fs)
+        return self._download_cache
+
+    def _get_backoff(self, attempt: int) -> float:
+        """Time in seconds to wait before retry number `attempt`, with jitter"""
+        return self.backoff_factor * 2**attempt + random.uniform(0, self.backoff_factor)
+
+    def _use_cached_response(self, entry: Optional[dict], endpoint: str, refresh: bool) -> bool:
+        """
+        Check if a cached response can be used without calling the api
+
+        :param entry: the cached entry of the url, or None if it is not cached
+        :param endpoint: the name of the endpoint, used to get the TTL from the response cache
+        :param refresh: if True, the cached response is never used without calling the api
+        :return: True if the cached response is younger than the TTL of the endpoint
+        """
+        return (
+            not refresh
+            and entry is not None
+            and self.response_cache.is_fresh(entry, endpoint=endpoint)
+        )
+
+    def _get_conditional_headers(self, entry: Optional[dict]) -> dict:
+        """
+        Get the headers for calling a json endpoint
+
+        :param entry: the cached entry of the url, or None if it is not cached
+        :return: the headers, with `If-None-Match` and `If-Modified-Since` if the cached
+            response has an `ETag` or `Last-Modified`
+        """
+        headers = dict(self.headers)
+        if entry is not None:
+            if entry["etag"] is not None:
+                headers["If-None-Match"] = entry["etag"]
+            if entry["last_modified"] is not None:
+                headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def _cache_response(
+        self, url: str, data: Any, response_headers, entry: Optional[dict] = None
+    ) -> dict:
+        """
+        Save the json data of a response in the response cache
+
+        A 304 response does not have to include the `ETag` and `Last-Modified` headers again,
+        so those of the cached entry are kept if they are missing.
+
+        :param url: url that was called
+        :param data: the json data of the response
+        :param response_headers: the headers of the response
+        :param entry: the cached entry of the url before it was called, if there was one
+        :return: the cached entry
+        """
+        if entry is None:
+            entry = {"etag": None, "last_modified": None}
+        return self.response_cache.set(
+            url=url,
+            data=data,
+            etag=response_headers.get("ETag", entry["etag"]),
+            last_modified=response_headers.get("Last-Modified", entry["last_modified"]),
+        )
+
+
+class BaseMetOfficeDataHub(DataHubMixin):
+    """Main class for connection and retrieving data from Met Office Weather DataHub AMD"""
+
+    def make_session(self, pool_size: int):
+        """
+        Make session object, this keeps connections to the api alive between calls
+
+        :param pool_size: the number of connections kept in the pool
+        """
+        logger.debug(f"Making session with a pool of {pool_size} connections")
+
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def call_url(self, url: str, headers: dict = None, stream: bool = False) -> requests.Response:
         """
         Call url string using request library.
 
+        Server errors (5xx), timeouts and connection errors are retried, with exponential backoff.
+        Each call waits for the rate limiter. A 429 response is retried after its `Retry-After`
+        time, and all other calls using the same rate limiter wait for that time too.
+
         :param url: url to be called
+        :param headers: headers to use, defaults to self.headers
+        :param stream: if True, the body is not downloaded until it is read from the response
         :return: response from url
         """
         if headers is None:
             headers = self.headers
 
         url = f"{url}?detail=MINIMAL"
-        logger.debug(f"Calling url {url}")
 
-        response = requests.get(url, headers=headers)
+        attempt = 0
+        while True:
+            logger.debug(f"Calling url {url}")
+            message: Optional[str] = None
+            too_many_requests = False
+            response: Optional[requests.Response] = None
+            self.rate_limiter.acquire()
+            try:
+                response = self.session.get(
+                    url, headers=headers, timeout=self.timeout, stream=stream
+                )
+            except (requests.ConnectionError, requests.Timeout) as e:
+                message = f"Tried to call url but got error {e}"
+            else:
+                logger.debug(response.status_code)
+                if response.status_code == 429:
+                    message = "Tried to call url but got response code 429, too many requests"
+                    too_many_requests = True
+                elif response.status_code >= 500:
+                    message = (
+                        f"Tried to call url but got response code "
+                        f"{response.status_code} with message: {response.text}"
+                    )
 
-        # check response code 200 and show error if not
-        logger.debug(response.status_code)
-        if response.status_code != 200:
+            if message is None:
+                break
+
+            if response is not None:
+                # the connection goes back to the pool, rather than being held while waiting
+                response.close()
+
+            if attempt >= self.max_retries:
+                logger.debug(message)
+                raise Exception(message)
+
+            if too_many_requests:
+                # hold back every call with this rate limiter, this waits in `acquire`
+                backoff = get_retry_after(response.headers.get("Retry-After"))
+                if backoff is None:
+                    backoff = self._get_backoff(attempt=attempt)
+                logger.warning(f"{message}. Will retry in {backoff:.1f} seconds")
+                self.rate_limiter.pause(backoff)
+            else:
+                backoff = self._get_backoff(attempt=attempt)
+                logger.warning(f"{message}. Will retry in {backoff:.1f} seconds")
+                time.sleep(backoff)
+            attempt += 1
+
+        # check response code 200 (or 206 for partial downloads, or 304 for conditional requests)
+        # and show error if not
+        if response.status_code not in (200, 206, 304):
             message = (
                 f"Tried to call url but got response code "
                 f"{response.status_code} with message: {response.text}"
@@ -82,27 +275,72 @@ class BaseMetOfficeDataHub:
 
         return response
 
+    def call_url_json(self, url: str, endpoint: str, refresh: bool = False) -> Any:
+        """
+        Call url and get the json data, using the response cache
+
+        A cached response is used if it is younger than the TTL of the endpoint. Otherwise the url
+        is called, conditionally if the cached response has an `ETag` or `Last-Modified`.
+
+        :param url: url to be called
+        :param endpoint: the name of the endpoint, used to get the TTL from the response cache
+        :param refresh: if True, the url is always called, even if the cached response is fresh.
+            The call is still conditional, so an unchanged response is not sent again.
+        :return: the json data of the response
+        """
+        entry = self.response_cache.get(url)
+        if self._use_cached_response(entry, endpoint=endpoint, refresh=refresh):
+            logger.debug(f"Using cached response for {url}")
+            return entry["data"]
+
+        response = self.call_url(url=url, headers=self._get_conditional_headers(entry))
+
+        if response.status_code == 304 and entry is not None:
+            logger.debug(f"Cached response for {url} is still valid")
+            data = entry["data"]
+        else:
+            data = response.json()
+
+        self._cache_response(url=url, data=data, response_headers=response.headers, entry=entry)
+
+        return data
+
     def get_orders(self) -> OrderList:
         """Get a list of order"""
 
-        response = self.call_url(url=f"https://{DOMAIN}/{ROOT}/orders")
-
-        data = response.json()
+        data = self.call_url_json(url=f"{self.base_url}/orders", endpoint="orders")
 
         return OrderList(**data)
 
-    def get_lastest_order(self, order_id) -> OrderDetails:
+    def get_lastest_order(
+        self,
+        order_id,
+        lite: bool = False,
+        fields: Optional[Iterable[str]] = None,
+        refresh: bool = False,
+    ) -> Union[OrderDetails, LightOrderDetails]:
         """
         Provide a list of the latest available data files for the specified order.
 
         :param order_id: The order ID that you wish to retrieve information about. The Order ID can
             be seen under a specific order on the Atmospheric Weather Data Tool Order Summary Page
             or found in the list of orders in the JSON response from your call to /1.0.0/orders
+        :param lite: if True, the files are parsed into slotted LightFile objects, which is much
+            faster for large orders, rather than validated into pydantic File models
+        :param fields: the fields of each file to parse when `lite` is True, e.g. ("fileId",
+            "runDateTime"). If None, all the fields are parsed.
+        :param refresh: if True, the response cache is not used, e.g. when a new run is expected
         :return: The latest order
         """
 
-        response = self.call_url(url=f"https://{DOMAIN}/{ROOT}/orders/{order_id}/latest")
-        data = response.json()["orderDetails"]
+        data = self.call_url_json(
+            url=f"{self.base_url}/orders/{order_id}/latest",
+            endpoint="latest_order",
+            refresh=refresh,
+        )["orderDetails"]
+
+        if lite:
+            return parse_order_details(data, fields=fields)
 
         return OrderDetails(**data)
 
@@ -119,16 +357,26 @@ class BaseMetOfficeDataHub:
         :return: Pydantic object of the details of the file
         """
 
-        response = self.call_url(url=f"https://{DOMAIN}/{ROOT}/orders/{order_id}/latest/{file_id}")
-
-        data = response.json()["fileDetails"]
+        data = self.call_url_json(
+            url=f"{self.base_url}/orders/{order_id}/latest/{file_id}",
+            endpoint="file_details",
+        )["fileDetails"]
 
         return FileDetails(**data)
 
-    def get_latest_order_file_id_data(self, order_id, file_id, filename: str = None) -> str:
+    def get_latest_order_file_id_data(
+        self,
+        order_id,
+        file_id,
+        filename: str = None,
+        run_datetime: Optional[datetime] = None,
+        save_manifest: bool = True,
+    ) -> str:
         """
         Gets the actual data for a specific file that can be obtained for the latest available data.
 
+        Files that are already in the download cache index are not downloaded again.
+
         :param order_id: The order ID that you wish to retrieve information about. The Order ID can
             be seen under a specific order on the Atmospheric Weather Data Tool Order Summary Page
             or found in the list of orders in the JSON response from your call to /1.0.0/orders
@@ -136,6 +384,10 @@ class BaseMetOfficeDataHub:
             about. The file IDs can be seen on the Atmospheric Weather Data Tool Order Summary Page
              or found in the JSON response from your call to /1.0.0/orders/{orderId}/latest
         :param filename: the name of the file that will be saved
+        :param run_datetime: the datetime of the run the file is from, this is saved in the
+            download cache index
+        :param save_manifest: save the download cache index after downloading the file. This can be
+            set to False when downloading many files, and then the index is saved at the end.
         :return: filename where the data is downloaded to
         """
 
@@ -146,31 +398,114 @@ class BaseMetOfficeDataHub:
             filename = f"{order_id}_{file_id}.grib"
 
         filename = f"{self.cache_dir}/{filename}"
-        fs = fsspec.open(Pathy.fluid(self.cache_dir).parent).fs
-        if not fs.exists(filename):
-            data = self.call_url(
-                url=f"https://{DOMAIN}/{ROOT}/orders/{order_id}/latest/{file_id}/data",
-                headers=headers,
-            )
-
+        download_cache = self.download_cache
+        fs = download_cache.fs
+        if not download_cache.contains(filename):
             if not fs.isdir(self.cache_dir):
                 try:
-                    fs.mkdir(self.cache_dir)
+                    # several files can be downloaded at the same time, so the folder
+                    # may have just been made by another thread
+                    fs.makedirs(self.cache_dir, exist_ok=True)
                 except Exception as e:
                     logger.error(e)
-                    raise Exception(
-                        f"Could not make directory {self.cache_dir}. "
-                        f"Will carry on anyway in case the folder "
-                        f"has been made already"
-                    )
+                    raise Exception(f"Could not make directory {self.cache_dir}.")
+
+            size, checksum = self.download_url_to_file(
+                url=f"{self.base_url}/orders/{order_id}/latest/{file_id}/data",
+                filename=filename,
+                fs=fs,
+                headers=headers,
+            )
 
-            with fs.open(filename, mode="wb") as localfile:
-                localfile.write(data.content)
+            download_cache.add(
+                filename=filename,
+                size=size,
+                checksum=checksum,
+                file_id=file_id,
+                run_datetime=run_datetime,
+            )
+            if save_manifest:
+                download_cache.save()
         else:
             logger.debug(f"File already exists so not downloading new one, {filename}")
 
         return filename
 
+    def download_url_to_file(
+        self, url: str, filename: str, fs: fsspec.AbstractFileSystem, headers: dict
+    ) -> Tuple[int, str]:
+        """
+        Stream the data from an url to a file
+
+        The data is written in chunks to "<filename>.part", and only moved to `filename` once
+        the whole file has been downloaded. If a "<filename>.part" file already exists,
+        the download is resumed from where it got to.
+
+        :param url: url to be called
+        :param filename: the file the data is saved to
+        :param fs: the filesystem of the file
+        :param headers: headers to use when calling the url
+        :return: the size in bytes, and the md5 checksum, of the downloaded file
+        """
+        temp_filename = f"{filename}.part"
+
+        offset = fs.size(temp_filename) if fs.exists(temp_filename) else 0
+        if offset > 0:
+            logger.debug(f"Resuming download of {filename} from byte {offset}")
+            try:
+                response = self.call_url(
+                    url=url, headers={**headers, "Range": f"bytes={offset}-"}, stream=True
+                )
+            except Exception as e:
+                logger.warning(f"Could not resume download of {filename}, starting again: {e}")
+                fs.rm(temp_filename)
+                offset = 0
+
+        if offset == 0:
+            response = self.call_url(url=url, headers=headers, stream=True)
+
+        checksum = hashlib.md5()
+        try:
+            if response.status_code == 206:
+                mode = "ab"
+                # the checksum includes the part that was already downloaded
+                with fs.open(temp_filename, mode="rb") as localfile:
+                    for chunk in iter(lambda: localfile.read(DOWNLOAD_CHUNK_SIZE), b""):
+                        checksum.update(chunk)
+            else:
+                # the server sent the whole file
+                offset = 0
+                mode = "wb"
+
+            expected_size = _get_expected_size(response=response, offset=offset)
+
+            with fs.open(temp_filename, mode=mode) as localfile:
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    checksum.update(chunk)
+                    localfile.write(chunk)
+        finally:
+            response.close()
+
+        size = fs.size(temp_filename)
+        if expected_size is not None and size != expected_size:
+            raise Exception(
+                f"Downloaded {size} bytes but expected {expected_size} bytes for {filename}, "
+                f"the download will be resumed next time"
+            )
+
+        fs.mv(temp_filename, filename)
+
+        return size, checksum.hexdigest()
+
+    def evict_download_cache(self, older_than: datetime):
+        """
+        Remove downloaded files, from runs before `older_than`, from the cache directory
+
+        :param older_than: files from runs before this datetime are removed
+        """
+        removed = self.download_cache.evict(older_than=older_than)
+        logger.info(f"Removed {len(removed)} files from {self.cache_dir}")
+
     def get_runs(self) -> RunList:
         """
         List all runs
@@ -178,22 +513,52 @@ class BaseMetOfficeDataHub:
         :return: pydantic object of run list
         """
 
-        response = self.call_url(url=f"https://{DOMAIN}/{ROOT}/runs")
-
-        data = response.json()
+        data = self.call_url_json(url=f"{self.base_url}/runs", endpoint="runs")
 
         return RunList(**data)
 
-    def get_runs_model_id(self, model_id) -> RunListForModel:
+    def get_runs_model_id(self, model_id, refresh: bool = False) -> RunListForModel:
         """
         List all runs for specific model
 
         :param model_id: the model id we are looking for
+        :param refresh: if True, the response cache is not used, e.g. when polling for new runs
         :return: Pydantic object of specific run list for a model
         """
 
-        response = self.call_url(url=f"https://{DOMAIN}/{ROOT}/runs/{model_id}")
-
-        data = response.json()
+        data = self.call_url_json(
+            url=f"{self.base_url}/runs/{model_id}", endpoint="runs", refresh=refresh
+        )
 
         return RunListForModel(**data)
+
+
+def _get_status(response) -> int:
+    """The status code of a requests or an aiohttp response"""
+    return getattr(response, "status_code", None) or response.status
+
+
+def _get_expected_size(response, offset: int) -> Optional[int]:
+    """
+    Get the size, in bytes, the downloaded file should be
+
+    :param response: the response from the api, from requests or aiohttp
+    :param offset: the number of bytes already downloaded, if resuming a download
+    :return: the expected size, or None if it is not known
+    """
+    if response.headers.get("Content-Encoding") is not None:
+        # the content length is of the encoded data, not of the data we write
+        return None
+
+    content_range = response.headers.get("Content-Range")
+    if _get_status(response) == 206 and content_range is not None:
+        # e.g. "bytes 100-999/1000"
+        total = content_range.split("/")[-1]
+        if total != "*":
+            return int(total)
+
+    content_length = response.headers.get("Content-Length")
+    if content_length is not None:
+        return offset + int(content_length)
+
+    return None
@@ -0,0 +1,411 @@
+""" Caches used when downloading and loading files """
+import glob
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+import fsspec
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILENAME = "manifest.json"
+
+STAGING_DIR = os.getenv("STAGING_DIR", "./temp")
+STAGING_MAX_SIZE_GB = float(os.getenv("STAGING_MAX_SIZE_GB", 10))
+STAGING_USE_FSSPEC_CACHE = os.getenv("STAGING_USE_FSSPEC_CACHE", "False").lower() == "true"
+INDEX_DIR = os.getenv("CFGRIB_INDEX_DIR", f"{STAGING_DIR}/index")
+# the subdirectory of the staging directory used by fsspec's `filecache`
+FSSPEC_CACHE_SUBDIR = "filecache"
+
+RESPONSE_CACHE_DIR = os.getenv("RESPONSE_CACHE_DIR", None)
+# how long, in seconds, a response from each endpoint is used for before it is revalidated
+RESPONSE_CACHE_TTLS = {
+    "orders": float(os.getenv("ORDERS_TTL", 3600)),
+    "latest_order": float(os.getenv("LATEST_ORDER_TTL", 60)),
+    "file_details": float(os.getenv("FILE_DETAILS_TTL", 60)),
+    "runs": float(os.getenv("RUNS_TTL", 60)),
+}
+
+
+class DownloadCache:
+    """Index of the files that have been downloaded to the cache directory
+
+    The index is saved as a manifest file in the cache directory. It is loaded once, and checked
+    against one listing of the cache directory, or if there is no manifest, it is made from the
+    listing. After that, checking if a file has already been downloaded does not need any calls to
+    the filesystem, which for s3 would be one request per file.
+
+    Each entry holds the `fileId`, `runDateTime`, size and md5 checksum of a downloaded file.
+    """
+
+    def __init__(self, cache_dir: str, fs: fsspec.AbstractFileSystem):
+        """
+        Initialise the cache index
+
+        :param cache_dir: The directory where files are downloaded to
+        :param fs: the filesystem of the cache directory
+        """
+        self.cache_dir = cache_dir
+        self.fs = fs
+        self.entries: Dict[str, dict] = {}
+        self.loaded = False
+        self._lock = threading.Lock()
+
+    @property
+    def manifest_filename(self) -> str:
+        """The filename of the manifest"""
+        return f"{self.cache_dir}/{MANIFEST_FILENAME}"
+
+    def load(self):
+        """
+        Load the manifest, or make it from a listing of the cache directory
+
+        The manifest is checked against one listing of the cache directory, and files that are
+        missing, or have a different size, e.g. because they were removed or partly overwritten
+        by another process, are dropped from the index so they are downloaded again.
+        """
+        with self._lock:
+            files = self._list_files()
+            if self.fs.exists(self.manifest_filename):
+                logger.debug(f"Loading download cache manifest {self.manifest_filename}")
+                with self.fs.open(self.manifest_filename, mode="r") as f:
+                    self.entries = json.load(f)
+
+                for name, entry in list(self.entries.items()):
+                    if files.get(name) != entry["size"]:
+                        logger.debug(
+                            f"Removing {name} from the download cache index, "
+                            f"the file is missing or has a different size"
+                        )
+                        self.entries.pop(name)
+            else:
+                logger.debug(f"Making download cache manifest from files in {self.cache_dir}")
+                self.entries = {
+                    name: {"fileId": None, "runDateTime": None, "size": size, "checksum": None}
+                    for name, size in files.items()
+                }
+
+            self.loaded = True
+
+    def _list_files(self) -> Dict[str, int]:
+        """The sizes of the downloaded files in the cache directory, from one listing"""
+        if not self.fs.isdir(self.cache_dir):
+            return {}
+
+        files = {}
+        for detail in self.fs.ls(self.cache_dir, detail=True):
+            name = detail["name"].split("/")[-1]
+            if detail["type"] != "file" or name == MANIFEST_FILENAME or name.endswith(".part"):
+                continue
+            files[name] = detail["size"]
+        return files
+
+    def save(self):
+        """Save the manifest"""
+        with self._lock:
+            logger.debug(f"Saving download cache manifest {self.manifest_filename}")
+            temp_filename = f"{self.manifest_filename}.part"
+            with self.fs.open(temp_filename, mode="w") as f:
+                json.dump(self.entries, f, indent=2)
+            self.fs.mv(temp_filename, self.manifest_filename)
+
+    def contains(self, filename: str) -> bool:
+        """Check if a file has been downloaded already"""
+        if not self.loaded:
+            self.load()
+        return filename.split("/")[-1] in self.entries
+
+    def add(
+        self,
+        filename: str,
+        size: int,
+        checksum: Optional[str] = None,
+        file_id: Optional[str] = None,
+        run_datetime: Optional[datetime] = None,
+    ):
+        """
+        Add a downloaded file to the index
+
+        :param filename: the downloaded file
+        :param size: the size in bytes of the file
+        :param checksum: the md5 checksum of the file
+        :param file_id: the file id of the file
+        :param run_datetime: the datetime of the run the file is from
+        """
+        if not self.loaded:
+            self.load()
+
+        with self._lock:
+            self.entries[filename.split("/")[-1]] = {
+                "fileId": file_id,
+                "runDateTime": None if run_datetime is None else run_datetime.isoformat(),
+                "size": size,
+                "checksum": checksum,
+            }
+
+    def evict(self, older_than: datetime) -> List[str]:
+        """
+        Remove files, from runs before `older_than`, from the cache directory and the index
+
+        Files where the run datetime is not known are kept.
+
+        :param older_than: files from runs before this datetime are removed
+        :return: the filenames that have been removed
+        """
+        if not self.loaded:
+            self.load()
+
+        with self._lock:
+            to_remove = [
+                name
+                for name, entry in self.entries.items()
+                if entry["runDateTime"] is not None
+                and datetime.fromisoformat(entry["runDateTime"]) < older_than
+            ]
+
+            filenames = [f"{self.cache_dir}/{name}" for name in to_remove]
+            if len(filenames) > 0:
+                logger.debug(f"Removing {len(filenames)} files from the download cache")
+                self.fs.rm(filenames)
+            for name in to_remove:
+                self.entries.pop(name)
+
+        if len(to_remove) > 0:
+            self.save()
+
+        return filenames
+
+
+class StagingCache:
+    """Local copies of remote files, so they can be decoded
+
+    cfgrib can only open local files. Files that are already local are used directly. Remote files
+    (e.g. on s3) are copied to `staging_dir` once, and then reused until they are evicted.
+    When the total size of `staging_dir` is more than `max_size_bytes`, the least recently used
+    files are removed. Alternatively, the files can be opened through fsspec's `filecache`, which
+    keeps its own copies, and its own metadata, in the "filecache" subdirectory of `staging_dir`.
+    These are managed by fsspec, so they are not evicted, and `max_size_bytes` does not apply.
+
+    When loading lazily, the staged files need to stay until the data is saved,
+    so `max_size_bytes` should be larger than one run.
+
+    The cfgrib index files are kept in `index_dir`, rather than next to the grib files, and are
+    reused when a file is loaded again. The index of a staged file is removed with the file.
+    """
+
+    def __init__(
+        self,
+        staging_dir: str = STAGING_DIR,
+        max_size_bytes: Optional[int] = int(STAGING_MAX_SIZE_GB * 1024**3),
+        use_fsspec_cache: bool = STAGING_USE_FSSPEC_CACHE,
+        index_dir: Optional[str] = INDEX_DIR,
+    ):
+        """
+        Initialise the staging cache
+
+        :param staging_dir: local directory where remote files are copied to
+        :param max_size_bytes: maximum total size of the staged files. If None, there is no limit
+        :param use_fsspec_cache: if True, use fsspec's `filecache` instead of copying the files
+        :param index_dir: local directory for the cfgrib index files. If None, no index files are
+            written, and each file is scanned every time it is loaded
+        """
+        self.staging_dir = staging_dir
+        self.max_size_bytes = max_size_bytes
+        self.use_fsspec_cache = use_fsspec_cache
+        self.index_dir = index_dir
+
+    def get_local_filename(self, file: str) -> str:
+        """
+        Get a local filename for a file, staging it if needed
+
+        :param file: the file, this can be local or remote
+        :return: a local filename with the same contents
+        """
+        fs, path = fsspec.core.url_to_fs(file)
+        if "file" in fs.protocol:
+            logger.debug(f"Using local file {path}")
+            return path
+
+        os.makedirs(self.staging_dir, exist_ok=True)
+
+        if self.use_fsspec_cache:
+            cache_storage = f"{self.staging_dir}/{FSSPEC_CACHE_SUBDIR}"
+            logger.debug(f"Opening {file} with fsspec filecache in {cache_storage}")
+            local_filename = fsspec.open_local(
+                f"filecache::{file}", filecache={"cache_storage": cache_storage}
+            )
+        else:
+            local_filename = f"{self.staging_dir}/{file.split('/')[-1]}"
+            if os.path.exists(local_filename):
+                logger.debug(f"Already in local file, {local_filename}")
+                # mark as recently used
+                os.utime(local_filename)
+            else:
+                logger.debug(f"Copying {file} to {local_filename}")
+                temp_filename = f"{local_filename}.part"
+                fs.get(path, temp_filename)
+                os.replace(temp_filename, local_filename)
+
+        self.evict(keep=local_filename)
+
+        return local_filename
+
+    def get_indexpath(self, local_filename: str) -> str:
+        """
+        Get the cfgrib `indexpath` for a local file
+
+        The name includes a hash of the full path, so files with the same name in different
+        directories do not share an index. cfgrib fills in `{short_hash}` from the index keys.
+
+        :param local_filename: the local grib file
+        :return: the `indexpath` template, or "" if index files are not used
+        """
+        if self.index_dir is None:
+            return ""
+
+        os.makedirs(self.index_dir, exist_ok=True)
+        path_hash = hashlib.md5(os.path.abspath(local_filename).encode()).hexdigest()[:8]
+        filename = local_filename.split("/")[-1]
+        return f"{self.index_dir}/{filename}.{path_hash}.{{short_hash}}.idx"
+
+    def evict(self, keep: Optional[str] = None) -> List[str]:
+        """
+        Remove the least recently used files, until the staged files are under the size limit
+
+        Only the files directly in `staging_dir` are staged files, so the subdirectories, e.g. the
+        fsspec `filecache` and the cfgrib index files, are not included.
+
+        :param keep: a file that should not be removed, e.g. the one that has just been staged
+        :return: the filenames that have been removed
+        """
+        if self.max_size_bytes is None or not os.path.isdir(self.staging_dir):
+            return []
+
+        files = []
+        for entry in os.scandir(self.staging_dir):
+            if entry.is_file():
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        total_size = sum(size for _, size, _ in files)
+
+        removed = []
+        for _, size, filename in sorted(files):
+            if total_size <= self.max_size_bytes:
+                break
+            if keep is not None and os.path.abspath(filename) == os.path.abspath(keep):
+                continue
+            logger.debug(f"Removing {filename} from the staging cache")
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                # already removed, e.g. by another process
+                pass
+            total_size -= size
+            removed.append(filename)
+
+            if self.index_dir is not None:
+                index_prefix = self.get_indexpath(filename).split("{short_hash}")[0]
+                for index_filename in glob.glob(f"{glob.escape(index_prefix)}*.idx"):
+                    os.remove(index_filename)
+
+        return removed
+
+
+class ResponseCache:
+    """Cache of json responses from the metadata endpoints of the api
+
+    Responses are kept in memory, and optionally also saved in `cache_dir` (local or "s3://..."),
+    so they can be shared between processes and services. A cached response is used until it is
+    older than the TTL of its endpoint. After that, if the server gave an `ETag` or
+    `Last-Modified` header, the request is made conditional, and a 304 response means the cached
+    response can be used again.
+    """
+
+    def __init__(
+        self, cache_dir: Optional[str] = RESPONSE_CACHE_DIR, ttls: Optional[Dict[str, float]] = None
+    ):
+        """
+        Initialise the response cache
+
+        :param cache_dir: directory where responses are saved. If None, they are only kept in memory
+        :param ttls: the TTL, in seconds, of each endpoint, defaults to RESPONSE_CACHE_TTLS.
+            Endpoints that are not included are not cached.
+        """
+        self.cache_dir = cache_dir
+        self.ttls = RESPONSE_CACHE_TTLS if ttls is None else ttls
+        self.entries: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+
+    def _get_filename(self, url: str) -> str:
+        """The filename where the response of a url is saved"""
+        return f"{self.cache_dir}/{hashlib.sha256(url.encode()).hexdigest()[:16]}.json"
+
+    def get(self, url: str) -> Optional[dict]:
+        """
+        Get the cached entry for a url
+
+        :param url: the url that was called
+        :return: dict with the json `data`, `etag`, `last_modified` and the `time` it was saved,
+            or None if the url is not in the cache
+        """
+        with self._lock:
+            if url in self.entries:
+                return self.entries[url]
+
+        if self.cache_dir is not None:
+            filename = self._get_filename(url)
+            try:
+                with fsspec.open(filename, mode="r") as f:
+                    entry = json.load(f)
+            except FileNotFoundError:
+                return None
+            except Exception as e:
+                logger.warning(f"Could not load cached response {filename}: {e}")
+                return None
+
+            with self._lock:
+                self.entries[url] = entry
+            return entry
+
+        return None
+
+    def is_fresh(self, entry: dict, endpoint: str) -> bool:
+        """Check if a cached entry is younger than the TTL of its endpoint"""
+        return time.time() - entry["time"] < self.ttls.get(endpoint, 0)
+
+    def set(
+        self,
+        url: str,
+        data: Any,
+        etag: Optional[str] = None,
+        last_modified: Optional[str] = None,
+    ) -> dict:
+        """
+        Save a response in the cache
+
+        :param url: the url that was called
+        :param data: the json data of the response
+        :param etag: the `ETag` header of the response
+        :param last_modified: the `Last-Modified` header of the response
+        :return: the cached entry
+        """
+        entry = {"data": data, "etag": etag, "last_modified": last_modified, "time": time.time()}
+        with self._lock:
+            self.entries[url] = entry
+
+        if self.cache_dir is not None:
+            filename = self._get_filename(url)
+            try:
+                fs = fsspec.open(filename).fs
+                fs.makedirs(self.cache_dir, exist_ok=True)
+                with fs.open(filename, mode="w") as f:
+                    json.dump(entry, f)
+            except Exception as e:
+                logger.warning(f"Could not save cached response {filename}: {e}")
+
+        return entry
@@ -0,0 +1,24 @@
+""" Compression of the saved data
+
+`ocf_blosc2.Blosc2` compresses every chunk with blosc2's default `typesize` of 8 bytes, which
+fails for float32 chunks with an odd number of values, and shuffles float32 data as if it was
+float64. `Blosc2` here uses the item size of the data instead. It has the same codec id and
+config, so the data is read with `ocf_blosc2` as before. Zarr makes the codec again from its
+config, so this class is registered in place of `ocf_blosc2.Blosc2` when this module is imported.
+"""
+import blosc2
+import ocf_blosc2
+from numcodecs import register_codec
+from numcodecs.compat import ensure_contiguous_ndarray
+
+
+class Blosc2(ocf_blosc2.Blosc2):
+    """The ocf_blosc2 codec, compressing with the item size of the data"""
+
+    def encode(self, buf):
+        """Compress a chunk, using the item size of its dtype"""
+        buf = ensure_contiguous_ndarray(buf, self.max_buffer_size)
+        return blosc2.compress(buf, typesize=buf.itemsize, codec=self._codec, clevel=self.clevel)
+
+
+register_codec(Blosc2)
@@ -1,3 +1,4 @@
 """ Constant variables used by this library """
 DOMAIN = "rgw.5878-e94b1c46.eu-gb.apiconnect.appdomain.cloud"
 ROOT = "metoffice/production/1.0.0"
+BASE_URL = f"https://{DOMAIN}/{ROOT}"
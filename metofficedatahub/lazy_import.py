@@ -0,0 +1,35 @@
+""" Import heavy dependencies only when they are first used
+
+Importing xarray, cfgrib, ocf_blosc2, scipy and pyproj takes several seconds, which short jobs,
+like `--help`, health checks and polling for metadata, never need. For example
+```python
+xr = lazy_import("xarray")
+```
+makes `xr` a module that is only imported when one of its attributes is first used.
+"""
+import importlib.util
+import sys
+from types import ModuleType
+
+
+def lazy_import(name: str) -> ModuleType:
+    """
+    Get a module that is imported when one of its attributes is first used
+
+    :param name: the name of the module, e.g. "xarray" or "scipy.spatial"
+    :return: the module, which is already imported if it has been imported before
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+
+    # the parent packages are imported now, which is quick for the modules used here
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f"No module named '{name}'", name=name)
+
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
@@ -0,0 +1,114 @@
+""" Lightweight versions of the models, for large order details responses
+
+An order can list thousands of files, and validating each one into a pydantic `File` is slow,
+when often only the file ids and run times are used. `parse_order_details` makes a
+`LightOrderDetails`, with slotted `LightFile` objects instead. These have the same attributes as
+`File`, so they can be used in its place, and `to_model` makes the pydantic models if needed.
+
+Only the `fields` that are asked for are parsed, the others are None. The run datetimes are
+shared by many files, so each one is only parsed once.
+"""
+from datetime import datetime
+from functools import lru_cache
+from typing import Iterable, List, Optional
+
+from pydantic import parse_obj_as
+
+from metofficedatahub.models import File, OrderDetails, OrderInfo
+
+# the fields of a file in the order details response
+FILE_FIELDS = ("fileId", "runDateTime", "run", "timesteps")
+
+
+class LightFile:
+    """Slotted version of the File model, with the same attributes"""
+
+    __slots__ = ("fileId", "runDateTime", "run", "timesteps", "local_filename")
+
+    def __init__(
+        self,
+        fileId: str,
+        runDateTime: Optional[datetime] = None,
+        run: Optional[int] = None,
+        timesteps: Optional[List[int]] = None,
+        local_filename: Optional[str] = None,
+    ):
+        """Initialise the file, the fields that were not parsed are None"""
+        self.fileId = fileId
+        self.runDateTime = runDateTime
+        self.run = run
+        self.timesteps = timesteps
+        self.local_filename = local_filename
+
+    def __repr__(self) -> str:
+        """Show the file id and the run"""
+        return f"LightFile(fileId={self.fileId!r}, runDateTime={self.runDateTime!r})"
+
+    def dict(self) -> dict:
+        """The fields as a dictionary, like `File.dict`"""
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def copy(self, update: Optional[dict] = None) -> "LightFile":
+        """Copy the file, like `File.copy`, with the fields in `update` changed"""
+        return LightFile(**{**self.dict(), **(update or {})})
+
+    def to_model(self) -> File:
+        """Make the pydantic File model, this needs the runDateTime and run to be parsed"""
+        return File(**self.dict())
+
+
+class LightOrderDetails:
+    """Slotted version of the OrderDetails model, with a list of LightFile"""
+
+    __slots__ = ("order", "files")
+
+    def __init__(self, order: OrderInfo, files: List[LightFile]):
+        """Initialise the order details"""
+        self.order = order
+        self.files = files
+
+    def to_model(self) -> OrderDetails:
+        """Make the pydantic OrderDetails model"""
+        return OrderDetails(order=self.order, files=[file.to_model() for file in self.files])
+
+
+@lru_cache(maxsize=1024)
+def _parse_datetime(value: str) -> datetime:
+    """Parse a datetime from the api, e.g. "2022-01-01T00:00:00Z", the same way as pydantic"""
+    try:
+        return datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return parse_obj_as(datetime, value)
+
+
+def parse_order_details(data: dict, fields: Optional[Iterable[str]] = None) -> LightOrderDetails:
+    """
+    Parse the order details response into a LightOrderDetails
+
+    :param data: the "orderDetails" of the json response
+    :param fields: the fields of each file to parse, from FILE_FIELDS. The fileId is always
+        parsed. If None, all the fields are parsed.
+    :return: the order details
+    """
+    fields = set(FILE_FIELDS if fields is None else fields) | {"fileId"}
+    unknown = fields - set(FILE_FIELDS)
+    if len(unknown) > 0:
+        raise ValueError(f"Unknown file fields {sorted(unknown)}, must be from {FILE_FIELDS}")
+
+    parse_run_datetime = "runDateTime" in fields
+    parse_run = "run" in fields
+    parse_timesteps = "timesteps" in fields
+
+    files = []
+    for file in data["files"]:
+        timesteps = file.get("timesteps") if parse_timesteps else None
+        files.append(
+            LightFile(
+                fileId=file["fileId"],
+                runDateTime=_parse_datetime(file["runDateTime"]) if parse_run_datetime else None,
+                run=int(file["run"]) if parse_run else None,
+                timesteps=None if timesteps is None else [int(step) for step in timesteps],
+            )
+        )
+
+    return LightOrderDetails(order=OrderInfo(**data["order"]), files=files)
@@ -0,0 +1,241 @@
+""" Timing and resource metrics for each stage of the pipeline
+
+Each stage (e.g. download, decode, merge, regrid, post_process and save) is wrapped in
+`PipelineMetrics.stage`, which records
+- wall_seconds: the wall time of the stage
+- cpu_seconds: the cpu time of the stage, including any child processes that have finished
+- peak_rss_bytes: the peak resident memory of the process and its child processes, e.g. the
+  decode workers, during the stage. This is sampled every `METRICS_RSS_INTERVAL` seconds in a
+  background thread, so short peaks between samples are missed.
+- bytes_in, bytes_out and files: added by the stage itself
+- throttled_seconds and throttled_calls: the time spent waiting for the rate limiter, and the
+  number of calls that had to wait, added by the stages that call the api
+
+The metrics can be saved as a json run report, or as a Prometheus textfile for the node exporter.
+When the metrics are disabled, `stage` does nothing, and no measurements are made.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional
+
+import fsspec
+
+from metofficedatahub.lazy_import import lazy_import
+
+psutil = lazy_import("psutil")
+
+logger = logging.getLogger(__name__)
+
+PROMETHEUS_PREFIX = "metofficedatahub_stage"
+
+# how often, in seconds, the resident memory is sampled during a stage
+METRICS_RSS_INTERVAL = float(os.getenv("METRICS_RSS_INTERVAL", 0.1))
+
+PROMETHEUS_HELP = {
+    "wall_seconds": "Wall time of the pipeline stage in seconds",
+    "cpu_seconds": "CPU time of the pipeline stage in seconds",
+    "peak_rss_bytes": "Peak resident memory of the process and its children during the stage, "
+    "in bytes",
+    "bytes_in": "Bytes read by the pipeline stage",
+    "bytes_out": "Bytes written by the pipeline stage",
+    "files": "Number of files handled by the pipeline stage",
+    "throttled_seconds": "Time spent waiting for the api rate limit in seconds",
+    "throttled_calls": "Number of api calls that waited for the rate limit",
+}
+
+
+class StageMetrics:
+    """Metrics of one stage, the stage adds the bytes and files it handles"""
+
+    def __init__(self):
+        """Initialise the metrics of one stage"""
+        self.wall_seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.peak_rss_bytes = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.files = 0
+        self.throttled_seconds = 0.0
+        self.throttled_calls = 0
+
+    def add(
+        self,
+        bytes_in: int = 0,
+        bytes_out: int = 0,
+        files: int = 0,
+        throttled_seconds: float = 0,
+        throttled_calls: int = 0,
+    ):
+        """Add to the bytes in, bytes out, number of files and throttling of the stage"""
+        self.bytes_in += bytes_in
+        self.bytes_out += bytes_out
+        self.files += files
+        self.throttled_seconds += throttled_seconds
+        self.throttled_calls += throttled_calls
+
+    def to_dict(self) -> dict:
+        """The metrics as a dictionary"""
+        return {name: getattr(self, name) for name in PROMETHEUS_HELP}
+
+
+class _NoStageMetrics(StageMetrics):
+    """Used when the metrics are disabled, this ignores everything that is added"""
+
+    def add(self, *args, **kwargs):
+        """Do nothing"""
+        pass
+
+
+_no_stage_metrics = _NoStageMetrics()
+
+
+class PipelineMetrics:
+    """Metrics of each stage of one run of the pipeline"""
+
+    def __init__(self, enabled: bool = True, rss_interval: float = METRICS_RSS_INTERVAL):
+        """
+        Initialise the metrics
+
+        :param enabled: if False, nothing is measured or saved
+        :param rss_interval: how often, in seconds, the resident memory is sampled during a stage
+        """
+        self.enabled = enabled
+        self.rss_interval = rss_interval
+        self.stages: Dict[str, StageMetrics] = {}
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[StageMetrics]:
+        """
+        Measure a stage of the pipeline
+
+        If a stage is run more than once, the metrics are added together,
+        apart from the peak memory, which is the largest.
+
+        :param name: the name of the stage
+        :return: the metrics of the stage, so the stage can add the bytes and files it handles
+        """
+        if not self.enabled:
+            yield _no_stage_metrics
+            return
+
+        metrics = self.stages.setdefault(name, StageMetrics())
+        rss_sampler = _RssSampler(interval=self.rss_interval)
+        rss_sampler.start()
+        start_wall = time.perf_counter()
+        start_cpu = _get_cpu_seconds()
+        try:
+            yield metrics
+        finally:
+            metrics.wall_seconds += time.perf_counter() - start_wall
+            metrics.cpu_seconds += _get_cpu_seconds() - start_cpu
+            metrics.peak_rss_bytes = max(metrics.peak_rss_bytes, rss_sampler.stop())
+            logger.debug(f"Stage {name}: {metrics.to_dict()}")
+
+    def to_dict(self) -> dict:
+        """The metrics of all the stages as a dictionary"""
+        return {name: metrics.to_dict() for name, metrics in self.stages.items()}
+
+    def save_json(self, path: str):
+        """Save the metrics as a json run report, path can be local or remote"""
+        if not self.enabled:
+            return
+
+        logger.info(f"Saving metrics to {path}")
+        with fsspec.open(path, mode="w") as f:
+            json.dump({"stages": self.to_dict()}, f, indent=2)
+
+    def to_prometheus(self) -> str:
+        """The metrics in the Prometheus text format"""
+        lines = []
+        for metric, help_text in PROMETHEUS_HELP.items():
+            name = f"{PROMETHEUS_PREFIX}_{metric}"
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            for stage, metrics in self.stages.items():
+                lines.append(f'{name}{{stage="{stage}"}} {getattr(metrics, metric)}')
+        return "\n".join(lines) + "\n"
+
+    def save_prometheus(self, path: str):
+        """
+        Save the metrics as a Prometheus textfile, path can be local or remote
+
+        The file is written to a temporary file first, and then moved,
+        so the node exporter never reads a half written file.
+        """
+        if not self.enabled:
+            return
+
+        logger.info(f"Saving Prometheus metrics to {path}")
+        fs = fsspec.open(path).fs
+        temp_path = f"{path}.part"
+        with fs.open(temp_path, mode="w") as f:
+            f.write(self.to_prometheus())
+        fs.mv(temp_path, path)
+
+
+def _get_cpu_seconds() -> float:
+    """The cpu time of this process and of its finished child processes"""
+    cpu_times = psutil.Process(os.getpid()).cpu_times()
+    return cpu_times.user + cpu_times.system + cpu_times.children_user + cpu_times.children_system
+
+
+def _get_rss_bytes() -> int:
+    """The resident memory of this process and of its child processes"""
+    process = psutil.Process(os.getpid())
+    rss = process.memory_info().rss
+    for child in process.children(recursive=True):
+        try:
+            rss += child.memory_info().rss
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            # the child has finished since it was listed
+            pass
+    return rss
+
+
+class _RssSampler:
+    """Samples the resident memory in a background thread, to find the peak during a stage"""
+
+    def __init__(self, interval: float):
+        """
+        Initialise the sampler
+
+        :param interval: the time in seconds between samples
+        """
+        self.interval = interval
+        self.peak_rss_bytes = 0
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _sample(self):
+        """Take one sample"""
+        self.peak_rss_bytes = max(self.peak_rss_bytes, _get_rss_bytes())
+
+    def _run(self):
+        """Take samples until the sampler is stopped"""
+        while not self._stopped.wait(self.interval):
+            self._sample()
+
+    def start(self):
+        """Start sampling, this takes a first sample straight away"""
+        self._sample()
+        self._thread.start()
+
+    def stop(self) -> int:
+        """
+        Stop sampling, this takes a last sample
+
+        :return: the peak resident memory in bytes
+        """
+        self._stopped.set()
+        self._thread.join()
+        self._sample()
+        return self.peak_rss_bytes
+
+
+def get_metrics(metrics: Optional[PipelineMetrics]) -> PipelineMetrics:
+    """Get the metrics to use, which are disabled if None is given"""
+    return PipelineMetrics(enabled=False) if metrics is None else metrics
@@ -1,23 +1,33 @@
 """ Main Application on top of wrapper
 
 This gives an easy way to download all files from an order
+
+xarray, pandas, psutil, cfgrib and ocf_blosc2 are only imported when they are first used, so
+importing this module to download files, or to poll for new runs, is quick.
 """
+from __future__ import annotations
+
 import logging
 import math
 import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import ExitStack
 from datetime import datetime, timedelta, timezone
-from typing import List
+from typing import List, Optional, Tuple
 
-import cfgrib
 import fsspec
-import pandas as pd
-import psutil
-import xarray as xr
-from ocf_blosc2 import Blosc2
-from pathy import Pathy
+import numpy as np
 
 from metofficedatahub.base import BaseMetOfficeDataHub
-from metofficedatahub.utils import add_x_y, post_process_dataset
+from metofficedatahub.cache import StagingCache
+from metofficedatahub.lazy_import import lazy_import
+from metofficedatahub.metrics import PipelineMetrics, get_metrics
+from metofficedatahub.utils import DTYPE, add_x_y, parse_bbox, post_process_dataset
+
+pd = lazy_import("pandas")
+psutil = lazy_import("psutil")
+xr = lazy_import("xarray")
 
 logger = logging.getLogger(__name__)
 
@@ -40,39 +50,88 @@ variable_name_translation = {
     "rain-precipitation-rate": {"rprate": "prate"},
 }
 
+# cfgrib backend_kwargs for each variable, e.g. {"filter_by_keys": {"typeOfLevel": "surface"}},
+# so only the grib messages that are needed are decoded
+variable_backend_kwargs = {}
+
 HOUR_IN_PAST = 7
 
+# chunks used when loading the files lazily, each chunk holds the full grid for one step
+LAZY_CHUNKS = {"step": 1}
+
+# decoding a grib file takes roughly this many times the file size in memory
+MEMORY_PER_FILE_SIZE = 10
+
+# expired runs are only removed from the zarr archive once there are this many, as removing them
+# rewrites the whole archive
+ARCHIVE_PRUNE_BATCH = int(os.getenv("ARCHIVE_PRUNE_BATCH", 8))
+
 
 class MetOfficeDataHub(BaseMetOfficeDataHub):
     """Class built on top of BaseMetOfficeDataHub used for processing multiple files"""
 
-    folder_to_download = "./temp"
-
-    if ~os.path.exists(folder_to_download):
-        try:
-            os.mkdir(folder_to_download)
-        except Exception as e:
-            logger.debug(f"Could not make folder {folder_to_download} - {e}")
+    def __init__(
+        self,
+        *args,
+        staging_cache: Optional[StagingCache] = None,
+        metrics: Optional[PipelineMetrics] = None,
+        **kwargs,
+    ):
+        """
+        Initialise the class, see BaseMetOfficeDataHub for the other arguments
 
-    def download_all_files(self, order_ids: List[str]):
+        :param staging_cache: where remote files are copied to before they are decoded.
+            If None, the default StagingCache is used.
+        :param metrics: metrics of the download, decode, merge, regrid and post_process stages.
+            If None, no metrics are recorded.
+        """
+        super().__init__(*args, **kwargs)
+        self.staging_cache = StagingCache() if staging_cache is None else staging_cache
+        self.metrics = get_metrics(metrics)
+
+    def download_all_files(
+        self,
+        order_ids: List[str],
+        max_workers: int = int(os.getenv("MAX_WORKERS", 1)),
+        hours_in_past: Optional[float] = HOUR_IN_PAST,
+        refresh: bool = False,
+    ):
         """Download all latest files for specified orders.
 
         If no orders are specified, nothing is downloaded.
+
+        Files are downloaded concurrently using `max_workers` threads. If a file fails to
+        download, the error is stored in `self.download_errors` and the other files carry on.
+        An error is only raised if no files could be downloaded at all.
+
+        Files that are not downloaded, and why, are listed in `self.skipped_files`.
+
+        :param order_ids: the orders to download the latest files from
+        :param max_workers: the number of files downloaded at the same time
+        :param hours_in_past: files from runs older than this many hours are not downloaded,
+            as they would not be used in `load_all_files`. If None, all runs are downloaded.
+        :param refresh: if True, the cached order details are not used, e.g. when a new run
+            has just been found
         """
+        filter_time = None if hours_in_past is None else _get_filter_time(hours_in_past)
 
         # loop over orders
         self.files = []
+        self.download_errors = {}
+        self.skipped_files = []
+        files_to_download = []
         for order_id in order_ids:
             logger.debug(f"Loading files from order {order_id}")
 
-            self.order_details = self.get_lastest_order(order_id=order_id)
+            # only the file ids and run times are used, so the files are not validated
+            self.order_details = self.get_lastest_order(
+                order_id=order_id, lite=True, fields=("fileId", "runDateTime"), refresh=refresh
+            )
 
             logger.debug(f"There are {len(self.order_details.files)} files to load")
 
             # loop over all files
-            for i, file in enumerate(self.order_details.files):
-                logger.debug(f"Downloading file {i} out of {len(self.order_details.files)}")
-
+            for file in self.order_details.files:
                 file_id = file.fileId
 
                 variable = file.fileId
@@ -81,88 +140,196 @@ class MetOfficeDataHub(BaseMetOfficeDataHub):
 
                 # There seem to be two files that are the same,
                 # one with '+HH' and one with 'YYYYMMDDHH'
-                if datetime[0] != "+":
-                    # download file
-                    filename = self.get_latest_order_file_id_data(
-                        order_id=order_id, file_id=file_id
+                if datetime[0] == "+":
+                    logger.debug(f"Not adding {file_id} to list")
+                    self.skipped_files.append(
+                        dict(
+                            fileId=file_id,
+                            runDateTime=file.runDateTime,
+                            reason="duplicate of the 'YYYYMMDDHH' file",
+                        )
+                    )
+                elif filter_time is not None and _as_utc(file.runDateTime) < filter_time:
+                    logger.debug(f"Not adding {file_id} to list as the run is < {filter_time}")
+                    self.skipped_files.append(
+                        dict(
+                            fileId=file_id,
+                            runDateTime=file.runDateTime,
+                            reason=f"run is older than {hours_in_past} hours",
+                        )
                     )
-
-                    # put local file in file object
-                    file.local_filename = filename
-                    self.files.append(file)
                 else:
-                    logger.debug(f"Not adding {file_id} to list")
-
-        logger.info(f"All files downloaded ({len(self.files)}")
+                    files_to_download.append((order_id, file))
+
+        if len(self.skipped_files) > 0:
+            logger.info(f"Not downloading {len(self.skipped_files)} files")
+
+        # load the index of files that have already been downloaded once
+        self.download_cache.load()
+        already_downloaded = set(self.download_cache.entries)
+
+        logger.debug(f"Downloading {len(files_to_download)} files with {max_workers} workers")
+        throttled = self.rate_limiter.to_dict()
+        with self.metrics.stage("download") as stage_metrics, ThreadPoolExecutor(
+            max_workers=max_workers
+        ) as executor:
+            futures = {
+                executor.submit(
+                    self.get_latest_order_file_id_data,
+                    order_id=order_id,
+                    file_id=file.fileId,
+                    run_datetime=file.runDateTime,
+                    save_manifest=False,
+                ): index
+                for index, (order_id, file) in enumerate(files_to_download)
+            }
+
+            downloaded = []
+            for i, future in enumerate(as_completed(futures)):
+                index = futures[future]
+                file = files_to_download[index][1]
+                logger.debug(f"Downloaded file {i} out of {len(files_to_download)}")
+                try:
+                    # put local file in file object
+                    file.local_filename = future.result()
+                    downloaded.append(index)
+                except Exception as e:
+                    logger.warning(f"Could not download {file.fileId}: {e}")
+                    self.download_errors[file.fileId] = str(e)
+
+            if self.metrics.enabled:
+                # only the files that were fetched, not those already in the download cache. The
+                # sizes are in the download cache index, so no calls to the filesystem are needed
+                entries = self.download_cache.entries
+                fetched_sizes = []
+                for index in downloaded:
+                    name = files_to_download[index][1].local_filename.split("/")[-1]
+                    if name not in already_downloaded:
+                        fetched_sizes.append(entries[name]["size"])
+                stage_metrics.add(
+                    bytes_in=sum(fetched_sizes),
+                    files=len(fetched_sizes),
+                    throttled_seconds=self.rate_limiter.throttled_seconds
+                    - throttled["throttled_seconds"],
+                    throttled_calls=self.rate_limiter.throttled_calls
+                    - throttled["throttled_calls"],
+                )
 
-    def load_file(self, file) -> xr.Dataset:
-        """Load one grib file"""
+        # keep the files in the same order as the orders
+        self.files = [files_to_download[index][1] for index in sorted(downloaded)]
 
-        logger.debug(f"Loading {file}")
+        if len(files_to_download) > 0:
+            self.download_cache.save()
 
-        # make tempfilename
-        filename = file.split("/")[-1]
-        temp_filename = f"{self.folder_to_download}/{filename}"
+        if len(self.download_errors) > 0:
+            logger.warning(
+                f"{len(self.download_errors)} files failed to download: "
+                f"{list(self.download_errors.keys())}"
+            )
+            if len(self.files) == 0:
+                raise Exception(f"All files failed to download: {self.download_errors}")
 
-        # save from s3 to local temp
-        if ~os.path.exists(Pathy(temp_filename)):
-            logger.debug(f"Moving {file} to {temp_filename}")
-            fs = fsspec.open(Pathy.fluid(file).parent).fs
-            fs.get(file, temp_filename)
-        else:
-            logger.debug(f"Already in local file, {temp_filename}")
+        logger.info(f"All files downloaded ({len(self.files)}")
 
-        # load
-        datasets_from_grib: list[xr.Dataset] = cfgrib.open_datasets(temp_filename)
+    def load_file(
+        self, file, chunks: Optional[dict] = None, backend_kwargs: Optional[dict] = None
+    ) -> xr.Dataset:
+        """Load one grib file
 
-        # merge
-        merged_ds = xr.merge(datasets_from_grib)
+        :param file: the grib file, this can be local or remote
+        :param chunks: if given, the data is loaded lazily as dask arrays with these chunks
+        :param backend_kwargs: extra cfgrib backend_kwargs, e.g. `filter_by_keys`
+        """
+        return _load_file(
+            file=file,
+            staging_cache=self.staging_cache,
+            chunks=chunks,
+            backend_kwargs=backend_kwargs,
+        )
 
-        del datasets_from_grib
+    def load_all_files(
+        self,
+        max_workers: int = int(os.getenv("LOAD_WORKERS", 1)),
+        lazy: bool = os.getenv("LAZY", "False").lower() == "true",
+        dtype: str = DTYPE,
+        backend_kwargs: Optional[dict] = None,
+        bbox: Optional[Tuple[float, float, float, float]] = parse_bbox(os.getenv("BBOX")),
+        bbox_crs: str = os.getenv("BBOX_CRS", "osgb"),
+    ) -> xr.Dataset:
+        """Load all files and join them together
+
+        :param max_workers: the maximum number of processes used to decode and clean the files.
+            If 1, the files are loaded one after another in this process. The number of processes
+            is also limited by the number of cpus and the available memory.
+        :param lazy: if True, the grib files are opened as dask arrays, chunked by `step`, and
+            nothing is decoded until the data is saved. The regridding is then done chunk by chunk,
+            so the full dataset is never held in memory. The local grib files need to be kept
+            until the data is saved. `max_workers` is not used.
+        :param dtype: the float dtype of the data, float32 by default. This is used when
+            regridding, so the full float64 data is never made.
+        :param backend_kwargs: cfgrib backend_kwargs for each variable, e.g.
+            {"temperature": {"filter_by_keys": {"typeOfLevel": "heightAboveGround"}}}, so only the
+            grib messages that are needed are decoded. These are added to `variable_backend_kwargs`
+        :param bbox: a region of interest, as (west, south, east, north). If given, the data is
+            cropped to it before regridding, so only the region is regridded and saved.
+        :param bbox_crs: the crs of the `bbox`, "osgb" for meters, or "lat_lon" for degrees
+        """
 
-        return merged_ds
+        logger.info("Now loading all files and joining them together")
+        if lazy and max_workers > 1:
+            logger.debug("Loading files lazily, so not using a process pool")
+            max_workers = 1
 
-    def load_all_files(self) -> xr.Dataset:
-        """Load all files and join them together"""
+        # filter time
+        filter_time = _get_filter_time(HOUR_IN_PAST)
 
-        logger.info("Now loading all files and joining them together")
+        # cfgrib backend_kwargs for each file
+        backend_kwargs = {**variable_backend_kwargs, **(backend_kwargs or {})}
+        backend_kwargs_per_file = [
+            backend_kwargs.get(file.fileId.split("_")[1]) for file in self.files
+        ]
 
         # loop over all files and load them
         all_datasets_per_filename = {}
-        for i, file in enumerate(self.files):
-            logger.debug(f"Loading file {i} out of {len(self.files)}")
-
-            variable = file.fileId
-            variable = variable.split("_")[1]
-
-            dataset = self.load_file(file=file.local_filename)
-
-            # filter time
-            filter_time = datetime.now(timezone.utc) - timedelta(hours=HOUR_IN_PAST)
-
-            # rename variables
-            if variable in variable_name_translation:
-                rename = variable_name_translation[variable]
-                for key in rename.keys():
-                    if key in dataset.data_vars:
-                        logger.debug(f"Renaming {rename}")
-                        dataset = dataset.rename(variable_name_translation[variable])
-                    else:
-                        logger.debug(f"Key ({key}) not in data vars")
-
-            # remove un-needed variables
-            for var in VARS_TO_DELETE:
-                if var in dataset.variables:
-                    del dataset[var]
-
-            time = pd.to_datetime(dataset.time.values)
-            time = time.replace(tzinfo=timezone.utc)
-            logger.debug(f"Data is for {time}, {filter_time=}")
-            if time < filter_time:
-                logger.debug(
-                    f"Not including file as the data is < {filter_time}, {file.local_filename}"
+        number_of_workers = _get_number_of_workers(max_workers=max_workers, files=self.files)
+        with ExitStack() as stack:
+            stage_metrics = stack.enter_context(self.metrics.stage("decode"))
+            if number_of_workers > 1:
+                logger.debug(f"Loading files with {number_of_workers} processes")
+                executor = stack.enter_context(ProcessPoolExecutor(max_workers=number_of_workers))
+                datasets = executor.map(
+                    _load_and_clean_file,
+                    [file.local_filename for file in self.files],
+                    [file.fileId for file in self.files],
+                    [self.staging_cache] * len(self.files),
+                    [filter_time] * len(self.files),
+                    backend_kwargs_per_file,
                 )
             else:
+                datasets = (
+                    _clean_dataset(
+                        dataset=self.load_file(
+                            file=file.local_filename,
+                            chunks=LAZY_CHUNKS if lazy else None,
+                            backend_kwargs=file_backend_kwargs,
+                        ),
+                        file_id=file.fileId,
+                        filter_time=filter_time,
+                    )
+                    for file, file_backend_kwargs in zip(self.files, backend_kwargs_per_file)
+                )
+
+            for i, (file, dataset) in enumerate(zip(self.files, datasets)):
+                logger.debug(f"Loaded file {i} out of {len(self.files)}")
+
+                if dataset is None:
+                    logger.debug(
+                        f"Not including file as the data is < {filter_time}, {file.local_filename}"
+                    )
+                    continue
+
+                variable = file.fileId
+                variable = variable.split("_")[1]
                 if variable not in all_datasets_per_filename.keys():
                     all_datasets_per_filename[variable] = [dataset]
                 else:
@@ -170,41 +337,260 @@ class MetOfficeDataHub(BaseMetOfficeDataHub):
 
                 del dataset
 
-        # loop over different variables and join them together
+            if self.metrics.enabled:
+                stage_metrics.add(
+                    bytes_in=sum(_get_file_size(file.local_filename) for file in self.files),
+                    files=len(self.files),
+                )
+
         logger.info("Joining the dataset together")
-        all_dataset = []
-        keys = list(all_datasets_per_filename.keys())
-        for k in keys:
-            logger.debug(f"Merging dataset {k} out of {len(keys)}")
+        with self.metrics.stage("merge") as stage_metrics:
+            if lazy:
+                # the data are dask arrays, so merge them lazily
+                dataset = _merge_datasets(all_datasets_per_filename)
+            else:
+                dataset = _assemble_datasets(
+                    [d for datasets in all_datasets_per_filename.values() for d in datasets]
+                )
+            del all_datasets_per_filename
+            stage_metrics.add(bytes_out=dataset.nbytes)
+
+        logger.debug(f"Loaded all files, {dataset.data_vars}")
+        logger.debug(f"{dataset.time=}")
+        logger.debug(f"{dataset.step=}")
 
-            v = all_datasets_per_filename.pop(k)
+        with self.metrics.stage("regrid") as stage_metrics:
+            dataset = add_x_y(dataset, dtype=dtype, bbox=bbox, bbox_crs=bbox_crs)
+            stage_metrics.add(bytes_out=dataset.nbytes)
 
-            # print memoery
-            process = psutil.Process(os.getpid())
-            logger.debug(f"Memory is {process.memory_info().rss / 10 ** 6} MB")
+        with self.metrics.stage("post_process") as stage_metrics:
+            dataset = post_process_dataset(dataset, dtype=dtype)
+            stage_metrics.add(bytes_out=dataset.nbytes)
 
-            # add time as dimension
-            v = [vv.expand_dims("time") for vv in v]
+        return dataset
 
-            # merge dataset
-            dataset = xr.merge(v)
 
-            # join all variables together
-            all_dataset.append(dataset)
+def _get_filter_time(hours_in_past: float) -> datetime:
+    """Data from before this time is not used"""
+    return datetime.now(timezone.utc) - timedelta(hours=hours_in_past)
 
-            # save memory
-            del v
 
-        logger.debug(all_dataset)
-        dataset = xr.merge(all_dataset)
-        logger.debug(f"Loaded all files, {dataset.data_vars}")
-        logger.debug(f"{dataset.time=}")
-        logger.debug(f"{dataset.step=}")
+def _as_utc(time: datetime) -> datetime:
+    """Make sure a datetime is timezone aware, naive datetimes are assumed to be UTC"""
+    if time.tzinfo is None:
+        return time.replace(tzinfo=timezone.utc)
+    return time
 
-        dataset = add_x_y(dataset)
-        dataset = post_process_dataset(dataset)
 
-        return dataset
+def _load_file(
+    file: str,
+    staging_cache: StagingCache,
+    chunks: Optional[dict] = None,
+    backend_kwargs: Optional[dict] = None,
+) -> xr.Dataset:
+    """Load one grib file
+
+    :param file: the grib file, this can be local or remote
+    :param staging_cache: where remote files are copied to before decoding
+    :param chunks: if given, the data is loaded lazily as dask arrays with these chunks
+    :param backend_kwargs: extra cfgrib backend_kwargs, e.g. `filter_by_keys`
+    """
+    import cfgrib
+
+    logger.debug(f"Loading {file}")
+
+    # remote files are copied to a local file, local files are used directly
+    temp_filename = staging_cache.get_local_filename(file)
+
+    # load, the index file is kept in the index directory
+    backend_kwargs = {
+        "indexpath": staging_cache.get_indexpath(temp_filename),
+        **(backend_kwargs or {}),
+    }
+    datasets_from_grib: list[xr.Dataset] = cfgrib.open_datasets(
+        temp_filename, backend_kwargs=backend_kwargs, chunks=chunks
+    )
+
+    # merge
+    merged_ds = xr.merge(datasets_from_grib)
+
+    del datasets_from_grib
+
+    return merged_ds
+
+
+def _clean_dataset(
+    dataset: xr.Dataset, file_id: str, filter_time: datetime
+) -> Optional[xr.Dataset]:
+    """Rename the variables and remove un-needed ones from one loaded grib file
+
+    :param dataset: the loaded grib file
+    :param file_id: the file id, this is used to get the variable name
+    :param filter_time: data from before this time is not used
+    :return: the cleaned dataset, or None if the data is from before `filter_time`
+    """
+    variable = file_id.split("_")[1]
+
+    # rename variables
+    if variable in variable_name_translation:
+        rename = variable_name_translation[variable]
+        for key in rename.keys():
+            if key in dataset.data_vars:
+                logger.debug(f"Renaming {rename}")
+                dataset = dataset.rename(variable_name_translation[variable])
+            else:
+                logger.debug(f"Key ({key}) not in data vars")
+
+    # remove un-needed variables
+    for var in VARS_TO_DELETE:
+        if var in dataset.variables:
+            del dataset[var]
+
+    time = pd.to_datetime(dataset.time.values)
+    time = time.replace(tzinfo=timezone.utc)
+    logger.debug(f"Data is for {time}, {filter_time=}")
+    if time < filter_time:
+        return None
+
+    return dataset
+
+
+def _load_and_clean_file(
+    file: str,
+    file_id: str,
+    staging_cache: StagingCache,
+    filter_time: datetime,
+    backend_kwargs: Optional[dict] = None,
+) -> Optional[xr.Dataset]:
+    """Load and clean one grib file, this is run in a separate process
+
+    The data is loaded into memory, so only numpy arrays are sent back to the main process.
+    """
+    dataset = _load_file(file=file, staging_cache=staging_cache, backend_kwargs=backend_kwargs)
+    dataset = _clean_dataset(dataset=dataset, file_id=file_id, filter_time=filter_time)
+    if dataset is not None:
+        dataset = dataset.load()
+    return dataset
+
+
+def _get_file_size(file: str) -> int:
+    """The size of a file in bytes, this can be local or remote"""
+    fs = fsspec.open(file).fs
+    return fs.size(file)
+
+
+def _merge_datasets(all_datasets_per_filename: dict) -> xr.Dataset:
+    """Join the datasets together by merging them, one variable at a time
+
+    :param all_datasets_per_filename: lists of datasets, keyed by the variable
+    """
+    all_dataset = []
+    keys = list(all_datasets_per_filename.keys())
+    for k in keys:
+        logger.debug(f"Merging dataset {k} out of {len(keys)}")
+
+        v = all_datasets_per_filename.pop(k)
+
+        # print memoery
+        process = psutil.Process(os.getpid())
+        logger.debug(f"Memory is {process.memory_info().rss / 10 ** 6} MB")
+
+        # add time as dimension
+        v = [vv.expand_dims("time") for vv in v]
+
+        # merge dataset
+        dataset = xr.merge(v)
+
+        # join all variables together
+        all_dataset.append(dataset)
+
+        # save memory
+        del v
+
+    logger.debug(all_dataset)
+    return xr.merge(all_dataset)
+
+
+def _assemble_datasets(datasets: List[xr.Dataset]) -> xr.Dataset:
+    """Join the datasets together by writing them into one preallocated array per variable
+
+    This gives the same as adding `time` as a dimension and merging the datasets, but without
+    aligning and copying the data at each merge. The `(time, step)` layout is read from the
+    coordinates of the datasets, which does not decode any data. Then one array per variable is
+    made, and each dataset is decoded straight into its place. Any missing slices are nan.
+
+    :param datasets: the cleaned datasets, each one for a single `time`
+    :return: dataset with dimensions (time, step, y, x)
+    """
+    datasets = [d if "step" in d.dims else d.expand_dims("step") for d in datasets]
+
+    # get the layout from the coordinates
+    times = pd.DatetimeIndex(sorted({d.time.values for d in datasets}))
+    steps = pd.TimedeltaIndex(sorted({step for d in datasets for step in d.step.values}))
+
+    # make one array for each variable
+    data_vars = {}
+    for dataset in datasets:
+        for name, data in dataset.data_vars.items():
+            if name not in data_vars:
+                spatial_dims = tuple(dim for dim in data.dims if dim != "step")
+                spatial_shape = tuple(dataset.sizes[dim] for dim in spatial_dims)
+                values = np.full(
+                    (len(times), len(steps), *spatial_shape),
+                    np.nan,
+                    dtype=np.result_type(data.dtype, np.float32),
+                )
+                data_vars[name] = xr.Variable(
+                    ("time", "step", *spatial_dims), values, attrs=data.attrs
+                )
+
+    process = psutil.Process(os.getpid())
+    logger.debug(f"Memory is {process.memory_info().rss / 10 ** 6} MB")
+
+    # write each dataset into place
+    for i, dataset in enumerate(datasets):
+        logger.debug(f"Assembling dataset {i} out of {len(datasets)}")
+        time_index = times.get_loc(dataset.time.values)
+        step_index = steps.get_indexer(dataset.step.values)
+        for name, data in dataset.data_vars.items():
+            variable = data_vars[name]
+            data = data.transpose("step", *variable.dims[2:])
+            variable.values[time_index, step_index] = data.values
+
+    # keep the coordinates that do not depend on time or step, e.g latitude and longitude
+    first_dataset = datasets[0]
+    coords = {
+        "time": xr.Variable("time", times.values, attrs=first_dataset.time.attrs),
+        "step": xr.Variable("step", steps.values, attrs=first_dataset.step.attrs),
+    }
+    for name, coord in first_dataset.coords.items():
+        if name not in coords and not {"time", "step"} & set(coord.dims):
+            coords[name] = coord.variable
+
+    return xr.Dataset(data_vars=data_vars, coords=coords, attrs=first_dataset.attrs)
+
+
+def _get_number_of_workers(max_workers: int, files: list) -> int:
+    """Get the number of processes to use for loading files
+
+    This is limited by the number of cpus, the number of files, and the available memory.
+    Decoding a file takes about MEMORY_PER_FILE_SIZE times the file size in memory.
+    """
+    number_of_workers = min(max_workers, os.cpu_count() or 1, len(files))
+    if number_of_workers <= 1:
+        return 1
+
+    file_sizes = [
+        os.path.getsize(file.local_filename)
+        for file in files
+        if file.local_filename is not None and os.path.exists(file.local_filename)
+    ]
+    if len(file_sizes) > 0:
+        memory_per_worker = max(file_sizes) * MEMORY_PER_FILE_SIZE
+        available_memory = psutil.virtual_memory().available
+        number_of_workers = min(number_of_workers, int(available_memory // memory_per_worker))
+
+    return max(number_of_workers, 1)
 
 
 def _get_first_init_time_as_str(dataset: xr.Dataset) -> str:
@@ -234,8 +620,8 @@ def _chunk(dataset: xr.Dataset, *, ideal_chunk_size_mb: float) -> xr.Dataset:
     num_step = dataset.dims["step"]
     num_variables = dataset.dims["variable"]
 
-    # Number of floats in a megabyte (assuming 64 bit floats).
-    num_float_in_mb = 1024 * 1024 / 8
+    # Number of floats in a megabyte, using the size of the dtype of the data
+    num_float_in_mb = 1024 * 1024 / dataset["UKV"].dtype.itemsize
 
     # because of compressions we can make this number larger
     compression_factor = 5
@@ -257,7 +643,15 @@ def _log_and_save(dataset: xr.Dataset, path: str):
     save_to_s3(dataset, path)
 
 
-def save(dataset: xr.Dataset, save_dir: str, *, ideal_chunk_size_mb=1):
+def save(
+    dataset: xr.Dataset,
+    save_dir: str,
+    *,
+    ideal_chunk_size_mb=1,
+    archive_path: Optional[str] = None,
+    archive_retention_hours: Optional[float] = None,
+    metrics: Optional[PipelineMetrics] = None,
+):
     """
     Save dataset
 
@@ -268,22 +662,225 @@ def save(dataset: xr.Dataset, save_dir: str, *, ideal_chunk_size_mb=1):
             * latest.netcdf
             * latest.zarr
     :param ideal_chunk_size_mb: Ideal chunk size in Mb for the .zarr file.
+    :param archive_path: Optional path of a long-lived .zarr archive, that each new `init_time`
+        is appended to. See `save_to_zarr_archive`.
+    :param archive_retention_hours: Runs older than this, compared to the newest run,
+        are removed from the archive. If None, all runs are kept.
+    :param metrics: metrics of the save stage. If None, no metrics are recorded.
     """
     logger.info(f'Saving data to "{save_dir}"')
+    metrics = get_metrics(metrics)
 
     filename = _get_first_init_time_as_str(dataset)
-    _log_and_save(dataset, f"{save_dir}/{filename}.netcdf")
+    chunked = _chunk(dataset, ideal_chunk_size_mb=ideal_chunk_size_mb)
+    zarr_path = f"{save_dir}/latest.zarr"
+
+    with metrics.stage("save") as stage_metrics:
+        lazy = dataset["UKV"].chunks is not None
+        if lazy:
+            # The data is loaded lazily, so writing each target would decode (and regrid) all
+            # the grib files again. Instead latest.zarr is written first, and the other targets
+            # are written from it.
+            _log_and_save(chunked, zarr_path)
+            dataset = _open_saved_zarr(zarr_path)
+
+        # The different targets are written at the same time. The netcdf file is only written
+        # once, and then copied to "latest.netcdf", which is done server-side for s3.
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            futures = [
+                executor.submit(
+                    _save_and_copy,
+                    dataset,
+                    f"{save_dir}/{filename}.netcdf",
+                    f"{save_dir}/latest.netcdf",
+                )
+            ]
+            if not lazy:
+                futures.append(executor.submit(_log_and_save, chunked, zarr_path))
+            if archive_path is not None:
+                futures.append(
+                    executor.submit(
+                        save_to_zarr_archive,
+                        dataset,
+                        archive_path,
+                        ideal_chunk_size_mb=ideal_chunk_size_mb,
+                        retention_hours=archive_retention_hours,
+                    )
+                )
 
-    # Also save it as "lastest.<ext>", both in zarr and netcdf format.
-    # TODO Copying the file we just wrote in AWS directly would be faster.
-    _log_and_save(dataset, f"{save_dir}/latest.netcdf")
+            # raise any errors
+            for future in futures:
+                future.result()
 
-    chunked = _chunk(dataset, ideal_chunk_size_mb=ideal_chunk_size_mb)
-    _log_and_save(chunked, f"{save_dir}/latest.zarr")
+        if metrics.enabled:
+            # the size of the netcdf file and of latest.zarr, the copies are not included
+            fs = fsspec.open(save_dir).fs
+            stage_metrics.add(
+                bytes_out=fs.size(f"{save_dir}/{filename}.netcdf") + fs.du(zarr_path),
+                files=3 if archive_path is None else 4,
+            )
+
+
+def _open_saved_zarr(path: str) -> xr.Dataset:
+    """Open a zarr file written by `save_to_s3`, so it can be written to other targets"""
+    # importing this registers the Blosc2 codec, which is needed to read the zarr file
+    import metofficedatahub.compression  # noqa: F401
+
+    dataset = xr.open_zarr(path)
+    # the encoding of the zarr file, e.g. its compressor and chunks, is not used for the others
+    for variable in dataset.variables.values():
+        variable.encoding = {}
+    return dataset
+
+
+def _save_and_copy(dataset: xr.Dataset, path: str, copy_path: str):
+    """Save the dataset once, and then copy the file"""
+    _log_and_save(dataset, path)
+
+    logger.debug(f'Copying "{path}" to "{copy_path}"')
+    fs = fsspec.open(path).fs
+    fs.copy(path, copy_path)
+
+
+def save_to_zarr_archive(
+    dataset: xr.Dataset,
+    path: str,
+    *,
+    ideal_chunk_size_mb=1,
+    retention_hours: Optional[float] = None,
+    prune_batch: int = ARCHIVE_PRUNE_BATCH,
+):
+    """
+    Append the dataset to a long-lived zarr archive
+
+    If the archive does not exist, it is made. Otherwise only the `init_time`s that are not already
+    in the archive are appended along `init_time`, using the chunking and encoding of the archive.
+
+    :param dataset: The Xarray Dataset to be saved
+    :param path: the path of the .zarr archive. This can either be a local path or a
+        "s3://..." path.
+    :param ideal_chunk_size_mb: Ideal chunk size in Mb, used when the archive is made.
+    :param retention_hours: Runs older than this, compared to the newest run in the archive,
+        are removed. Zarr can not remove data from the start of an array, so this rewrites the
+        archive, and so it is only done once `prune_batch` runs have expired. If None, all runs
+        are kept.
+    :param prune_batch: the number of expired runs that are removed at once
+    """
+    path = str(path)
+    if not path.endswith(".zarr"):
+        raise ValueError(f"The zarr archive path should end with '.zarr', not {path}")
+    fs = fsspec.open(path).fs
+    _recover_zarr_archive(path=path, fs=fs)
+
+    if not fs.exists(f"{path}/.zmetadata"):
+        logger.info(f'Making new zarr archive "{path}"')
+        chunked = _chunk(dataset, ideal_chunk_size_mb=ideal_chunk_size_mb)
+        _log_and_save(chunked, path)
+    else:
+        # importing this registers the Blosc2 codec, which is needed to read and append to the
+        # archive
+        import metofficedatahub.compression  # noqa: F401
+
+        archive = xr.open_zarr(path)
+
+        _check_archive_coords(archive=archive, dataset=dataset, path=path)
+
+        new_init_times = ~dataset.init_time.isin(archive.init_time.values)
+        if not new_init_times.any():
+            logger.info(f'All init times are already in the zarr archive "{path}"')
+        else:
+            # use the same chunks as the archive
+            chunks = dict(zip(archive.UKV.dims, archive.UKV.encoding["chunks"]))
+            new_data = dataset.isel(init_time=new_init_times.values).chunk(chunks)
+
+            logger.info(f'Appending {new_data.init_time.values} to zarr archive "{path}"')
+            new_data.to_zarr(store=path, mode="a", append_dim="init_time", consolidated=True)
+
+    if retention_hours is not None:
+        _prune_zarr_archive(path=path, retention_hours=retention_hours, prune_batch=prune_batch)
+
+
+def _check_archive_coords(archive: xr.Dataset, dataset: xr.Dataset, path: str):
+    """
+    Check the dataset is on the same grid, steps and variables as the archive
+
+    Appending along `init_time` would otherwise overwrite the coordinates of the archive,
+    so that the runs already in it are labelled wrongly, or fail with an xarray error.
+    """
+    for name in ["variable", "step", "y", "x"]:
+        if not archive[name].equals(dataset[name]):
+            raise ValueError(
+                f"The {name} coordinate ({dataset[name].size} values, from "
+                f"{dataset[name].values[0]} to {dataset[name].values[-1]}) is not the same as in "
+                f"the archive ({archive[name].size} values, from {archive[name].values[0]} to "
+                f"{archive[name].values[-1]}), so can not be appended to {path}"
+            )
+
+
+def _get_archive_paths(path: str) -> Tuple[str, str]:
+    """The paths of the new copy, and of the old archive, used when the archive is pruned"""
+    stem = path[: -len(".zarr")]
+    return f"{stem}_tmp.zarr", f"{stem}_old.zarr"
+
+
+def _recover_zarr_archive(path: str, fs: fsspec.AbstractFileSystem):
+    """
+    Put the archive back, if pruning it was stopped part way through
+
+    The pruned copy is only written to "_tmp.zarr" if it is complete, i.e. it has its
+    ".zmetadata", so that is used if it is there. Otherwise the old archive is moved back.
+    """
+    if fs.exists(f"{path}/.zmetadata"):
+        return
+
+    temp_path, old_path = _get_archive_paths(path)
+    for replacement in [temp_path, old_path]:
+        if fs.exists(f"{replacement}/.zmetadata"):
+            logger.warning(f'Recovering zarr archive "{path}" from "{replacement}"')
+            if fs.exists(path):
+                fs.rm(path, recursive=True)
+            fs.mv(replacement, path, recursive=True)
+            break
+
+    if fs.exists(old_path):
+        fs.rm(old_path, recursive=True)
+
+
+def _prune_zarr_archive(path: str, retention_hours: float, prune_batch: int = 1):
+    """
+    Remove runs older than `retention_hours`, compared to the newest run, from the archive
+
+    The runs that are kept are copied to a new archive, which then replaces the old one. The old
+    archive is only removed once the new one is in place, see `_recover_zarr_archive`.
+    """
+    archive = xr.open_zarr(path)
+    init_times = pd.to_datetime(archive.init_time.values)
+    keep = init_times >= init_times.max() - pd.Timedelta(hours=retention_hours)
+    if (~keep).sum() < max(prune_batch, 1):
+        logger.debug(f"{(~keep).sum()} runs have expired, waiting for {prune_batch} to prune")
+        return
+
+    logger.info(f'Removing {init_times[~keep].values} from zarr archive "{path}"')
+    chunks = dict(zip(archive.UKV.dims, archive.UKV.encoding["chunks"]))
+    kept = archive.isel(init_time=keep).chunk(chunks)
+    for variable in kept.variables.values():
+        variable.encoding = {}
+
+    fs = fsspec.open(path).fs
+    temp_path, old_path = _get_archive_paths(path)
+    if fs.exists(temp_path):
+        fs.rm(temp_path, recursive=True)
+    _log_and_save(kept, temp_path)
+
+    # the live archive is moved aside, rather than deleted, until the new one is in place
+    fs.mv(path, old_path, recursive=True)
+    fs.mv(temp_path, path, recursive=True)
+    fs.rm(old_path, recursive=True)
 
 
 def save_to_s3(dataset: xr.Dataset, path: str):
     """Save to s3"""
+    from metofficedatahub.compression import Blosc2
 
     if path.endswith(".zarr"):
         dataset.to_zarr(
@@ -292,20 +889,24 @@ def save_to_s3(dataset: xr.Dataset, path: str):
             consolidated=True,
             encoding={
                 "init_time": {"units": "nanoseconds since 1970-01-01"},
-                "UKV": {"compressor": Blosc2("zstd", clevel=5)},
+                "UKV": {"compressor": Blosc2("zstd", clevel=5), "dtype": dataset["UKV"].dtype},
             },
         )
     elif path.endswith(".netcdf"):
-        # xarray doesn't support writing .netcdf files directly to S3 like for .zarr files.
-        # Also note the "simplecache::" and see https://github.com/pydata/xarray/issues/4122
-        with fsspec.open("simplecache::" + path, mode="wb") as f:
+        # xarray can only write .netcdf files with h5netcdf to a local path, a file object is
+        # written with scipy as netcdf3 instead. So the file is written locally, and then copied,
+        # see https://github.com/pydata/xarray/issues/4122. The Blosc2 codec is not available in
+        # h5netcdf, so the data is compressed with zlib.
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            local_path = f"{tmpdirname}/{path.split('/')[-1]}"
             dataset.to_netcdf(
-                f,
+                local_path,
                 engine="h5netcdf",
                 encoding={
                     "init_time": {"units": "nanoseconds since 1970-01-01"},
-                    "UKV": {"compressor": Blosc2("zstd", clevel=5)},
+                    "UKV": {"zlib": True, "complevel": 5, "dtype": dataset["UKV"].dtype},
                 },
             )
+            fsspec.open(path).fs.put(local_path, path)
     else:
         assert False, "unexpected extension"
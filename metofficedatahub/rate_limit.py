@@ -0,0 +1,120 @@
+""" Token bucket rate limiter for the calls to the api
+
+The api limits the number of calls each client id can make. One `RateLimiter` is attached to each
+client, and is shared by all the threads that use the client, so together they stay under the
+limit. When the api does respond with a 429, every thread waits for the `Retry-After` time.
+"""
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# calls per second, 0 means there is no limit
+RATE_LIMIT = float(os.getenv("RATE_LIMIT", 0))
+# the number of calls that can be made at once, after being idle
+RATE_LIMIT_BURST = int(os.getenv("RATE_LIMIT_BURST", 1))
+
+
+class RateLimiter:
+    """Token bucket, shared by the threads that call the api"""
+
+    def __init__(self, rate: float = RATE_LIMIT, burst: int = RATE_LIMIT_BURST):
+        """
+        Initialise the rate limiter
+
+        :param rate: the number of calls per second. If 0, the calls are only held back
+            after a 429 response.
+        :param burst: the size of the bucket, i.e. the number of calls that can be made
+            straight away after being idle
+        """
+        self.rate = rate
+        self.burst = max(burst, 1)
+
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+        # the total time spent waiting, the number of calls that had to wait,
+        # and the number of 429 responses
+        self.throttled_seconds = 0.0
+        self.throttled_calls = 0
+        self.too_many_requests = 0
+
+    def reserve(self) -> float:
+        """
+        Take a token from the bucket, without waiting for it
+
+        :return: the time in seconds the caller has to wait before making the call
+        """
+        with self._lock:
+            now = time.monotonic()
+            wait = max(self._paused_until - now, 0.0)
+
+            if self.rate > 0:
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                # the token can go negative, which queues the callers one after another
+                self._tokens -= 1
+                if self._tokens < 0:
+                    wait = max(wait, -self._tokens / self.rate)
+
+            if wait > 0:
+                self.throttled_seconds += wait
+                self.throttled_calls += 1
+
+        return wait
+
+    def acquire(self):
+        """Wait until a call can be made"""
+        wait = self.reserve()
+        if wait > 0:
+            logger.debug(f"Rate limited, waiting {wait:.2f} seconds")
+            time.sleep(wait)
+
+    def pause(self, seconds: float):
+        """
+        Hold back all calls for some time, e.g. after a 429 response
+
+        :param seconds: the time in seconds to hold back the calls for
+        """
+        with self._lock:
+            self.too_many_requests += 1
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def to_dict(self) -> dict:
+        """The time spent throttled, and the number of calls and 429 responses"""
+        return {
+            "throttled_seconds": self.throttled_seconds,
+            "throttled_calls": self.throttled_calls,
+            "too_many_requests": self.too_many_requests,
+        }
+
+
+def get_retry_after(retry_after: Optional[str]) -> Optional[float]:
+    """
+    Get the time to wait from a `Retry-After` header
+
+    :param retry_after: the header, either a number of seconds or a http date
+    :return: the time in seconds to wait, or None if there is no header or it can not be read
+    """
+    if retry_after is None:
+        return None
+
+    try:
+        return max(float(retry_after), 0.0)
+    except ValueError:
+        pass
+
+    try:
+        retry_datetime = parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        logger.warning(f"Could not read Retry-After header {retry_after}")
+        return None
+
+    return max((retry_datetime - datetime.now(timezone.utc)).total_seconds(), 0.0)
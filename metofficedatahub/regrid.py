@@ -0,0 +1,205 @@
+""" Reusable regridding weights from the UKV source grid to the OSGB target grid
+
+Building the nearest-neighbour tree and the Delaunay triangulation is the expensive part of
+regridding, and the UKV source grid hardly ever changes between runs. The mapping is therefore
+computed once, stored (locally or anywhere fsspec can write to), keyed by a hash of the source
+latitude/longitude grid and the target grid, and then applied to every slice with an index
+gather.
+"""
+import hashlib
+import io
+import logging
+import os
+from typing import Optional
+
+import fsspec
+import numpy as np
+
+from metofficedatahub.lazy_import import lazy_import
+
+spatial = lazy_import("scipy.spatial")
+
+logger = logging.getLogger(__name__)
+
+# keep the weights in memory too, so that repeated calls in one process do not hit storage
+_weights_in_memory = {}
+
+
+class RegridWeights:
+    """Source-to-target mapping for regridding
+
+    This holds
+    - nearest_index: for every target point, the index of the nearest (flattened) source point
+    - linear_vertices: for every target point, the 3 source points of its Delaunay triangle
+    - linear_weights: for every target point, the barycentric weights of those 3 source points.
+        These are nan for target points outside the source grid.
+    """
+
+    def __init__(
+        self,
+        nearest_index: np.ndarray,
+        linear_vertices: np.ndarray,
+        linear_weights: np.ndarray,
+        target_shape: tuple,
+    ):
+        """
+        Initialise the weights
+
+        :param nearest_index: index of nearest source point, one per target point
+        :param linear_vertices: indices of the 3 source points surrounding each target point
+        :param linear_weights: barycentric weights for the linear_vertices
+        :param target_shape: the 2D shape (y, x) of the target grid
+        """
+        self.nearest_index = nearest_index
+        self.linear_vertices = linear_vertices
+        self.linear_weights = linear_weights
+        self.target_shape = tuple(target_shape)
+
+    @classmethod
+    def from_points(
+        cls, source_points: np.ndarray, target_points: np.ndarray, target_shape: tuple
+    ) -> "RegridWeights":
+        """
+        Compute the weights. This reproduces what scipy.interpolate.griddata does
+
+        :param source_points: array of shape (n, 2) of the source points
+        :param target_points: array of shape (m, 2) of the target points
+        :param target_shape: the 2D shape of the target grid, m = target_shape[0]*target_shape[1]
+        """
+        logger.debug("Building nearest neighbour tree")
+        _, nearest_index = spatial.cKDTree(source_points).query(target_points)
+
+        logger.debug("Building Delaunay triangulation")
+        triangulation = spatial.Delaunay(source_points)
+        simplex = triangulation.find_simplex(target_points)
+        linear_vertices = triangulation.simplices[simplex]
+
+        transform = triangulation.transform[simplex]
+        delta = target_points - transform[:, 2]
+        bary = np.einsum("njk,nk->nj", transform[:, :2, :], delta)
+        linear_weights = np.hstack((bary, 1 - bary.sum(axis=1, keepdims=True)))
+        linear_weights[simplex == -1] = np.nan
+
+        return cls(
+            nearest_index=nearest_index.astype(np.int64),
+            linear_vertices=linear_vertices.astype(np.int64),
+            linear_weights=linear_weights,
+            target_shape=target_shape,
+        )
+
+    def nearest(self, values: np.ndarray) -> np.ndarray:
+        """
+        Regrid using nearest neighbour
+
+        :param values: the source values, the last two dimensions are the source grid.
+            Any leading dimensions (e.g. 'init_time' and 'step') are regridded in one go.
+        :return: array on the target grid, with the same leading dimensions
+        """
+        leading_shape = values.shape[:-2]
+        values = values.reshape(*leading_shape, -1)
+        return values[..., self.nearest_index].reshape(*leading_shape, *self.target_shape)
+
+    def linear(self, values: np.ndarray) -> np.ndarray:
+        """
+        Regrid using linear interpolation
+
+        :param values: the source values, the last two dimensions are the source grid.
+            Any leading dimensions (e.g. 'init_time' and 'step') are regridded in one go.
+        :return: array on the target grid, with the same leading dimensions
+        """
+        leading_shape = values.shape[:-2]
+        values = values.reshape(*leading_shape, -1)[..., self.linear_vertices]
+        values = np.einsum("...nj,nj->...n", values, self.linear_weights)
+        return values.reshape(*leading_shape, *self.target_shape)
+
+    def save(self, path: str):
+        """Save weights to a .npz file, path can be local or remote"""
+        buffer = io.BytesIO()
+        np.savez(
+            buffer,
+            nearest_index=self.nearest_index,
+            linear_vertices=self.linear_vertices,
+            linear_weights=self.linear_weights,
+            target_shape=np.array(self.target_shape),
+        )
+        with fsspec.open(path, mode="wb") as f:
+            f.write(buffer.getvalue())
+
+    @classmethod
+    def load(cls, path: str) -> "RegridWeights":
+        """Load weights from a .npz file, path can be local or remote"""
+        with fsspec.open(path, mode="rb") as f:
+            data = np.load(io.BytesIO(f.read()))
+            return cls(
+                nearest_index=data["nearest_index"],
+                linear_vertices=data["linear_vertices"],
+                linear_weights=data["linear_weights"],
+                target_shape=tuple(data["target_shape"]),
+            )
+
+
+def make_grid_hash(*arrays: np.ndarray) -> str:
+    """Make a hash of the source and target grids, used to identify the weights"""
+    hasher = hashlib.sha256()
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        hasher.update(str(array.shape).encode())
+        hasher.update(str(array.dtype).encode())
+        hasher.update(array.tobytes())
+    return hasher.hexdigest()[:16]
+
+
+def get_regrid_weights(
+    latitude: np.ndarray,
+    longitude: np.ndarray,
+    source_points: np.ndarray,
+    target_points: np.ndarray,
+    target_shape: tuple,
+    cache_dir: Optional[str] = os.getenv("REGRID_CACHE_DIR", None),
+) -> RegridWeights:
+    """
+    Get the regridding weights, either from the cache or by computing them
+
+    :param latitude: the source latitudes, used for the hash
+    :param longitude: the source longitudes, used for the hash
+    :param source_points: array of shape (n, 2) of the source points
+    :param target_points: array of shape (m, 2) of the target points
+    :param target_shape: the 2D shape of the target grid
+    :param cache_dir: directory where weights are stored. This can be local or "s3://...".
+        If None, weights are only kept in memory.
+    :return: the regridding weights
+    """
+    key = make_grid_hash(latitude, longitude, target_points)
+
+    if key in _weights_in_memory:
+        logger.debug(f"Using regridding weights {key} from memory")
+        return _weights_in_memory[key]
+
+    path = None
+    if cache_dir is not None:
+        path = f"{cache_dir}/regrid_weights_{key}.npz"
+        fs = fsspec.open(path).fs
+        if fs.exists(path):
+            logger.debug(f"Loading regridding weights from {path}")
+            try:
+                weights = RegridWeights.load(path)
+                _weights_in_memory[key] = weights
+                return weights
+            except Exception as e:
+                logger.warning(f"Could not load regridding weights from {path}, remaking them: {e}")
+
+    logger.debug(f"Making regridding weights {key}")
+    weights = RegridWeights.from_points(
+        source_points=source_points, target_points=target_points, target_shape=target_shape
+    )
+    _weights_in_memory[key] = weights
+
+    if path is not None:
+        logger.debug(f"Saving regridding weights to {path}")
+        try:
+            fs.makedirs(cache_dir, exist_ok=True)
+            weights.save(path)
+        except Exception as e:
+            logger.warning(f"Could not save regridding weights to {path}: {e}")
+
+    return weights
@@ -1,12 +1,18 @@
 """ Utils functions """
+from __future__ import annotations
+
 import logging
 import os
+from typing import Optional, Tuple
 
 import numpy as np
-import psutil
-import pyproj
-import xarray as xr
-from scipy.interpolate import griddata
+
+from metofficedatahub.lazy_import import lazy_import
+from metofficedatahub.regrid import get_regrid_weights
+
+psutil = lazy_import("psutil")
+pyproj = lazy_import("pyproj")
+xr = lazy_import("xarray")
 
 # OSGB is also called "OSGB 1936 / British National Grid -- United
 # Kingdom Ordnance Survey".  OSGB is used in many UK electricity
@@ -38,31 +44,178 @@ EASTING = np.arange(start=WEST, stop=EAST, step=DX_METERS, dtype=np.int32)
 NUM_ROWS = len(NORTHING)
 NUM_COLS = len(EASTING)
 
+# "batched" regrids the whole (time, step, y, x) cube of a variable in one gather,
+# "slices" regrids one (y, x) slice at a time, which uses less memory at once.
+REGRID_ENGINES = ("batched", "slices")
+
+# A region of interest, as (west, south, east, north), in OSGB meters or in degrees.
+# The source data is cropped to the region, with a margin, before it is regridded.
+BBOX_CRS = ("osgb", "lat_lon")
+
+# The grib data has much less precision than float64, so by default the data is kept as float32
+DTYPE = os.getenv("DTYPE", "float32")
+
+
+def _get_dtype(dtype) -> np.dtype:
+    """Check the dtype is a float, so nans can be stored"""
+    dtype = np.dtype(dtype)
+    if not np.issubdtype(dtype, np.floating):
+        raise ValueError(f"The dtype should be a float, not {dtype}")
+    return dtype
+
+
+def parse_bbox(bbox: Optional[str]) -> Optional[Tuple[float, float, float, float]]:
+    """
+    Parse a bounding box from a string, e.g. from the cli or an environment variable
+
+    :param bbox: "west,south,east,north", or None
+    :return: the bounding box as (west, south, east, north), or None
+    """
+    if bbox is None or bbox == "":
+        return None
+
+    values = tuple(float(value) for value in bbox.split(","))
+    if len(values) != 4:
+        raise ValueError(f"The bounding box should be 'west,south,east,north', not {bbox}")
+    return values
+
+
+def get_bbox_osgb(
+    bbox: Tuple[float, float, float, float], crs: str = "osgb"
+) -> Tuple[float, float, float, float]:
+    """
+    Get a bounding box in OSGB meters
+
+    :param bbox: (west, south, east, north) in the `crs`
+    :param crs: the crs of the bounding box, one of BBOX_CRS
+    :return: (west, south, east, north) in OSGB meters. For a latitude and longitude box,
+        this is the box around the whole region, as its edges are curved in OSGB.
+    """
+    if crs not in BBOX_CRS:
+        raise ValueError(f"Bounding box crs {crs} not in {BBOX_CRS}")
+
+    west, south, east, north = bbox
+    if west >= east or south >= north:
+        raise ValueError(f"The bounding box {bbox} should be (west, south, east, north)")
+    if crs == "osgb":
+        return west, south, east, north
+
+    # points along the south, east, north and west edges of the box
+    along = np.linspace(0, 1, 50)
+    longitudes = west + (east - west) * along
+    latitudes = south + (north - south) * along
+    longitude = np.concatenate([longitudes, np.full(50, east), longitudes, np.full(50, west)])
+    latitude = np.concatenate([np.full(50, south), latitudes, np.full(50, north), latitudes])
+    lat_lon_to_osgb = pyproj.Transformer.from_crs(crs_from=WGS84, crs_to=OSGB)
+    x, y = lat_lon_to_osgb.transform(latitude, longitude)
+    return x.min(), y.min(), x.max(), y.max()
 
-def add_x_y(dataset: xr.Dataset) -> xr.Dataset:
+
+def crop_to_bbox(
+    dataset: xr.Dataset,
+    x: np.ndarray,
+    y: np.ndarray,
+    bbox_osgb: Tuple[float, float, float, float],
+    margin: Optional[float] = None,
+) -> Tuple[xr.Dataset, np.ndarray, np.ndarray]:
+    """
+    Crop the source data to the rectangle of grid points around a bounding box
+
+    :param dataset: the dataset on the UKV source grid
+    :param x: the OSGB x of each source grid point
+    :param y: the OSGB y of each source grid point
+    :param bbox_osgb: (west, south, east, north) in OSGB meters
+    :param margin: source points up to this many meters outside the box are kept. If None, this
+        is twice the largest spacing of the source grid, so the regridding near the edges of the
+        box is the same as without cropping.
+    :return: the cropped dataset, x and y
+    """
+    if margin is None:
+        margin = 2 * max(
+            np.abs(np.diff(x, axis=1)).max(initial=0), np.abs(np.diff(y, axis=0)).max(initial=0)
+        )
+
+    west, south, east, north = bbox_osgb
+    inside = (
+        (x >= west - margin) & (x <= east + margin) & (y >= south - margin) & (y <= north + margin)
+    )
+    rows = np.flatnonzero(inside.any(axis=1))
+    cols = np.flatnonzero(inside.any(axis=0))
+    if len(rows) == 0 or len(cols) == 0:
+        raise ValueError(f"The bounding box {bbox_osgb} does not overlap the data")
+
+    dim_y, dim_x = dataset.latitude.dims
+    rows = slice(rows[0], rows[-1] + 1)
+    cols = slice(cols[0], cols[-1] + 1)
+    logger.debug(f"Cropping the source data to {dim_y}={rows}, {dim_x}={cols}")
+    return dataset.isel({dim_y: rows, dim_x: cols}), x[rows, cols], y[rows, cols]
+
+
+def add_x_y(
+    dataset: xr.Dataset,
+    regrid_cache_dir: Optional[str] = os.getenv("REGRID_CACHE_DIR", None),
+    engine: str = os.getenv("REGRID_ENGINE", "batched"),
+    dtype: str = DTYPE,
+    bbox: Optional[Tuple[float, float, float, float]] = parse_bbox(os.getenv("BBOX")),
+    bbox_crs: str = os.getenv("BBOX_CRS", "osgb"),
+) -> xr.Dataset:
     """Add x and y coordinates
 
     This is specifically for the UK model,
     see above where these values are made.
+
+    The regridding weights only depend on the source and target grids, so they are computed once,
+    and then reused for all the variables, 'init_time' and 'step' slices.
+
+    :param dataset: the dataset on the UKV source grid
+    :param regrid_cache_dir: directory where the regridding weights are stored, so they can be
+        reused between runs. This can be local or "s3://...". If None, they are only kept in memory.
+    :param engine: how to apply the weights, one of REGRID_ENGINES. If the data is a dask array,
+        each chunk is regridded separately and lazily.
+    :param dtype: the float dtype of the regridded data variables
+    :param bbox: a region of interest, as (west, south, east, north). If given, only the target
+        grid points in the box are made, and the source data is cropped to the box, with a margin,
+        before regridding. If None, the whole UKV area is regridded.
+    :param bbox_crs: the crs of the `bbox`, "osgb" for meters, or "lat_lon" for degrees
     """
+    if engine not in REGRID_ENGINES:
+        raise ValueError(f"Regrid engine {engine} not in {REGRID_ENGINES}")
+    dtype = _get_dtype(dtype)
 
     # transform to osgb
     lat_lon_to_osgb = pyproj.Transformer.from_crs(crs_from=WGS84, crs_to=OSGB)
-    x, y = lat_lon_to_osgb.transform(dataset.latitude, dataset.longitude)
+    x, y = lat_lon_to_osgb.transform(dataset.latitude.values, dataset.longitude.values)
 
     # new grid
-    x_grid, y_grid = np.meshgrid(EASTING, NORTHING)
-    points = np.array([y.ravel(), x.ravel()])
-    points = points.transpose().tolist()
+    northing, easting = NORTHING, EASTING
+    if bbox is not None:
+        bbox_osgb = get_bbox_osgb(bbox, crs=bbox_crs)
+        west, south, east, north = bbox_osgb
+        northing = NORTHING[(NORTHING >= south) & (NORTHING <= north)]
+        easting = EASTING[(EASTING >= west) & (EASTING <= east)]
+        if len(northing) == 0 or len(easting) == 0:
+            raise ValueError(f"The bounding box {bbox} does not contain any OSGB grid points")
 
-    # # interpolate lat lon, could take about 6 seconds
-    logger.debug("Resampling lat and lon values")
-    lat = griddata(
-        points=points, values=dataset.latitude.values.ravel(), xi=(y_grid, x_grid), method="linear"
-    )
-    lon = griddata(
-        points=points, values=dataset.longitude.values.ravel(), xi=(y_grid, x_grid), method="linear"
+        # the source points that are not near the target grid are not needed
+        dataset, x, y = crop_to_bbox(dataset, x=x, y=y, bbox_osgb=bbox_osgb)
+
+    x_grid, y_grid = np.meshgrid(easting, northing)
+    points = np.array([y.ravel(), x.ravel()]).transpose()
+    target_points = np.array([y_grid.ravel(), x_grid.ravel()]).transpose()
+
+    # nearest neighbour tree and triangulation, could take about 6 seconds if not cached
+    regrid_weights = get_regrid_weights(
+        latitude=dataset.latitude.values,
+        longitude=dataset.longitude.values,
+        source_points=points,
+        target_points=target_points,
+        target_shape=x_grid.shape,
+        cache_dir=regrid_cache_dir,
     )
+
+    logger.debug("Resampling lat and lon values")
+    lat = regrid_weights.linear(dataset.latitude.values)
+    lon = regrid_weights.linear(dataset.longitude.values)
     process = psutil.Process(os.getpid())
     logger.debug(f"Memory is {process.memory_info().rss / 10 ** 6} MB")
 
@@ -74,20 +227,28 @@ def add_x_y(dataset: xr.Dataset) -> xr.Dataset:
         data = dataset.__getitem__(data_var)
         dataset.drop_vars(data_var)
 
-        n1, n2, ny, nx = data.shape
-        data_gird = np.zeros((n1, n2, NUM_ROWS, NUM_COLS))
-
-        # need to loop of 'init_time' and 'step'
-        for i in range(n1):
-            for j in range(n2):
-                values = data[i, j].values.ravel()
-                # The following different methods can be used.
-                # nearest - 0.4 seconds
-                # linear - 2.9 seconds
-                # cubic - 3.3 seconds
-                # The timings are for a (639, 455) image
-                tt = griddata(points=points, values=values, xi=(y_grid, x_grid), method="nearest")
-                data_gird[i, j] = tt
+        if data.chunks is not None:
+            # dask array, so regrid each chunk separately. Each chunk needs the full grid.
+            data = data.chunk({data.dims[-2]: -1, data.dims[-1]: -1})
+            data_gird = data.data.map_blocks(
+                regrid_weights.nearest,
+                chunks=data.chunks[:-2] + tuple((size,) for size in regrid_weights.target_shape),
+                dtype=data.dtype,
+            ).astype(dtype, copy=False)
+        elif engine == "batched":
+            # one gather over all 'init_time' and 'step' slices,
+            # we use nearest neighbour, the same as griddata(..., method="nearest")
+            data_gird = regrid_weights.nearest(data.values).astype(dtype, copy=False)
+        else:
+            n1, n2, ny, nx = data.shape
+            data_gird = np.zeros((n1, n2, len(northing), len(easting)), dtype=dtype)
+
+            # need to loop of 'init_time' and 'step'
+            for i in range(n1):
+                for j in range(n2):
+                    values = data[i, j].values
+                    # we use nearest neighbour, the same as griddata(..., method="nearest")
+                    data_gird[i, j] = regrid_weights.nearest(values)
 
         process = psutil.Process(os.getpid())
         logger.debug(f"Memory is {process.memory_info().rss / 10 ** 6} MB")
@@ -102,8 +263,8 @@ def add_x_y(dataset: xr.Dataset) -> xr.Dataset:
         coords={
             "time": dataset.time,
             "step": dataset.step,
-            "y": ("y", NORTHING),
-            "x": ("x", EASTING),
+            "y": ("y", northing),
+            "x": ("x", easting),
             "latitude": (["y", "x"], lat, dataset.latitude.attrs),
             "longitude": (["y", "x"], lon, dataset.longitude.attrs),
         },
@@ -113,7 +274,7 @@ def add_x_y(dataset: xr.Dataset) -> xr.Dataset:
     return new_dataset
 
 
-def post_process_dataset(dataset: xr.Dataset) -> xr.Dataset:
+def post_process_dataset(dataset: xr.Dataset, dtype: str = DTYPE) -> xr.Dataset:
     """Get the Dataset ready for saving to Zarr.
 
     Convert the Dataset (with differet DataArrays for each NWP variable)
@@ -128,9 +289,11 @@ def post_process_dataset(dataset: xr.Dataset) -> xr.Dataset:
     `dataset.to_zarr(encoding=...)`) has two advantages:  1) We can name the dimensions; and
     2) Chunking at this stage converts the Dataset into a Dask dataset, which adds a second
     level of parallelism.
+
+    The data is converted to `dtype`, which is float32 by default.
     """
     logger.debug("Post-processing dataset...")
-    da = dataset.to_array(dim="variable", name="UKV")
+    da = dataset.to_array(dim="variable", name="UKV").astype(_get_dtype(dtype), copy=False)
 
     process = psutil.Process(os.getpid())
     logger.debug(f"Memory is {process.memory_info().rss / 10 ** 6} MB")
@@ -148,8 +311,8 @@ def post_process_dataset(dataset: xr.Dataset) -> xr.Dataset:
             {
                 "init_time": 1,
                 "step": 1,
-                "y": len(dataset.y) // 2,
-                "x": len(dataset.x) // 2,
+                "y": max(len(dataset.y) // 2, 1),
+                "x": max(len(dataset.x) // 2, 1),
                 "variable": -1,
             }
         )
@@ -20,5 +20,5 @@ setup(
     long_description=long_description,
     long_description_content_type="text/markdown",
     include_package_data=True,
-    packages=find_packages(),
+    packages=find_packages(exclude=["benchmarks", "tests"]),
 )
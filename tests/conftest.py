@@ -7,12 +7,16 @@ export PYTHONPATH=${PYTHONPATH}:/tests
 import json
 import os
 
+import numpy as np
+import pandas as pd
+import pyproj
 import pytest
 import xarray as xr
 from nowcasting_datamodel.connection import DatabaseConnection
 from nowcasting_datamodel.models.base import Base_Forecast
 
 from metofficedatahub.base import BaseMetOfficeDataHub
+from metofficedatahub.cache import StagingCache
 from metofficedatahub.constants import DOMAIN, ROOT
 from metofficedatahub.multiple_files import MetOfficeDataHub
 
@@ -37,9 +41,12 @@ def basemetofficedatahub():
 
 
 @pytest.fixture
-def metofficedatahub():
+def metofficedatahub(tmp_path):
     """Fixture of MetOfficeDataHub"""
-    return MetOfficeDataHub(client_id="fake", client_secret="fake")
+    staging_cache = StagingCache(
+        staging_dir=str(tmp_path / "staging"), index_dir=str(tmp_path / "index")
+    )
+    return MetOfficeDataHub(client_id="fake", client_secret="fake", staging_cache=staging_cache)
 
 
 def mocked_requests_get(*args, **kwargs):
@@ -50,10 +57,20 @@ def mocked_requests_get(*args, **kwargs):
             self.json_data = data
             self.status_code = status_code
             self.content = data
+            self.headers = {}
+            if isinstance(data, bytes):
+                self.headers["Content-Length"] = str(len(data))
 
         def json(self):
             return self.json_data
 
+        def iter_content(self, chunk_size=1):
+            for i in range(0, len(self.content), chunk_size):
+                yield self.content[i : i + chunk_size]
+
+        def close(self):
+            pass
+
     if args[0] == f"https://{DOMAIN}/{ROOT}/orders?detail=MINIMAL":
         filename = "order_list.json"
     elif args[0] == f"https://{DOMAIN}/{ROOT}/orders/test_order_id/latest?detail=MINIMAL":
@@ -86,14 +103,32 @@ def mocked_requests_get(*args, **kwargs):
     return MockResponse(data, 200)
 
 
-def mocked_requests_get_error():
-    """Mock API so it always gives 404"""
+class MockDataResponse:
+    """Mocked streamed response for downloading a data file"""
+
+    def __init__(self, content: bytes, status_code: int = 200, headers: dict = None):
+        self.content = content
+        self.status_code = status_code
+        self.headers = {"Content-Length": str(len(content))} if headers is None else headers
+
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i : i + chunk_size]
+
+    def close(self):
+        pass
+
+
+def mocked_requests_get_error(status_code: int = 404):
+    """Mock API so it always gives 404, or another error code"""
 
     class MockResponse:
         def __init__(self, data, status_code):
             self.json_data = data
             self.status_code = status_code
             self.content = data
+            self.headers = {}
+            self.closed = False
 
         def json(self):
             return self.json_data
@@ -102,7 +137,10 @@ def mocked_requests_get_error():
         def text(self):
             return "Page does not exist"
 
-    return MockResponse("Page does not exist", 404)
+        def close(self):
+            self.closed = True
+
+    return MockResponse("Page does not exist", status_code)
 
 
 @pytest.fixture
@@ -112,3 +150,32 @@ def met_office_all_files():
     This allows running some tests way faster.
     """
     return xr.open_dataset("tests/fixtures/met_all_files.netcdf")
+
+
+@pytest.fixture
+def ukv_dataset():
+    """Small xarray dataset that looks like the merged grib files, on a coarse UKV-like grid"""
+    # coarse 20km grid in OSGB covering the target grid, then transformed to lat lon
+    y_osgb = np.arange(-40_000, 1_300_000, 20_000)
+    x_osgb = np.arange(-240_000, 740_000, 20_000)
+    x_grid, y_grid = np.meshgrid(x_osgb, y_osgb)
+    osgb_to_lat_lon = pyproj.Transformer.from_crs(crs_from=27700, crs_to=4326)
+    latitude, longitude = osgb_to_lat_lon.transform(x_grid, y_grid)
+
+    time = pd.to_datetime(["2022-01-01T00:00"])
+    step = pd.to_timedelta([0, 1, 2], unit="h")
+    shape = (len(time), len(step), len(y_osgb), len(x_osgb))
+    rng = np.random.default_rng(0)
+
+    return xr.Dataset(
+        data_vars={
+            "t": (["time", "step", "y", "x"], rng.uniform(270, 290, shape).astype(np.float32)),
+            "lcc": (["time", "step", "y", "x"], rng.uniform(0, 100, shape).astype(np.float32)),
+        },
+        coords={
+            "time": time,
+            "step": step,
+            "latitude": (["y", "x"], latitude),
+            "longitude": (["y", "x"], longitude),
+        },
+    )
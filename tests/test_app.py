@@ -1,17 +1,19 @@
 import tempfile
+from datetime import datetime, timezone
 from unittest import mock
 
 from click.testing import CliRunner
 from freezegun import freeze_time
 
-from metofficedatahub.app import run
+from metofficedatahub.app import poll_for_new_runs, run
+from metofficedatahub.models import RunDetails, RunListForModel
 from tests.conftest import mocked_requests_get, mocked_requests_get_error
 
 runner = CliRunner()
 
 
 @freeze_time("2022-01-01")
-@mock.patch("requests.get", side_effect=mocked_requests_get)
+@mock.patch("requests.Session.get", side_effect=mocked_requests_get)
 def test_save_to_zarr(mock_get, db_connection):
     with tempfile.TemporaryDirectory() as tmpdirname:
         response = runner.invoke(
@@ -32,7 +34,7 @@ def test_save_to_zarr(mock_get, db_connection):
 
 
 @freeze_time("2022-01-01")
-@mock.patch("requests.get", side_effect=mocked_requests_get)
+@mock.patch("requests.Session.get", side_effect=mocked_requests_get)
 def test_no_order_ids(mock_get, db_connection):
     with tempfile.TemporaryDirectory() as tmpdirname:
         response = runner.invoke(
@@ -50,10 +52,52 @@ def test_no_order_ids(mock_get, db_connection):
 
 
 @freeze_time("2022-01-01")
-@mock.patch("requests.get", side_effect=mocked_requests_get_error)
+@mock.patch("requests.Session.get", side_effect=mocked_requests_get_error)
 def test_error(mock_get, db_connection):
     with tempfile.TemporaryDirectory() as tmpdirname:
         response = runner.invoke(
             run, ["--api-key", "fake", "--api-secret", "fake", "--save-dir", tmpdirname]
         )
         assert response.exit_code == 1
+
+
+@mock.patch("metofficedatahub.app.time.sleep")
+def test_poll_for_new_runs(mock_sleep):
+    def make_runs(hours):
+        return RunListForModel(
+            modelId="mo-uk",
+            completeRuns=[
+                RunDetails(run=hour, runDateTime=datetime(2022, 1, 1, hour), runFilter="")
+                for hour in hours
+            ],
+        )
+
+    datahub = mock.Mock()
+    datahub.get_runs_model_id.side_effect = [
+        make_runs([0]),
+        make_runs([0]),
+        Exception("API error"),
+        make_runs([0, 1]),
+        make_runs([0, 1]),
+        make_runs([0, 1]),
+        make_runs([0, 1]),
+    ]
+    # the pipeline returns the run it saved. The second run fails the first time, and then is
+    # not in the order yet, so the older run is saved
+    pipeline = mock.Mock(
+        side_effect=[
+            datetime(2022, 1, 1, 0, tzinfo=timezone.utc),
+            Exception("Failed"),
+            datetime(2022, 1, 1, 0, tzinfo=timezone.utc),
+            datetime(2022, 1, 1, 1, tzinfo=timezone.utc),
+        ]
+    )
+
+    poll_for_new_runs(
+        datahub=datahub, pipeline=pipeline, model_id="mo-uk", poll_interval=60, max_polls=7
+    )
+
+    assert pipeline.call_count == 4
+    assert mock_sleep.call_count == 6
+    # the runs are not taken from the response cache
+    datahub.get_runs_model_id.assert_called_with(model_id="mo-uk", refresh=True)
@@ -0,0 +1,128 @@
+import asyncio
+import filecmp
+import threading
+
+import pytest
+
+from benchmarks.mock_datahub import MockDataHubServer
+from benchmarks.synthetic import make_grib_files
+from metofficedatahub.async_base import AsyncMetOfficeDataHub
+from metofficedatahub.models import OrderDetails, OrderList
+
+
+@pytest.fixture
+def grib_files(tmp_path):
+    return make_grib_files(folder=str(tmp_path / "source"), n_variables=4)
+
+
+def make_datahub(server, cache_dir, **kwargs):
+    return AsyncMetOfficeDataHub(
+        client_id="fake",
+        client_secret="fake",
+        base_url=server.base_url,
+        cache_dir=str(cache_dir),
+        backoff_factor=0,
+        **kwargs,
+    )
+
+
+def test_metadata(grib_files, tmp_path):
+    async def get_metadata(datahub):
+        async with datahub:
+            return await asyncio.gather(
+                datahub.get_orders(),
+                datahub.get_lastest_order(order_id=server.order_id),
+                datahub.get_runs_model_id(model_id=server.model_id),
+                datahub.get_latest_order_file_id(
+                    order_id=server.order_id, file_id=grib_files[0].fileId
+                ),
+            )
+
+    with MockDataHubServer(files=grib_files) as server:
+        datahub = make_datahub(server, tmp_path / "raw")
+        orders, order_details, runs, file_details = asyncio.run(get_metadata(datahub))
+
+    assert isinstance(orders, OrderList)
+    assert isinstance(order_details, OrderDetails)
+    assert len(order_details.files) == len(grib_files)
+    assert len(runs.completeRuns) == 1
+    assert file_details.file.fileId == grib_files[0].fileId
+
+
+def test_download_concurrently_with_errors(grib_files, tmp_path):
+    async def download(datahub):
+        async with datahub:
+            filenames = await asyncio.gather(
+                *[
+                    datahub.get_latest_order_file_id_data(
+                        order_id=server.order_id, file_id=file.fileId, save_manifest=False
+                    )
+                    for file in grib_files
+                ]
+            )
+        datahub.download_cache.save()
+        return filenames
+
+    with MockDataHubServer(
+        files=grib_files, error_rate=0.3, too_many_requests_rate=0.3, retry_after=0.01
+    ) as server:
+        datahub = make_datahub(server, tmp_path / "raw", max_retries=10, pool_size=2)
+        filenames = asyncio.run(download(datahub))
+
+    assert server.injected["503"] > 0
+    assert server.injected["429"] > 0
+    for file, filename in zip(grib_files, filenames):
+        assert filecmp.cmp(file.local_filename, filename, shallow=False)
+        assert datahub.download_cache.contains(filename)
+
+
+def test_download_dropped_connection_resumes(grib_files, tmp_path):
+    file_id = grib_files[0].fileId
+
+    async def download(datahub):
+        async with datahub:
+            return await datahub.get_latest_order_file_id_data(
+                order_id=server.order_id, file_id=file_id
+            )
+
+    with MockDataHubServer(files=grib_files[:1], drop_rate=1) as server:
+        datahub = make_datahub(server, tmp_path / "raw")
+        with pytest.raises(Exception):
+            asyncio.run(download(datahub))
+
+        # the second time, the rest of the file is downloaded
+        server.drop_rate = 0
+        filename = asyncio.run(download(datahub))
+
+    assert filecmp.cmp(grib_files[0].local_filename, filename, shallow=False)
+
+
+def test_filesystem_calls_do_not_block_event_loop(grib_files, tmp_path):
+    threads = []
+
+    async def download(datahub):
+        async with datahub:
+            return await datahub.get_latest_order_file_id_data(
+                order_id=server.order_id, file_id=grib_files[0].fileId
+            )
+
+    with MockDataHubServer(files=grib_files[:1]) as server:
+        datahub = make_datahub(server, tmp_path / "raw")
+        fs = datahub.download_cache.fs
+        for name in ["exists", "size", "open", "mv"]:
+            method = getattr(fs, name)
+
+            def record(*args, _method=method, **kwargs):
+                threads.append(threading.get_ident())
+                return _method(*args, **kwargs)
+
+            setattr(fs, name, record)
+        try:
+            filename = asyncio.run(download(datahub))
+        finally:
+            for name in ["exists", "size", "open", "mv"]:
+                delattr(fs, name)
+
+    assert filecmp.cmp(grib_files[0].local_filename, filename, shallow=False)
+    assert len(threads) > 0
+    assert threading.get_ident() not in threads
@@ -0,0 +1,131 @@
+from unittest import mock
+
+import pytest
+import requests
+
+from metofficedatahub.base import BaseMetOfficeDataHub, DataHubMixin
+from metofficedatahub.cache import ResponseCache
+from tests.conftest import mocked_requests_get, mocked_requests_get_error
+
+
+def test_session_is_reused():
+    datahub = BaseMetOfficeDataHub(client_id="fake", client_secret="fake", pool_size=4)
+    adapter = datahub.session.get_adapter("https://example.com")
+    assert adapter._pool_maxsize == 4
+
+
+def test_mixin_needs_make_session():
+    class DataHubWithoutSession(DataHubMixin):
+        pass
+
+    with pytest.raises(TypeError, match="make_session"):
+        DataHubWithoutSession(client_id="fake", client_secret="fake")
+
+
+def test_call_url_retry_on_server_error():
+    datahub = BaseMetOfficeDataHub(client_id="fake", client_secret="fake", backoff_factor=0)
+
+    error_response = mocked_requests_get_error(status_code=503)
+    responses = [error_response, requests.ConnectionError("dropped")]
+
+    def side_effect(*args, **kwargs):
+        if responses:
+            response = responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return response
+        return mocked_requests_get(*args, **kwargs)
+
+    with mock.patch("requests.Session.get", side_effect=side_effect) as mock_get:
+        datahub.get_orders()
+
+    assert mock_get.call_count == 3
+    assert mock_get.call_args.kwargs["timeout"] == datahub.timeout
+    # the connection of the error response is released before retrying
+    assert error_response.closed
+
+
+def test_call_url_max_retries():
+    datahub = BaseMetOfficeDataHub(
+        client_id="fake", client_secret="fake", backoff_factor=0, max_retries=2
+    )
+
+    with mock.patch(
+        "requests.Session.get", side_effect=lambda *args, **kwargs: mocked_requests_get_error(503)
+    ) as mock_get:
+        with pytest.raises(Exception):
+            datahub.get_orders()
+
+    assert mock_get.call_count == 3
+
+
+def test_call_url_no_retry_on_client_error():
+    datahub = BaseMetOfficeDataHub(client_id="fake", client_secret="fake", backoff_factor=0)
+
+    with mock.patch(
+        "requests.Session.get", side_effect=lambda *args, **kwargs: mocked_requests_get_error()
+    ) as mock_get:
+        with pytest.raises(Exception):
+            datahub.get_orders()
+
+    assert mock_get.call_count == 1
+
+
+def test_response_cache_ttl():
+    datahub = BaseMetOfficeDataHub(client_id="fake", client_secret="fake")
+
+    with mock.patch("requests.Session.get", side_effect=mocked_requests_get) as mock_get:
+        runs = datahub.get_runs_model_id(model_id="mo-uk")
+        assert datahub.get_runs_model_id(model_id="mo-uk") == runs
+
+    assert mock_get.call_count == 1
+
+
+def test_response_cache_revalidate(tmp_path):
+    response_cache = ResponseCache(cache_dir=str(tmp_path), ttls={"runs": 0})
+    datahub = BaseMetOfficeDataHub(
+        client_id="fake", client_secret="fake", response_cache=response_cache
+    )
+
+    def side_effect(*args, **kwargs):
+        response = mocked_requests_get(*args, **kwargs)
+        response.headers["ETag"] = '"v1"'
+        if kwargs["headers"].get("If-None-Match") == '"v1"':
+            response.status_code = 304
+            response.json_data = None
+        return response
+
+    with mock.patch("requests.Session.get", side_effect=side_effect) as mock_get:
+        runs = datahub.get_runs_model_id(model_id="mo-uk")
+
+        # a new instance uses the responses saved on disk
+        datahub.response_cache = ResponseCache(cache_dir=str(tmp_path), ttls={"runs": 0})
+        assert datahub.get_runs_model_id(model_id="mo-uk") == runs
+
+    assert mock_get.call_count == 2
+    assert mock_get.call_args.kwargs["headers"]["If-None-Match"] == '"v1"'
+
+
+def test_response_cache_revalidate_keeps_etag():
+    response_cache = ResponseCache(cache_dir=None, ttls={"runs": 0})
+    datahub = BaseMetOfficeDataHub(
+        client_id="fake", client_secret="fake", response_cache=response_cache
+    )
+
+    def side_effect(*args, **kwargs):
+        response = mocked_requests_get(*args, **kwargs)
+        if kwargs["headers"].get("If-None-Match") == '"v1"':
+            # the 304 response does not send the ETag again
+            response.status_code = 304
+            response.json_data = None
+        else:
+            response.headers["ETag"] = '"v1"'
+        return response
+
+    with mock.patch("requests.Session.get", side_effect=side_effect) as mock_get:
+        runs = datahub.get_runs_model_id(model_id="mo-uk")
+        assert datahub.get_runs_model_id(model_id="mo-uk") == runs
+        assert datahub.get_runs_model_id(model_id="mo-uk") == runs
+
+    assert mock_get.call_count == 3
+    assert mock_get.call_args.kwargs["headers"]["If-None-Match"] == '"v1"'
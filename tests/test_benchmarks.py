@@ -0,0 +1,50 @@
+from benchmarks.run import compare
+from benchmarks.synthetic import make_grib_files, make_ukv_dataset
+from metofficedatahub.utils import NUM_COLS, NUM_ROWS
+
+
+def test_make_grib_files(metofficedatahub, tmp_path):
+    metofficedatahub.files = make_grib_files(folder=str(tmp_path), n_variables=2)
+
+    data = metofficedatahub.load_all_files()
+
+    assert list(data.variable.values) == ["t", "r"]
+    assert data.UKV.shape == (2, 1, 3, NUM_ROWS, NUM_COLS)
+
+
+def test_make_ukv_dataset():
+    dataset = make_ukv_dataset(n_steps=2, n_variables=3)
+
+    assert list(dataset.data_vars) == ["t", "r", "lcc"]
+    assert dataset.t.shape == (1, 2, 60, 65)
+
+
+def test_compare():
+    baseline = {
+        "small": {
+            "size": "small",
+            "results": {
+                "add_x_y": {"median": 1.0},
+                "post_process_dataset": {"median": 1.0},
+                "save_to_s3_netcdf": {"error": "failed"},
+            },
+        }
+    }
+    results = {
+        "size": "small",
+        "results": {
+            "add_x_y": {"median": 1.5},
+            "_chunk": {"median": 1.0},
+            "post_process_dataset": {"error": "failed"},
+            "save_to_s3_netcdf": {"median": 1.0},
+        },
+    }
+
+    comparison = compare(results=results, baseline=baseline)
+
+    assert comparison == {
+        "ratios": {"add_x_y": 1.5},
+        "regressions": ["add_x_y"],
+        "missing": ["_chunk", "save_to_s3_netcdf"],
+        "failed": ["post_process_dataset"],
+    }
@@ -0,0 +1,179 @@
+import hashlib
+import json
+import os
+from datetime import datetime, timezone
+from unittest import mock
+
+import fsspec
+
+from metofficedatahub.cache import DownloadCache, StagingCache
+from tests.conftest import MockDataResponse
+
+
+def test_download_cache_from_listing(tmp_path):
+    (tmp_path / "order_file_1.grib").write_bytes(b"1234")
+    (tmp_path / "order_file_2.grib.part").write_bytes(b"12")
+
+    download_cache = DownloadCache(cache_dir=str(tmp_path), fs=fsspec.filesystem("file"))
+
+    assert download_cache.contains(f"{tmp_path}/order_file_1.grib")
+    assert not download_cache.contains(f"{tmp_path}/order_file_2.grib")
+    assert download_cache.entries["order_file_1.grib"]["size"] == 4
+
+
+def test_download_cache_save_load_evict(tmp_path):
+    fs = fsspec.filesystem("file")
+    download_cache = DownloadCache(cache_dir=str(tmp_path), fs=fs)
+    for hour in [0, 6]:
+        filename = f"{tmp_path}/order_file_{hour}.grib"
+        (tmp_path / f"order_file_{hour}.grib").write_bytes(b"1234")
+        download_cache.add(
+            filename=filename,
+            size=4,
+            checksum="abc",
+            file_id=f"file_{hour}",
+            run_datetime=datetime(2022, 1, 1, hour, tzinfo=timezone.utc),
+        )
+    download_cache.save()
+
+    # load the manifest in a new index
+    download_cache = DownloadCache(cache_dir=str(tmp_path), fs=fs)
+    download_cache.load()
+    assert download_cache.entries["order_file_6.grib"]["fileId"] == "file_6"
+
+    removed = download_cache.evict(older_than=datetime(2022, 1, 1, 3, tzinfo=timezone.utc))
+    assert removed == [f"{tmp_path}/order_file_0.grib"]
+    assert not (tmp_path / "order_file_0.grib").exists()
+    assert (tmp_path / "order_file_6.grib").exists()
+
+    with open(tmp_path / "manifest.json") as f:
+        assert list(json.load(f).keys()) == ["order_file_6.grib"]
+
+
+def test_download_cache_load_checks_files(tmp_path):
+    fs = fsspec.filesystem("file")
+    download_cache = DownloadCache(cache_dir=str(tmp_path), fs=fs)
+    for name in ["kept", "removed", "truncated"]:
+        (tmp_path / f"order_{name}.grib").write_bytes(b"1234")
+        download_cache.add(filename=f"{tmp_path}/order_{name}.grib", size=4)
+    download_cache.save()
+
+    # the files are changed by another process
+    (tmp_path / "order_removed.grib").unlink()
+    (tmp_path / "order_truncated.grib").write_bytes(b"12")
+
+    download_cache = DownloadCache(cache_dir=str(tmp_path), fs=fs)
+    with mock.patch.object(fs, "ls", wraps=fs.ls) as mock_ls:
+        download_cache.load()
+
+    assert mock_ls.call_count == 1
+    assert list(download_cache.entries.keys()) == ["order_kept.grib"]
+
+
+def test_download_cache_no_remote_calls(basemetofficedatahub, tmp_path):
+    """Check that a cached file is not checked on the filesystem, or downloaded again"""
+    basemetofficedatahub.cache_dir = str(tmp_path)
+    data = b"grib data"
+
+    with mock.patch("requests.Session.get", return_value=MockDataResponse(data)) as mock_get:
+        filename = basemetofficedatahub.get_latest_order_file_id_data(
+            order_id="test_order_id", file_id="agl_temperature_00"
+        )
+        with mock.patch.object(basemetofficedatahub.download_cache.fs, "exists") as mock_exists:
+            basemetofficedatahub.get_latest_order_file_id_data(
+                order_id="test_order_id", file_id="agl_temperature_00"
+            )
+
+    assert mock_get.call_count == 1
+    assert mock_exists.call_count == 0
+    entry = basemetofficedatahub.download_cache.entries[filename.split("/")[-1]]
+    assert entry["checksum"] == hashlib.md5(data).hexdigest()
+    assert entry["size"] == len(data)
+
+
+def test_staging_cache_local_file(tmp_path):
+    (tmp_path / "file.grib").write_bytes(b"1234")
+    staging_cache = StagingCache(staging_dir=str(tmp_path / "staging"))
+
+    assert staging_cache.get_local_filename(f"{tmp_path}/file.grib") == f"{tmp_path}/file.grib"
+    assert not (tmp_path / "staging").exists()
+
+
+def test_staging_cache_remote_file(tmp_path):
+    fs = fsspec.filesystem("memory")
+    fs.pipe("/staging_test/file.grib", b"1234")
+    staging_cache = StagingCache(staging_dir=str(tmp_path))
+
+    local_filename = staging_cache.get_local_filename("memory://staging_test/file.grib")
+    assert local_filename == f"{tmp_path}/file.grib"
+    assert (tmp_path / "file.grib").read_bytes() == b"1234"
+
+    # the second time, the file is not copied again
+    with mock.patch.object(type(fs), "get") as mock_get:
+        assert staging_cache.get_local_filename("memory://staging_test/file.grib") == local_filename
+        mock_get.assert_not_called()
+
+
+def test_staging_cache_fsspec_cache(tmp_path):
+    fs = fsspec.filesystem("memory")
+    fs.pipe("/staging_test/file_fsspec.grib", b"1234")
+    staging_cache = StagingCache(staging_dir=str(tmp_path), use_fsspec_cache=True)
+
+    local_filename = staging_cache.get_local_filename("memory://staging_test/file_fsspec.grib")
+    assert local_filename.startswith(str(tmp_path))
+    with open(local_filename, "rb") as f:
+        assert f.read() == b"1234"
+
+
+def test_staging_cache_fsspec_cache_not_evicted(tmp_path):
+    fs = fsspec.filesystem("memory")
+    fs.pipe("/staging_test/file_fsspec_1.grib", b"1234")
+    fs.pipe("/staging_test/file_fsspec_2.grib", b"5678")
+    staging_cache = StagingCache(staging_dir=str(tmp_path), max_size_bytes=1, use_fsspec_cache=True)
+
+    local_filename_1 = staging_cache.get_local_filename("memory://staging_test/file_fsspec_1.grib")
+    staging_cache.get_local_filename("memory://staging_test/file_fsspec_2.grib")
+
+    # the copies and the metadata of fsspec are kept in their own directory, and not evicted
+    assert os.path.exists(local_filename_1)
+    assert os.path.exists(f"{tmp_path}/filecache/cache")
+    assert list(tmp_path.iterdir()) == [tmp_path / "filecache"]
+
+
+def test_staging_cache_evict(tmp_path):
+    staging_cache = StagingCache(staging_dir=str(tmp_path), max_size_bytes=10)
+    for i in range(3):
+        (tmp_path / f"file_{i}.grib").write_bytes(b"1234")
+        os.utime(tmp_path / f"file_{i}.grib", (i, i))
+
+    # file_0 is the least recently used, but is kept
+    removed = staging_cache.evict(keep=f"{tmp_path}/file_0.grib")
+
+    assert removed == [f"{tmp_path}/file_1.grib"]
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["file_0.grib", "file_2.grib"]
+
+
+def test_staging_cache_indexpath(tmp_path):
+    staging_cache = StagingCache(staging_dir=str(tmp_path), index_dir=str(tmp_path / "index"))
+
+    indexpath = staging_cache.get_indexpath(f"{tmp_path}/file.grib")
+    assert indexpath.startswith(f"{tmp_path}/index/file.grib.")
+    assert indexpath.endswith(".{short_hash}.idx")
+    assert indexpath != staging_cache.get_indexpath(f"{tmp_path}/other/file.grib")
+
+    assert StagingCache(index_dir=None).get_indexpath("file.grib") == ""
+
+
+def test_staging_cache_evict_index(tmp_path):
+    staging_cache = StagingCache(
+        staging_dir=str(tmp_path / "staging"), max_size_bytes=0, index_dir=str(tmp_path / "index")
+    )
+    (tmp_path / "staging").mkdir()
+    (tmp_path / "staging" / "file.grib").write_bytes(b"1234")
+    indexpath = staging_cache.get_indexpath(f"{tmp_path}/staging/file.grib")
+    with open(indexpath.format(short_hash="abcde"), "wb") as f:
+        f.write(b"1234")
+
+    staging_cache.evict()
+
+    assert list((tmp_path / "index").iterdir()) == []
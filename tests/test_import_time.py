@@ -0,0 +1,66 @@
+"""Importing the client and the cli should not import the heavy dependencies"""
+import os
+import subprocess
+import sys
+
+import pytest
+
+# the modules that are only imported when they are used
+HEAVY_MODULES = [
+    "cfgrib",
+    "dask",
+    "eccodes",
+    "nowcasting_datamodel",
+    "ocf_blosc2",
+    "pandas",
+    "pyproj",
+    "scipy.spatial",
+    "xarray",
+]
+
+# the import time, in seconds, of each module. This was about 0.15 s for metofficedatahub.base,
+# and 0.25 s for metofficedatahub.app, compared to 1.5 s before the heavy imports were deferred.
+# Wall clock times depend on the machine, so these are only checked if IMPORT_TIME_BUDGET=1.
+IMPORT_TIME_BUDGET = os.getenv("IMPORT_TIME_BUDGET", "0") == "1"
+IMPORT_TIME_BUDGET_SECONDS = {
+    "metofficedatahub.base": 0.5,
+    "metofficedatahub.app": 0.75,
+}
+
+CHECK_IMPORTED = """
+import sys
+import {module}
+
+for name in {heavy_modules}:
+    # a lazy module is in sys.modules, but is only loaded when it is used
+    if name in sys.modules and type(sys.modules[name]).__name__ != "_LazyModule":
+        print(name)
+"""
+
+
+def _run(*args) -> subprocess.CompletedProcess:
+    return subprocess.run(
+        [sys.executable, *args], capture_output=True, text=True, check=True, timeout=60
+    )
+
+
+@pytest.mark.parametrize("module", list(IMPORT_TIME_BUDGET_SECONDS))
+def test_heavy_modules_not_imported(module):
+    code = CHECK_IMPORTED.format(module=module, heavy_modules=HEAVY_MODULES)
+    imported = _run("-c", code).stdout.split()
+    assert imported == []
+
+
+@pytest.mark.skipif(not IMPORT_TIME_BUDGET, reason="set IMPORT_TIME_BUDGET=1 to check")
+@pytest.mark.parametrize("module", list(IMPORT_TIME_BUDGET_SECONDS))
+def test_import_time_budget(module):
+    # the last line of -X importtime is the module itself, with the cumulative time in us
+    stderr = _run("-X", "importtime", "-c", f"import {module}").stderr
+    line = [line for line in stderr.splitlines() if line.endswith(f" {module}")][-1]
+    import_time = int(line.split("|")[1]) / 1e6
+
+    assert import_time < IMPORT_TIME_BUDGET_SECONDS[module]
+
+
+def test_cli_help():
+    assert "--api-key" in _run("-m", "metofficedatahub.app", "--help").stdout
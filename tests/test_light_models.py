@@ -0,0 +1,66 @@
+import json
+from datetime import datetime, timezone
+
+import pytest
+
+from metofficedatahub.light_models import LightFile, parse_order_details
+from metofficedatahub.models import File, OrderDetails
+
+
+@pytest.fixture
+def order_details_json():
+    with open("tests/data/order_details.json") as json_file:
+        data = json.load(json_file)["orderDetails"]
+
+    # add some more files, including ones from other runs
+    for hour in range(3):
+        data["files"].append(
+            {
+                "fileId": f"agl_temperature_2022010{hour}",
+                "runDateTime": f"2022-01-0{hour + 1}T0{hour}:00:00Z",
+                "run": str(hour),
+                "timesteps": ["0", "1"],
+            }
+        )
+    return data
+
+
+def test_parse_order_details(order_details_json):
+    order_details = parse_order_details(order_details_json)
+
+    assert order_details.to_model() == OrderDetails(**order_details_json)
+    assert order_details.files[-1].runDateTime == datetime(2022, 1, 3, 2, tzinfo=timezone.utc)
+    assert order_details.files[-1].timesteps == [0, 1]
+
+
+def test_parse_order_details_fields(order_details_json):
+    order_details = parse_order_details(order_details_json, fields=["runDateTime"])
+
+    file = order_details.files[0]
+    assert file.fileId == "agl_temperature_00"
+    assert file.runDateTime is not None
+    assert file.run is None
+    assert file.timesteps is None
+
+    # the files can be used like the pydantic model
+    file.local_filename = "test.grib"
+    assert not hasattr(file, "__dict__")
+
+
+def test_parse_order_details_unknown_field(order_details_json):
+    with pytest.raises(ValueError):
+        parse_order_details(order_details_json, fields=["size"])
+
+
+def test_light_file_to_model():
+    file = LightFile(fileId="agl_t_0", runDateTime=datetime(2022, 1, 1), run=0)
+    assert file.to_model() == File(fileId="agl_t_0", runDateTime=datetime(2022, 1, 1), run=0)
+
+
+def test_light_file_copy():
+    file = LightFile(fileId="agl_t_0", local_filename="a.grib")
+    copy = file.copy(update={"local_filename": "b.grib"})
+
+    assert copy.fileId == "agl_t_0"
+    assert copy.local_filename == "b.grib"
+    assert file.local_filename == "a.grib"
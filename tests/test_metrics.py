@@ -0,0 +1,81 @@
+import json
+import subprocess
+import sys
+import time
+
+from metofficedatahub.metrics import PipelineMetrics
+
+
+def test_stage():
+    metrics = PipelineMetrics()
+
+    for _ in range(2):
+        with metrics.stage("download") as stage_metrics:
+            time.sleep(0.01)
+            stage_metrics.add(bytes_in=10, files=1)
+
+    download = metrics.stages["download"]
+    assert download.wall_seconds >= 0.02
+    assert download.cpu_seconds >= 0
+    assert download.peak_rss_bytes > 0
+    assert download.bytes_in == 20
+    assert download.files == 2
+
+
+def test_stage_peak_rss():
+    metrics = PipelineMetrics(rss_interval=0.01)
+    size = 200 * 1024**2
+
+    with metrics.stage("decode"):
+        data = b"1" * size
+        time.sleep(0.1)
+        del data
+    with metrics.stage("save"):
+        time.sleep(0.1)
+
+    # the memory is sampled during each stage, not the peak of the process so far
+    assert metrics.stages["decode"].peak_rss_bytes > size
+    assert (
+        metrics.stages["save"].peak_rss_bytes < metrics.stages["decode"].peak_rss_bytes - size / 2
+    )
+
+
+def test_stage_peak_rss_children():
+    metrics = PipelineMetrics(rss_interval=0.01)
+    size = 200 * 1024**2
+
+    with metrics.stage("decode"):
+        code = f"import time; data = b'1' * {size}; time.sleep(0.5)"
+        subprocess.run([sys.executable, "-c", code], check=True)
+
+    assert metrics.stages["decode"].peak_rss_bytes > size
+
+
+def test_stage_disabled(tmp_path):
+    metrics = PipelineMetrics(enabled=False)
+
+    with metrics.stage("download") as stage_metrics:
+        stage_metrics.add(bytes_in=10, files=1)
+
+    assert metrics.stages == {}
+    assert stage_metrics.bytes_in == 0
+
+    metrics.save_json(f"{tmp_path}/metrics.json")
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_save(tmp_path):
+    metrics = PipelineMetrics()
+    with metrics.stage("save") as stage_metrics:
+        stage_metrics.add(bytes_out=100, files=3)
+
+    metrics.save_json(f"{tmp_path}/metrics.json")
+    with open(tmp_path / "metrics.json") as f:
+        report = json.load(f)
+    assert report["stages"]["save"]["bytes_out"] == 100
+
+    metrics.save_prometheus(f"{tmp_path}/metrics.prom")
+    lines = (tmp_path / "metrics.prom").read_text().splitlines()
+    assert "# TYPE metofficedatahub_stage_files gauge" in lines
+    assert 'metofficedatahub_stage_files{stage="save"} 3' in lines
+    assert not (tmp_path / "metrics.prom.part").exists()
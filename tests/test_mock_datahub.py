@@ -0,0 +1,84 @@
+import filecmp
+
+import pytest
+
+from benchmarks.mock_datahub import MockDataHubServer
+from benchmarks.synthetic import make_grib_files
+from metofficedatahub.metrics import PipelineMetrics
+from metofficedatahub.multiple_files import MetOfficeDataHub
+
+
+@pytest.fixture
+def grib_files(tmp_path):
+    return make_grib_files(folder=str(tmp_path / "source"), n_variables=4)
+
+
+def make_datahub(server, cache_dir):
+    return MetOfficeDataHub(
+        client_id="fake",
+        client_secret="fake",
+        base_url=server.base_url,
+        cache_dir=str(cache_dir),
+        backoff_factor=0,
+    )
+
+
+def test_metadata(grib_files, tmp_path):
+    with MockDataHubServer(files=grib_files) as server:
+        datahub = make_datahub(server, tmp_path / "raw")
+
+        assert datahub.get_orders().orders[0].orderId == server.order_id
+        runs = datahub.get_runs_model_id(model_id=server.model_id)
+        run_datetime = runs.completeRuns[0].runDateTime
+        assert run_datetime.replace(tzinfo=None) == grib_files[0].runDateTime
+        file_details = datahub.get_latest_order_file_id(
+            order_id=server.order_id, file_id=grib_files[0].fileId
+        )
+        assert file_details.file.fileId == grib_files[0].fileId
+
+
+def test_download_all_files_with_errors(grib_files, tmp_path):
+    with MockDataHubServer(files=grib_files, latency=0.01, error_rate=0.3) as server:
+        datahub = make_datahub(server, tmp_path / "raw")
+        datahub.download_all_files(order_ids=[server.order_id], max_workers=4)
+
+    assert server.injected["503"] > 0
+    assert len(datahub.files) == len(grib_files)
+    for source, downloaded in zip(grib_files, datahub.files):
+        assert filecmp.cmp(source.local_filename, downloaded.local_filename, shallow=False)
+
+
+def test_download_dropped_connection_resumes(grib_files, tmp_path):
+    with MockDataHubServer(files=grib_files[:1], drop_rate=1) as server:
+        datahub = make_datahub(server, tmp_path / "raw")
+        with pytest.raises(Exception):
+            datahub.download_all_files(order_ids=[server.order_id])
+
+        # the second time, the rest of the file is downloaded
+        server.drop_rate = 0
+        datahub.download_all_files(order_ids=[server.order_id])
+        assert datahub.download_errors == {}
+
+    assert filecmp.cmp(grib_files[0].local_filename, datahub.files[0].local_filename, shallow=False)
+
+
+def test_download_all_files_too_many_requests(grib_files, tmp_path):
+    metrics = PipelineMetrics()
+    with MockDataHubServer(
+        files=grib_files, too_many_requests_rate=0.3, retry_after=0.05
+    ) as server:
+        datahub = MetOfficeDataHub(
+            client_id="fake",
+            client_secret="fake",
+            base_url=server.base_url,
+            cache_dir=str(tmp_path / "raw"),
+            backoff_factor=0,
+            max_retries=10,
+            metrics=metrics,
+        )
+        datahub.download_all_files(order_ids=[server.order_id], max_workers=4)
+
+    assert server.injected["429"] > 0
+    assert len(datahub.files) == len(grib_files)
+    assert datahub.rate_limiter.too_many_requests == server.injected["429"]
+    assert metrics.stages["download"].throttled_seconds > 0
@@ -1,16 +1,29 @@
+import logging
 import os
+import shutil
 import tempfile
 from datetime import datetime
 from unittest import mock
 
+import numpy as np
+import pytest
 import xarray as xr
 from freezegun import freeze_time
 
-from metofficedatahub.multiple_files import save
+from metofficedatahub.metrics import PipelineMetrics
+from metofficedatahub.models import File, OrderDetails, OrderInfo
+from metofficedatahub.multiple_files import (
+    _assemble_datasets,
+    _get_number_of_workers,
+    _merge_datasets,
+    save,
+    save_to_s3,
+    save_to_zarr_archive,
+)
 from tests.conftest import mocked_requests_get
 
 
-@mock.patch("requests.get", side_effect=mocked_requests_get)
+@mock.patch("requests.Session.get", side_effect=mocked_requests_get)
 def test_download_all_none(mock_get, metofficedatahub):
     """Check that if there are no order ids, then no data is downloaded"""
     with tempfile.TemporaryDirectory() as tmpdirname:
@@ -21,24 +34,24 @@ def test_download_all_none(mock_get, metofficedatahub):
         assert len(metofficedatahub.files) == 0
 
 
-@mock.patch("requests.get", side_effect=mocked_requests_get)
+@mock.patch("requests.Session.get", side_effect=mocked_requests_get)
 def test_download_all(mock_get, metofficedatahub):
     """Check that if there are order ids, then their data is downloaded"""
     with tempfile.TemporaryDirectory() as tmpdirname:
         metofficedatahub.cache_dir = tmpdirname
-        metofficedatahub.download_all_files(order_ids=["test_order_id"])
+        metofficedatahub.download_all_files(order_ids=["test_order_id"], hours_in_past=None)
 
         assert len(metofficedatahub.files) > 0
         for file in metofficedatahub.files:
             assert os.path.exists(file.local_filename)
 
 
-@mock.patch("requests.get", side_effect=mocked_requests_get)
+@mock.patch("requests.Session.get", side_effect=mocked_requests_get)
 def test_download_repeat(mock_get, metofficedatahub):
     """Check that files are not downloaded again"""
     with tempfile.TemporaryDirectory() as tmpdirname:
         metofficedatahub.cache_dir = tmpdirname
-        metofficedatahub.download_all_files(order_ids=["test_order_id"])
+        metofficedatahub.download_all_files(order_ids=["test_order_id"], hours_in_past=None)
 
         assert len(metofficedatahub.files) > 0
         for file in metofficedatahub.files:
@@ -46,7 +59,7 @@ def test_download_repeat(mock_get, metofficedatahub):
 
         # downloaded for second time
         datetime_now = datetime.now()
-        metofficedatahub.download_all_files(order_ids=["test_order_id"])
+        metofficedatahub.download_all_files(order_ids=["test_order_id"], hours_in_past=None)
 
         # make sure the files arent downloaded again
         for file in metofficedatahub.files:
@@ -55,8 +68,85 @@ def test_download_repeat(mock_get, metofficedatahub):
             assert datetime.fromtimestamp(creation_time) < datetime_now
 
 
+def _make_order_details(file_ids):
+    return OrderDetails(
+        order=OrderInfo(orderId="test_order_id", name="test", modelId="mo-uk", format="GRIB2"),
+        files=[
+            File(fileId=file_id, runDateTime=datetime(2022, 1, 1), run=0) for file_id in file_ids
+        ],
+    )
+
+
+def test_download_all_concurrent_with_errors(metofficedatahub, tmp_path):
+    """Check that files are downloaded concurrently, and one failure does not stop the rest"""
+    metofficedatahub.cache_dir = str(tmp_path)
+    file_ids = [f"agl_temperature_20220101{i:02}" for i in range(8)] + ["agl_temperature_+00"]
+
+    def get_data(order_id, file_id, **kwargs):
+        if file_id.endswith("03"):
+            raise Exception("Failed download")
+        return f"{order_id}_{file_id}.grib"
+
+    metofficedatahub.get_lastest_order = lambda order_id, **kwargs: _make_order_details(file_ids)
+    metofficedatahub.get_latest_order_file_id_data = get_data
+
+    metofficedatahub.download_all_files(
+        order_ids=["test_order_id"], max_workers=4, hours_in_past=None
+    )
+
+    assert [file.fileId for file in metofficedatahub.files] == [
+        file_id for file_id in file_ids[:-1] if not file_id.endswith("03")
+    ]
+    for file in metofficedatahub.files:
+        assert file.local_filename == f"test_order_id_{file.fileId}.grib"
+    assert list(metofficedatahub.download_errors.keys()) == ["agl_temperature_2022010103"]
+
+
+@freeze_time("2022-01-01T12:00")
+def test_download_all_skip_old_runs(metofficedatahub, tmp_path):
+    """Check that files from old runs are not downloaded"""
+    metofficedatahub.cache_dir = str(tmp_path)
+    order_details = _make_order_details([])
+    for hour in [0, 6, 12]:
+        for file_id in [f"agl_temperature_20220101{hour:02}", "agl_temperature_+00"]:
+            order_details.files.append(
+                File(fileId=file_id, runDateTime=datetime(2022, 1, 1, hour), run=hour)
+            )
+
+    metofficedatahub.get_lastest_order = lambda order_id, **kwargs: order_details
+    metofficedatahub.get_latest_order_file_id_data = mock.Mock(return_value="file.grib")
+
+    metofficedatahub.download_all_files(order_ids=["test_order_id"])
+
+    assert [file.fileId for file in metofficedatahub.files] == [
+        "agl_temperature_2022010106",
+        "agl_temperature_2022010112",
+    ]
+    assert metofficedatahub.get_latest_order_file_id_data.call_count == 2
+    assert len(metofficedatahub.skipped_files) == 4
+    skipped_old = [f for f in metofficedatahub.skipped_files if "older" in f["reason"]]
+    assert [f["fileId"] for f in skipped_old] == ["agl_temperature_2022010100"]
+
+
+def test_download_all_concurrent_all_errors(metofficedatahub, tmp_path):
+    metofficedatahub.cache_dir = str(tmp_path)
+
+    def get_data(order_id, file_id, **kwargs):
+        raise Exception("Failed download")
+
+    metofficedatahub.get_lastest_order = lambda order_id, **kwargs: _make_order_details(
+        ["agl_temperature_2022010100"]
+    )
+    metofficedatahub.get_latest_order_file_id_data = get_data
+
+    with pytest.raises(Exception):
+        metofficedatahub.download_all_files(
+            order_ids=["test_order_id"], max_workers=4, hours_in_past=None
+        )
+
+
 @freeze_time("2022-01-01")
-@mock.patch("requests.get", side_effect=mocked_requests_get)
+@mock.patch("requests.Session.get", side_effect=mocked_requests_get)
 def test_load_all_files(mock_get, metofficedatahub):
     with tempfile.TemporaryDirectory() as tmpdirname:
         metofficedatahub.cache_dir = tmpdirname
@@ -67,12 +157,128 @@ def test_load_all_files(mock_get, metofficedatahub):
         assert len(data.data_vars) > 0
 
 
+@freeze_time("2022-01-01")
+@mock.patch("requests.Session.get", side_effect=mocked_requests_get)
+def test_load_all_files_processes(mock_get, metofficedatahub):
+    """Check loading files with a process pool gives the same as loading them one by one"""
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        metofficedatahub.cache_dir = tmpdirname
+
+        metofficedatahub.download_all_files(order_ids=["test_order_id"])
+
+        # make a second file for the next run, so there is more than one file to load
+        file = metofficedatahub.files[0]
+        next_file = file.copy()
+        next_file.local_filename = file.local_filename.replace(".grib", "_copy.grib")
+        shutil.copy(file.local_filename, next_file.local_filename)
+        metofficedatahub.files.append(next_file)
+
+        with mock.patch("os.cpu_count", return_value=2):
+            data_processes = metofficedatahub.load_all_files(max_workers=2)
+        data = metofficedatahub.load_all_files(max_workers=1)
+
+        xr.testing.assert_identical(data_processes.compute(), data.compute())
+
+
+@freeze_time("2022-01-01")
+@mock.patch("requests.Session.get", side_effect=mocked_requests_get)
+def test_load_all_files_lazy(mock_get, metofficedatahub):
+    """Check loading files lazily gives the same as loading them into memory"""
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        metofficedatahub.cache_dir = tmpdirname
+
+        metofficedatahub.download_all_files(order_ids=["test_order_id"])
+
+        data_lazy = metofficedatahub.load_all_files(lazy=True)
+        data = metofficedatahub.load_all_files(lazy=False)
+
+        assert data_lazy.UKV.chunks is not None
+        xr.testing.assert_identical(data_lazy.compute(), data.compute())
+
+
+@freeze_time("2022-01-01")
+@mock.patch("requests.Session.get", side_effect=mocked_requests_get)
+def test_load_all_files_index_and_filter(mock_get, metofficedatahub, tmp_path):
+    """Check the index files are kept in the index directory, and messages can be filtered"""
+    metofficedatahub.cache_dir = str(tmp_path / "raw")
+    metofficedatahub.download_all_files(order_ids=["test_order_id"])
+
+    data = metofficedatahub.load_all_files()
+    assert len(list((tmp_path / "index").glob("*.idx"))) > 0
+    assert list((tmp_path / "raw").glob("*.idx")) == []
+
+    data_filtered = metofficedatahub.load_all_files(
+        backend_kwargs={"temperature": {"filter_by_keys": {"shortName": "t"}}}
+    )
+    xr.testing.assert_identical(data_filtered.compute(), data.compute())
+
+
+@freeze_time("2022-01-01")
+@mock.patch("requests.Session.get", side_effect=mocked_requests_get)
+def test_load_all_files_metrics(mock_get, metofficedatahub, tmp_path, caplog):
+    metofficedatahub.cache_dir = str(tmp_path / "raw")
+    metofficedatahub.metrics = PipelineMetrics()
+
+    with caplog.at_level(logging.DEBUG, logger="metofficedatahub.metrics"):
+        metofficedatahub.download_all_files(order_ids=["test_order_id"])
+    # the bytes and files are added before the end of the stage, so they are in its log
+    assert "'files': 1" in caplog.text
+    metofficedatahub.load_all_files()
+
+    stages = metofficedatahub.metrics.to_dict()
+    assert list(stages) == ["download", "decode", "merge", "regrid", "post_process"]
+    assert stages["download"]["files"] == 1
+    assert stages["download"]["bytes_in"] == os.path.getsize("tests/data/test_00.grib")
+    assert stages["decode"]["bytes_in"] == stages["download"]["bytes_in"]
+    assert stages["regrid"]["bytes_out"] > 0
+
+    # the files already in the download cache are not counted
+    metofficedatahub.metrics = PipelineMetrics()
+    metofficedatahub.download_all_files(order_ids=["test_order_id"])
+    assert metofficedatahub.metrics.stages["download"].files == 0
+    assert metofficedatahub.metrics.stages["download"].bytes_in == 0
+
+
+def test_assemble_datasets(ukv_dataset):
+    """Check assembling the datasets gives the same as merging them"""
+    all_datasets_per_filename = {}
+    for hour, steps in [(3, [0, 1, 2]), (0, [0, 1]), (6, [1, 2])]:
+        dataset = ukv_dataset.isel(time=0, step=steps)
+        dataset = dataset.assign_coords(time=dataset.time + np.timedelta64(hour, "h"))
+        for variable in ["t", "lcc"]:
+            all_datasets_per_filename.setdefault(variable, []).append(dataset[[variable]])
+
+    datasets = [d for datasets in all_datasets_per_filename.values() for d in datasets]
+    assembled = _assemble_datasets(datasets)
+    merged = _merge_datasets(all_datasets_per_filename)
+
+    assert assembled.t.dtype == np.float32
+    assert np.isnan(assembled.t.isel(time=0, step=2)).all()
+    xr.testing.assert_identical(assembled, merged)
+
+
+def test_get_number_of_workers(tmp_path):
+    files = []
+    for i in range(4):
+        local_filename = f"{tmp_path}/{i}.grib"
+        with open(local_filename, "wb") as f:
+            f.write(b"0" * 100)
+        files.append(File(fileId=f"agl_t_{i}", runDateTime=datetime(2022, 1, 1), run=0))
+        files[-1].local_filename = local_filename
+
+    assert _get_number_of_workers(max_workers=1, files=files) == 1
+    assert 1 <= _get_number_of_workers(max_workers=2, files=files) <= 2
+    assert _get_number_of_workers(max_workers=8, files=files[:1]) == 1
+
+
 def test_save(met_office_all_files, tmp_path):
     # Our fixture is small using the default `ideal_chunk_size` would make only one chunk.
     save(met_office_all_files, save_dir=tmp_path, ideal_chunk_size_mb=1 / 1024)
 
     # Make sure the 2 latest files have been created.
     assert os.path.exists(f"{tmp_path}/latest.netcdf")
+    netcdf = xr.open_dataset(f"{tmp_path}/latest.netcdf", engine="h5netcdf")
+    xr.testing.assert_equal(netcdf.UKV, met_office_all_files.UKV)
     zarr_path = f"{tmp_path}/latest.zarr"
     assert os.path.exists(zarr_path)
 
@@ -81,3 +287,156 @@ def test_save(met_office_all_files, tmp_path):
     # represent the files.
     ds = xr.open_dataset(zarr_path, chunks="auto", engine="zarr")
     assert ds.chunks == dict(variable=(1,), init_time=(1,), step=(13,), y=(10,), x=(10,))
+
+
+@pytest.mark.parametrize("dtype", ["float32", "float64"])
+def test_save_to_s3_zarr_odd_chunk(tmp_path, dtype):
+    """A chunk with an odd number of float32 values is not a whole number of 8 byte items"""
+    # importing ocf_blosc2 registers the Blosc2 codec, which is needed to read the zarr file
+    import ocf_blosc2  # noqa: F401
+
+    shape = (1, 3, 1, 5, 5)
+    dataset = xr.Dataset(
+        {
+            "UKV": (
+                ("init_time", "step", "variable", "y", "x"),
+                np.arange(np.prod(shape), dtype=dtype).reshape(shape),
+            )
+        },
+        coords={"init_time": [np.datetime64("2022-01-01", "ns")]},
+    ).chunk()
+
+    save_to_s3(dataset, f"{tmp_path}/data.zarr")
+
+    saved = xr.open_zarr(f"{tmp_path}/data.zarr")
+    assert saved.UKV.dtype == dtype
+    xr.testing.assert_equal(saved.UKV.compute(), dataset.UKV.compute())
+
+
+def test_save_netcdf_written_once(met_office_all_files, tmp_path):
+    """Check the netcdf is only serialised once, and latest.netcdf is a copy of it"""
+
+    def mocked_save_to_s3(dataset, path):
+        if path.endswith(".netcdf"):
+            with open(path, "wb") as f:
+                f.write(b"netcdf")
+        else:
+            save_to_s3(dataset, path)
+
+    with mock.patch(
+        "metofficedatahub.multiple_files.save_to_s3", side_effect=mocked_save_to_s3
+    ) as mock_save:
+        save(met_office_all_files, save_dir=str(tmp_path), ideal_chunk_size_mb=1 / 1024)
+
+    saved_paths = [call.args[1] for call in mock_save.call_args_list]
+    assert len([path for path in saved_paths if path.endswith(".netcdf")]) == 1
+    assert f"{tmp_path}/latest.netcdf" not in saved_paths
+
+    with open(f"{tmp_path}/latest.netcdf", "rb") as f:
+        assert f.read() == b"netcdf"
+    assert os.path.exists(f"{tmp_path}/2022-01-25T06:00:00+00:00.netcdf")
+    assert os.path.exists(f"{tmp_path}/latest.zarr")
+
+
+def test_save_lazy_computes_once(met_office_all_files, tmp_path):
+    """Check the data of a lazy dataset is only computed once, for all the targets"""
+    computed = []
+
+    def count(block):
+        # map_blocks also calls this on an empty block, to find the type of the result
+        if block.size > 0:
+            computed.append(block.shape)
+        return block
+
+    dataset = met_office_all_files.chunk()
+    dataset["UKV"] = dataset["UKV"].map_blocks(count)
+
+    def mocked_save_to_s3(dataset, path):
+        if path.endswith(".netcdf"):
+            dataset.load()
+            with open(path, "wb") as f:
+                f.write(b"netcdf")
+        else:
+            save_to_s3(dataset, path)
+
+    with mock.patch("metofficedatahub.multiple_files.save_to_s3", side_effect=mocked_save_to_s3):
+        save(
+            dataset,
+            save_dir=str(tmp_path),
+            ideal_chunk_size_mb=1 / 1024,
+            archive_path=f"{tmp_path}/archive.zarr",
+        )
+
+    assert len(computed) == 1
+    xr.testing.assert_equal(xr.open_zarr(f"{tmp_path}/archive.zarr").UKV, met_office_all_files.UKV)
+    xr.testing.assert_equal(xr.open_zarr(f"{tmp_path}/latest.zarr").UKV, met_office_all_files.UKV)
+
+
+def test_save_to_zarr_archive(met_office_all_files, tmp_path):
+    archive_path = f"{tmp_path}/archive.zarr"
+    init_time = met_office_all_files.init_time.values[0]
+
+    save_to_zarr_archive(met_office_all_files, archive_path, ideal_chunk_size_mb=1 / 1024)
+    chunks = xr.open_zarr(archive_path).UKV.encoding["chunks"]
+
+    # append the next run, and the same run again which should not be added twice
+    for hours in [3, 3, 6]:
+        next_run = met_office_all_files.assign_coords(
+            init_time=[init_time + np.timedelta64(hours, "h")]
+        )
+        save_to_zarr_archive(next_run, archive_path, ideal_chunk_size_mb=1 / 1024)
+
+    ds = xr.open_zarr(archive_path)
+    assert len(ds.init_time) == 3
+    assert ds.UKV.encoding["chunks"] == chunks
+    xr.testing.assert_allclose(
+        ds.UKV.isel(init_time=[0]).compute(), met_office_all_files.UKV.transpose(*ds.UKV.dims)
+    )
+
+    # only keep the last 4 hours of runs, once 2 runs have expired
+    save_to_zarr_archive(next_run, archive_path, retention_hours=1, prune_batch=3)
+    assert len(xr.open_zarr(archive_path).init_time) == 3
+    save_to_zarr_archive(next_run, archive_path, retention_hours=4, prune_batch=1)
+    ds = xr.open_zarr(archive_path)
+    assert len(ds.init_time) == 2
+    assert ds.init_time.values[0] == init_time + np.timedelta64(3, "h")
+    assert sorted(os.listdir(tmp_path)) == ["archive.zarr"]
+
+
+def test_save_to_zarr_archive_recover(met_office_all_files, tmp_path):
+    """If the archive was being replaced when the process stopped, the old one is put back"""
+    archive_path = f"{tmp_path}/archive.zarr"
+    save_to_zarr_archive(met_office_all_files, archive_path)
+    shutil.move(archive_path, f"{tmp_path}/archive_old.zarr")
+
+    next_run = met_office_all_files.assign_coords(
+        init_time=met_office_all_files.init_time.values + np.timedelta64(3, "h")
+    )
+    save_to_zarr_archive(next_run, archive_path)
+
+    assert len(xr.open_zarr(archive_path).init_time) == 2
+    assert sorted(os.listdir(tmp_path)) == ["archive.zarr"]
+
+
+@pytest.mark.parametrize(
+    "change",
+    [
+        lambda ds: ds.assign_coords(x=ds.x + 2_000),
+        lambda ds: ds.isel(step=slice(0, 2)),
+        lambda ds: ds.assign_coords(variable=["other"]),
+    ],
+)
+def test_save_to_zarr_archive_different_coords(met_office_all_files, tmp_path, change):
+    archive_path = f"{tmp_path}/archive.zarr"
+    init_time = met_office_all_files.init_time.values[0]
+    save_to_zarr_archive(met_office_all_files, archive_path)
+
+    next_run = change(met_office_all_files).assign_coords(
+        init_time=[init_time + np.timedelta64(3, "h")]
+    )
+    with pytest.raises(ValueError):
+        save_to_zarr_archive(next_run, archive_path)
+
+    ds = xr.open_zarr(archive_path)
+    assert len(ds.init_time) == 1
+    xr.testing.assert_equal(ds.x, met_office_all_files.x)
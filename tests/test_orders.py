@@ -2,22 +2,34 @@ import os
 import tempfile
 from unittest import mock
 
-from tests.conftest import mocked_requests_get
+import pytest
 
+from tests.conftest import MockDataResponse, mocked_requests_get
 
-@mock.patch("requests.get", side_effect=mocked_requests_get)
+
+@mock.patch("requests.Session.get", side_effect=mocked_requests_get)
 def test_get_orders(mock_get, basemetofficedatahub):
     basemetofficedatahub.get_orders()
 
 
-@mock.patch("requests.get", side_effect=mocked_requests_get)
+@mock.patch("requests.Session.get", side_effect=mocked_requests_get)
 def test_latest_order(mock_get, basemetofficedatahub):
     order_id = "test_order_id"
 
     basemetofficedatahub.get_lastest_order(order_id=order_id)
 
 
-@mock.patch("requests.get", side_effect=mocked_requests_get)
+@mock.patch("requests.Session.get", side_effect=mocked_requests_get)
+def test_latest_order_lite(mock_get, basemetofficedatahub):
+    order_id = "test_order_id"
+
+    order_details = basemetofficedatahub.get_lastest_order(order_id=order_id)
+    light_order_details = basemetofficedatahub.get_lastest_order(order_id=order_id, lite=True)
+
+    assert light_order_details.to_model() == order_details
+
+
+@mock.patch("requests.Session.get", side_effect=mocked_requests_get)
 def test_latest_order_file_id(mock_get, basemetofficedatahub):
     order_id = "test_order_id"
     file_id = "agl_temperature_00"
@@ -25,7 +37,7 @@ def test_latest_order_file_id(mock_get, basemetofficedatahub):
     basemetofficedatahub.get_latest_order_file_id(order_id=order_id, file_id=file_id)
 
 
-@mock.patch("requests.get", side_effect=mocked_requests_get)
+@mock.patch("requests.Session.get", side_effect=mocked_requests_get)
 def test_latest_order_file_id_data(mock_get, basemetofficedatahub):
     order_id = "test_order_id"
     file_id = "agl_temperature_00"
@@ -36,3 +48,57 @@ def test_latest_order_file_id_data(mock_get, basemetofficedatahub):
             order_id=order_id, file_id=file_id
         )
         assert os.path.exists(filename)
+
+
+def test_latest_order_file_id_data_resume(basemetofficedatahub):
+    """Check a partial download is resumed with a range request"""
+    order_id = "test_order_id"
+    file_id = "agl_temperature_00"
+    data = bytes(range(256)) * 10
+
+    def mocked_range_get(*args, **kwargs):
+        start = int(kwargs["headers"]["Range"].split("=")[1].rstrip("-"))
+        return MockDataResponse(
+            content=data[start:],
+            status_code=206,
+            headers={
+                "Content-Length": str(len(data) - start),
+                "Content-Range": f"bytes {start}-{len(data) - 1}/{len(data)}",
+            },
+        )
+
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        basemetofficedatahub.cache_dir = tmpdirname
+        with open(f"{tmpdirname}/{order_id}_{file_id}.grib.part", "wb") as f:
+            f.write(data[:1000])
+
+        with mock.patch("requests.Session.get", side_effect=mocked_range_get):
+            filename = basemetofficedatahub.get_latest_order_file_id_data(
+                order_id=order_id, file_id=file_id
+            )
+
+        with open(filename, "rb") as f:
+            assert f.read() == data
+        assert not os.path.exists(f"{filename}.part")
+
+
+def test_latest_order_file_id_data_truncated(basemetofficedatahub):
+    """Check a truncated download is not saved as the final file"""
+    order_id = "test_order_id"
+    file_id = "agl_temperature_00"
+
+    def mocked_truncated_get(*args, **kwargs):
+        return MockDataResponse(content=b"1234", headers={"Content-Length": "100"})
+
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        basemetofficedatahub.cache_dir = tmpdirname
+
+        with mock.patch("requests.Session.get", side_effect=mocked_truncated_get):
+            with pytest.raises(Exception):
+                basemetofficedatahub.get_latest_order_file_id_data(
+                    order_id=order_id, file_id=file_id
+                )
+
+        filename = f"{tmpdirname}/{order_id}_{file_id}.grib"
+        assert not os.path.exists(filename)
+        assert os.path.exists(f"{filename}.part")
@@ -0,0 +1,43 @@
+import time
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+from metofficedatahub.rate_limit import RateLimiter, get_retry_after
+
+
+def test_rate_limiter_burst():
+    rate_limiter = RateLimiter(rate=10, burst=2)
+
+    assert rate_limiter.reserve() == 0
+    assert rate_limiter.reserve() == 0
+    # the bucket is empty, so the calls are queued one after another
+    assert 0.09 < rate_limiter.reserve() <= 0.1
+    assert 0.19 < rate_limiter.reserve() <= 0.2
+    assert rate_limiter.throttled_calls == 2
+
+
+def test_rate_limiter_no_limit():
+    rate_limiter = RateLimiter(rate=0)
+
+    assert all(rate_limiter.reserve() == 0 for _ in range(100))
+    assert rate_limiter.throttled_seconds == 0
+
+
+def test_rate_limiter_pause():
+    rate_limiter = RateLimiter(rate=0)
+    rate_limiter.pause(0.05)
+
+    start = time.monotonic()
+    rate_limiter.acquire()
+    assert time.monotonic() - start >= 0.04
+    assert rate_limiter.to_dict()["too_many_requests"] == 1
+    assert rate_limiter.throttled_calls == 1
+
+
+def test_get_retry_after():
+    assert get_retry_after(None) is None
+    assert get_retry_after("2") == 2
+    assert get_retry_after("not a date") is None
+
+    retry_datetime = datetime.now(timezone.utc) + timedelta(seconds=30)
+    assert 25 < get_retry_after(format_datetime(retry_datetime, usegmt=True)) <= 30
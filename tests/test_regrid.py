@@ -0,0 +1,48 @@
+import numpy as np
+from scipy.interpolate import griddata
+
+from metofficedatahub.regrid import RegridWeights, get_regrid_weights
+
+
+def _make_points(n_source=500, shape=(20, 30), seed=0):
+    rng = np.random.default_rng(seed)
+    source_points = rng.uniform(0, 100, size=(n_source, 2))
+    y_grid, x_grid = np.meshgrid(np.linspace(5, 95, shape[0]), np.linspace(5, 95, shape[1]))
+    y_grid, x_grid = y_grid.T, x_grid.T
+    target_points = np.array([y_grid.ravel(), x_grid.ravel()]).transpose()
+    return source_points, target_points, (y_grid, x_grid)
+
+
+def test_regrid_weights_same_as_griddata():
+    source_points, target_points, xi = _make_points()
+    values = np.random.default_rng(1).uniform(size=len(source_points))
+
+    weights = RegridWeights.from_points(
+        source_points=source_points, target_points=target_points, target_shape=xi[0].shape
+    )
+
+    for method in ["nearest", "linear"]:
+        expected = griddata(points=source_points, values=values, xi=xi, method=method)
+        np.testing.assert_allclose(getattr(weights, method)(values), expected)
+
+
+def test_regrid_weights_cache(tmp_path):
+    source_points, target_points, xi = _make_points(seed=2)
+    latitude, longitude = source_points[:, 0], source_points[:, 1]
+
+    weights = get_regrid_weights(
+        latitude=latitude,
+        longitude=longitude,
+        source_points=source_points,
+        target_points=target_points,
+        target_shape=xi[0].shape,
+        cache_dir=str(tmp_path),
+    )
+
+    files = list(tmp_path.glob("regrid_weights_*.npz"))
+    assert len(files) == 1
+
+    loaded = RegridWeights.load(str(files[0]))
+    np.testing.assert_array_equal(loaded.nearest_index, weights.nearest_index)
+    np.testing.assert_array_equal(loaded.linear_weights, weights.linear_weights)
+    assert loaded.target_shape == weights.target_shape
@@ -1,7 +1,9 @@
-import xarray as xr
 import numpy as np
+import pytest
+import xarray as xr
 
-from metofficedatahub.utils import post_process_dataset
+from metofficedatahub.regrid import _weights_in_memory
+from metofficedatahub.utils import NUM_COLS, NUM_ROWS, add_x_y, parse_bbox, post_process_dataset
 
 
 def test_post_process_dataset():
@@ -39,3 +41,84 @@ def test_post_process_dataset():
 
     for d in new_dims:
         assert d in da.dims
+    assert da.UKV.dtype == np.float32
+
+
+def test_add_x_y(ukv_dataset, tmp_path):
+    _weights_in_memory.clear()
+    dataset = add_x_y(ukv_dataset, regrid_cache_dir=str(tmp_path))
+
+    assert dataset.t.shape == (1, 3, NUM_ROWS, NUM_COLS)
+    assert dataset.latitude.shape == (NUM_ROWS, NUM_COLS)
+    assert not np.isnan(dataset.t.values).any()
+    assert len(list(tmp_path.glob("*.npz"))) == 1
+
+
+def test_add_x_y_engines(ukv_dataset):
+    batched = add_x_y(ukv_dataset.copy(), engine="batched")
+    slices = add_x_y(ukv_dataset.copy(), engine="slices")
+
+    for data_var in ["t", "lcc"]:
+        np.testing.assert_array_equal(batched[data_var].values, slices[data_var].values)
+
+
+def test_add_x_y_unknown_engine(ukv_dataset):
+    with pytest.raises(ValueError):
+        add_x_y(ukv_dataset, engine="unknown")
+
+
+def test_add_x_y_lazy(ukv_dataset):
+    eager = add_x_y(ukv_dataset.copy())
+    lazy = add_x_y(ukv_dataset.chunk({"step": 1}))
+
+    assert lazy.t.chunks is not None
+    xr.testing.assert_identical(lazy.compute(), eager)
+
+
+def test_add_x_y_dtype(ukv_dataset):
+    for dtype in ["float16", "float32", "float64"]:
+        for engine in ["batched", "slices"]:
+            dataset = add_x_y(ukv_dataset.copy(), engine=engine, dtype=dtype)
+            assert dataset.t.dtype == np.dtype(dtype)
+
+
+def test_add_x_y_dtype_not_float(ukv_dataset):
+    with pytest.raises(ValueError):
+        add_x_y(ukv_dataset, dtype="int32")
+
+
+def test_add_x_y_bbox(ukv_dataset):
+    full = add_x_y(ukv_dataset.copy())
+    bbox = (300_000, 400_000, 400_000, 500_000)
+    cropped = add_x_y(ukv_dataset.copy(), bbox=bbox)
+
+    assert cropped.t.shape == (1, 3, 50, 50)
+    assert cropped.x.min() >= bbox[0] and cropped.x.max() <= bbox[2]
+    assert cropped.y.min() >= bbox[1] and cropped.y.max() <= bbox[3]
+
+    # the same as cropping after regridding the whole area
+    expected = full.sel(x=cropped.x, y=cropped.y)
+    for data_var in ["t", "lcc"]:
+        np.testing.assert_array_equal(cropped[data_var].values, expected[data_var].values)
+    np.testing.assert_allclose(cropped.latitude.values, expected.latitude.values)
+
+
+def test_add_x_y_bbox_lat_lon(ukv_dataset):
+    dataset = add_x_y(ukv_dataset.copy(), bbox=(-3, 52, -1, 53), bbox_crs="lat_lon")
+
+    assert dataset.t.shape[-2:] == dataset.latitude.shape
+    assert NUM_ROWS > dataset.latitude.shape[0] > 0
+    assert 51.9 < dataset.latitude.min() and dataset.latitude.max() < 53.1
+    assert -3.1 < dataset.longitude.min() and dataset.longitude.max() < -0.9
+
+
+def test_add_x_y_bbox_outside(ukv_dataset):
+    with pytest.raises(ValueError):
+        add_x_y(ukv_dataset, bbox=(2_000_000, 2_000_000, 2_100_000, 2_100_000))
+
+
+def test_parse_bbox():
+    assert parse_bbox(None) is None
+    assert parse_bbox("-3,52,-1,53") == (-3, 52, -1, 53)
+    with pytest.raises(ValueError):
+        parse_bbox("1,2,3")